@@ -1,62 +1,414 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # __author__ = 'zfanswer'
+import concurrent.futures
 import sys
-from concurrent.futures import ThreadPoolExecutor
 
-import dingtalk_stream
-from dingtalk_stream import CallbackHandler
-from loguru import logger
+# 最先导入，统计导入各依赖的耗时，见 core.startup
+from core.startup import STARTUP
 
-from configs import DIFY_OPEN_API_URL, LOG_LEVEL, load_bots_config, DEFAULT_MAX_WORKERS
-from core.dify_client import ChatClient, CompletionClient, WorkflowClient
-from core.handlers import HandlerFactory
+with STARTUP.phase("imports"), STARTUP.trace_imports():
+    from dingtalk_stream import Credential
+    from loguru import logger
 
-logger.remove()
-logger.add(sys.stdout, level=LOG_LEVEL)
+    from configs import (
+        DIFY_OPEN_API_URL,
+        LOG_LEVEL,
+        LOG_ENQUEUE,
+        LOG_QUEUE_SIZE,
+        LOG_DEBUG_SAMPLE_RATE,
+        LOG_MAX_LENGTH,
+        LOG_REDACT_CONTENT,
+        load_bots_config,
+        DEFAULT_MAX_WORKERS,
+        DEFAULT_DIFY_CLIENT_MODE,
+        DIFY_CONVERSATION_REMAIN_TIME,
+        GLOBAL_MAX_CONCURRENCY,
+        PER_USER_MAX_CONCURRENCY,
+        PER_USER_POLICY,
+        ADMISSION_QUEUE_SIZE,
+        RUNTIME_MODE,
+        RUNTIME_LOOPS,
+        RUNTIME_PIN_CORES,
+        WORKER_PROCESSES,
+        METRICS_ENABLED,
+        METRICS_HOST,
+        METRICS_PORT,
+        JOURNAL_ENABLED,
+        JOURNAL_PATH,
+        JOURNAL_MAX_MB,
+        JOURNAL_BACKUP_COUNT,
+        JOURNAL_COMPRESS,
+        JOURNAL_FLUSH_INTERVAL,
+        JOURNAL_INCLUDE_QUERY,
+        BOTS_CONFIG_PATH,
+        BOTS_CONFIG_RELOAD_INTERVAL,
+        BOTS_DRAIN_TIMEOUT,
+    )
+    from core.dify_client import (
+        AsyncChatClient,
+        AsyncCompletionClient,
+        AsyncWorkflowClient,
+        ChatClient,
+        CompletionClient,
+        WorkflowClient,
+    )
+    from core.admission import AdmissionController
+    from core.answer_cache import AnswerCache
+    from core.attachments import AttachmentUploader
+    from core.upstream import CircuitBreaker
+    from core.config_watcher import ConfigWatcher, changed_keys, diff_bots
+    from core.conversation_store import create_conversation_store
+    from core.dingtalk_api import get_dingtalk_app
+    from core.handlers import HandlerFactory
+    from core.journal import journal_stats, setup_journal, shutdown_journal, worker_journal_path
+    from core.log import setup_logging, shutdown_logging, writer_stats
+    from core.metrics import REGISTRY, MetricsRegistry, enable_metrics, start_metrics_server
+    from core.runtime import BotRuntime
+    from core.workers import MetricsAggregator, Supervisor, WorkerContext, worker_metrics_port
 
+setup_logging(
+    level=LOG_LEVEL,
+    enqueue=LOG_ENQUEUE,
+    queue_size=LOG_QUEUE_SIZE,
+    sample_rate=LOG_DEBUG_SAMPLE_RATE,
+    max_length=LOG_MAX_LENGTH,
+    redact=LOG_REDACT_CONTENT,
+    stream=sys.stdout,
+)
 
-def start_dingtalk_stream_client(app_client_id: str, app_client_secret: str, callback_handler: CallbackHandler):
-    credential = dingtalk_stream.Credential(app_client_id, app_client_secret)
-    client = dingtalk_stream.DingTalkStreamClient(credential, logger)
-    # client.register_all_event_handler(event_handler())
-    client.register_callback_handler(dingtalk_stream.ChatbotMessage.TOPIC, callback_handler)
-    client.start_forever()
+
+DIFY_CLIENT_CLASSES = {
+    # (dify_app_type, dify_client_mode) -> client class
+    ("chatbot", "sync"): ChatClient,
+    ("completion", "sync"): CompletionClient,
+    ("workflow", "sync"): WorkflowClient,
+    ("chatbot", "async"): AsyncChatClient,
+    ("completion", "async"): AsyncCompletionClient,
+    ("workflow", "async"): AsyncWorkflowClient,
+}
+
+# 热加载时可以直接在运行中的机器人上修改的配置，其余配置变化时重建 handler（连接不断开）
+LIVE_BOT_KEYS = frozenset(
+    ["dify_app_api_key", "max_workers", "stream_connections", "max_concurrency", "card_update", "dingtalk_rate_limit"]
+)
+# 钉钉应用变化时只能重新建立连接
+RECONNECT_BOT_KEYS = frozenset(["dingtalk_app_client_id", "dingtalk_app_client_secret"])
+# 每个机器人导出到 /metrics 的统计
+BOT_STATS_PREFIXES = (
+    "dod_dify_pool",
+    "dod_upstream",
+    "dod_conversation_store",
+    "dod_dedup",
+    "dod_generations",
+    "dod_card_pool",
+    "dod_answer_cache",
+    "dod_attachments",
+    "dod_dingtalk_api",
+)
+# 多进程模式下当前 worker 的分配与消息转交，单进程时为空，见 core.workers
+WORKER = None
+
+
+def create_dify_client(bot: dict):
+    app_type = bot["dify_app_type"].lower()
+    client_mode = bot.get("dify_client_mode", DEFAULT_DIFY_CLIENT_MODE).lower()
+    if client_mode not in ("sync", "async"):
+        raise ValueError(f"不支持的dify客户端模式：{client_mode}")
+    client_class = DIFY_CLIENT_CLASSES.get((app_type, client_mode))
+    if client_class is None:
+        raise ValueError(f"不支持的机器人类型：{bot['dify_app_type']}")
+    # 连接池、超时与重试参数，见 README 中 http_pool 的说明
+    http_pool_conf = bot.get("http_pool") or {}
+    # 每个 bot 各自的上游熔断器，见 core.upstream
+    circuit_breaker = CircuitBreaker(**(bot.get("circuit_breaker") or {}))
+    return client_class(api_key=bot["dify_app_api_key"], base_url=DIFY_OPEN_API_URL, circuit_breaker=circuit_breaker, **http_pool_conf)
+
+
+def configure_dingtalk_app(bot: dict):
+    # 钉钉 OpenAPI 的调用频率限制按应用生效，同一个应用的多个机器人以最后加载的配置为准，见 core.dingtalk_api
+    dingtalk_app = get_dingtalk_app(Credential(bot["dingtalk_app_client_id"], bot["dingtalk_app_client_secret"]))
+    # 多进程模式下各 worker 按处理消息的比例分摊调用额度
+    share = WORKER.share(bot["name"]) if WORKER is not None else 1
+    dingtalk_app.configure(share=share, **(bot.get("dingtalk_rate_limit") or {}))
+    return dingtalk_app
+
+
+def create_bot_handler(bot: dict, admission_controller: AdmissionController, previous: tuple = None):
+    """
+    :param previous: 热加载时原来的 (bot 配置, handler)，沿用其中的去重记录、进行中的生成，
+                     以及配置没有变化的会话上下文与回答缓存，用户不会因为改了配置而丢失上下文
+    """
+    if WORKER is not None:
+        WORKER.set_bot(bot["name"], get_total_bot_connections(bot))
+    # 根据app类型和客户端模式，使用不同的dify api client
+    bot_dify_client = create_dify_client(bot)
+    dingtalk_app = configure_dingtalk_app(bot)
+    handler_params = {
+        "dify_api_client": bot_dify_client,
+        "card_update_conf": bot.get("card_update"),
+        "card_conf": bot.get("card"),
+        "admission_controller": admission_controller,
+        "bot_name": bot["name"],
+        "router": WORKER,
+    }
+    admission_controller.set_bot_limit(bot["name"], bot.get("max_concurrency", 0))
+    old_bot, old_handler = previous or ({}, None)
+    if old_handler is not None:
+        handler_params["deduplicator"] = old_handler.deduplicator
+        if not changed_keys(old_bot, bot) & {"conversation_store", "dify_app_type"}:
+            handler_params["conversation_store"] = old_handler.cache
+        if old_handler.answer_cache is not None and not changed_keys(old_bot, bot) & {"answer_cache", "dify_app_type"}:
+            handler_params["answer_cache"] = old_handler.answer_cache
+        if old_handler.attachment_uploader is not None and not changed_keys(old_bot, bot) & {"attachments", "dify_app_api_key"}:
+            # 上传过的文件属于原来的 Dify 应用所在的工作空间，换了 api key 后不再沿用
+            handler_params["attachment_uploader"] = old_handler.attachment_uploader
+    if bot.get("conversation_store") and "conversation_store" not in handler_params:
+        # 用户会话上下文存储，多副本部署时使用 sqlite/redis 共享
+        handler_params["conversation_store"] = create_conversation_store(
+            bot["conversation_store"], namespace=bot["name"], expiry_time=60 * DIFY_CONVERSATION_REMAIN_TIME
+        )
+    if bot.get("answer_cache") and "answer_cache" not in handler_params:
+        # 回答缓存只对无状态的应用有意义，chatbot 的回答依赖会话上下文
+        if bot["dify_app_type"].lower() in ("completion", "workflow"):
+            handler_params["answer_cache"] = AnswerCache(**bot["answer_cache"])
+        else:
+            logger.warning(f"机器人{bot['name']}的类型是{bot['dify_app_type']}，不支持回答缓存，已忽略answer_cache配置")
+    attachments_conf = dict(bot.get("attachments") or {})
+    if attachments_conf.pop("enabled", True) and "attachment_uploader" not in handler_params:
+        # 图片、文件消息下载后上传到 Dify，见 core.attachments
+        handler_params["attachment_uploader"] = AttachmentUploader(**attachments_conf)
+    handler = HandlerFactory.create_handler(bot["handler"], **handler_params)
+    if old_handler is not None:
+        # 新消息仍然可以取消旧 handler 上进行中的生成
+        handler.generations = old_handler.generations
+    if METRICS_ENABLED:
+        unregister_bot_stats(bot["name"])
+        # 各组件已有的统计信息一并导出到 /metrics
+        REGISTRY.register_stats("dod_dify_pool", bot_dify_client.pool_stats, bot=bot["name"])
+        REGISTRY.register_stats("dod_upstream", bot_dify_client.circuit_breaker.stats, bot=bot["name"])
+        REGISTRY.register_stats("dod_conversation_store", handler.cache.stats, bot=bot["name"])
+        REGISTRY.register_stats("dod_dedup", handler.deduplicator.stats, bot=bot["name"])
+        REGISTRY.register_stats("dod_generations", handler.generations.stats, bot=bot["name"])
+        if handler.card_pool is not None:
+            REGISTRY.register_stats("dod_card_pool", handler.card_pool.stats, bot=bot["name"])
+        if handler.answer_cache is not None:
+            REGISTRY.register_stats("dod_answer_cache", handler.answer_cache.stats, bot=bot["name"])
+        if handler.attachment_uploader is not None:
+            REGISTRY.register_stats("dod_attachments", handler.attachment_uploader.stats, bot=bot["name"])
+        REGISTRY.register_stats("dod_dingtalk_api", dingtalk_app.stats, bot=bot["name"])
+    return handler
+
+
+def unregister_bot_stats(name: str):
+    for prefix in BOT_STATS_PREFIXES:
+        REGISTRY.unregister_stats(prefix, bot=name)
+
+
+def start_bot(runtime: BotRuntime, bot: dict, admission_controller: AdmissionController, previous: tuple = None):
+    bot_handler = create_bot_handler(bot, admission_controller, previous=previous)
+    runtime.add_bot(
+        bot["name"],
+        bot["dingtalk_app_client_id"],
+        bot["dingtalk_app_client_secret"],
+        bot_handler,
+        connections=get_bot_connections(bot),
+    )
+
+
+def update_bot(runtime: BotRuntime, admission_controller: AdmissionController, old_bot: dict, bot: dict):
+    name = bot["name"]
+    keys = changed_keys(old_bot, bot)
+    handler = runtime.handlers[name]
+    logger.info(f"机器人{name}的配置有变化：{sorted(keys)}")
+    if keys & RECONNECT_BOT_KEYS:
+        # 钉钉应用变了，断开旧连接（已收到的消息继续处理完）后用新的凭证重新连接
+        new_handler = create_bot_handler(bot, admission_controller, previous=(old_bot, handler))
+        runtime.remove_bot(name, drain_timeout=BOTS_DRAIN_TIMEOUT)
+        runtime.add_bot(
+            name, bot["dingtalk_app_client_id"], bot["dingtalk_app_client_secret"], new_handler, connections=get_bot_connections(bot)
+        )
+        return
+    live_keys = LIVE_BOT_KEYS
+    if handler.attachment_uploader is not None:
+        # 上传过的文件属于原来的 Dify 应用所在的工作空间，换了 api key 后要连同附件上传器一起重建 handler
+        live_keys = LIVE_BOT_KEYS - {"dify_app_api_key"}
+    if keys - live_keys:
+        # 连接不断开，新消息交给新 handler
+        runtime.replace_handler(
+            name, create_bot_handler(bot, admission_controller, previous=(old_bot, handler)), drain_timeout=BOTS_DRAIN_TIMEOUT
+        )
+    else:
+        if "dify_app_api_key" in keys:
+            handler.dify_api_client.set_api_key(bot["dify_app_api_key"])
+        if "card_update" in keys:
+            handler.card_update_conf = bot.get("card_update") or {}
+        if WORKER is not None:
+            # 多进程模式下连接数变化会改变各 worker 处理的消息和分摊的调用额度
+            WORKER.set_bot(name, get_total_bot_connections(bot))
+        if "dingtalk_rate_limit" in keys or WORKER is not None:
+            configure_dingtalk_app(bot)
+        admission_controller.set_bot_limit(name, bot.get("max_concurrency", 0))
+    if get_bot_connections(bot) != get_bot_connections(old_bot):
+        runtime.resize_bot(name, get_bot_connections(bot), drain_timeout=BOTS_DRAIN_TIMEOUT)
+
+
+def apply_bots_config(runtime: BotRuntime, admission_controller: AdmissionController, old_conf: dict, new_conf: dict) -> dict:
+    """
+    热加载 .bots.yaml：对比新旧配置，增量地启动新机器人、停止删除的机器人、更新有变化的机器人。
+    单个机器人应用失败时保留它原来的配置继续运行，返回实际生效的配置。
+    """
+    diff = diff_bots(old_conf["bots"], new_conf["bots"])
+    applied = {bot["name"]: bot for bot in old_conf["bots"]}
+    for bot in diff["removed"]:
+        logger.info(f"停止机器人：{bot['name']}")
+        runtime.remove_bot(bot["name"], drain_timeout=BOTS_DRAIN_TIMEOUT)
+        admission_controller.set_bot_limit(bot["name"], 0)
+        if WORKER is not None:
+            WORKER.remove_bot(bot["name"])
+        if METRICS_ENABLED:
+            unregister_bot_stats(bot["name"])
+        del applied[bot["name"]]
+    for bot in diff["added"]:
+        logger.info(f"启动新机器人：{bot['name']}")
+        try:
+            start_bot(runtime, bot, admission_controller)
+        except Exception as e:
+            logger.opt(exception=e).error(f"启动机器人{bot['name']}失败：{e}")
+            continue
+        applied[bot["name"]] = bot
+    for old_bot, bot in diff["changed"]:
+        try:
+            update_bot(runtime, admission_controller, old_bot, bot)
+        except Exception as e:
+            logger.opt(exception=e).error(f"更新机器人{bot['name']}失败，继续使用原配置：{e}")
+            continue
+        applied[bot["name"]] = bot
+    return dict(new_conf, bots=[applied[bot["name"]] for bot in new_conf["bots"] if bot["name"] in applied])
+
+
+def get_total_bot_connections(bot: dict) -> int:
+    # threads 模式下每个连接占用一个线程，沿用 max_workers；asyncio 模式下连接数与并发无关，默认 1 个
+    if RUNTIME_MODE == "threads":
+        return bot.get("max_workers", DEFAULT_MAX_WORKERS)
+    return bot.get("stream_connections", 1)
+
+
+def get_bot_connections(bot: dict) -> int:
+    """本进程中的连接数，多进程模式下是分配给当前 worker 的部分"""
+    if WORKER is not None:
+        return WORKER.connections(bot["name"], get_total_bot_connections(bot))
+    return get_total_bot_connections(bot)
+
+
+def load_worker_bots_config(path: str = BOTS_CONFIG_PATH) -> dict:
+    # 多进程模式下只加载在当前 worker 中有连接的机器人；热加载时 ConfigWatcher 会传入配置文件路径
+    bots_conf = load_bots_config(path)
+    if WORKER is not None:
+        bots_conf = WORKER.filter_bots_config(bots_conf, get_total_bot_connections)
+    return bots_conf
 
 
 def run():
-    bots_conf = load_bots_config()
+    with STARTUP.phase("load_config"):
+        bots_conf = load_worker_bots_config()
     bots_cnt = len(bots_conf["bots"])
-    max_workers_num = 0
-    for bot in bots_conf["bots"]:
-        max_workers_num += bot.get("max_workers", DEFAULT_MAX_WORKERS)
-    logger.info(f"待启动机器人数量：{bots_cnt}, 预计使用最大线程数：{max_workers_num}")
-    with ThreadPoolExecutor(max_workers=max_workers_num) as executor:
-        futures = []
-        for i, bot in enumerate(bots_conf["bots"]):
-            logger.info(f"启动第{i+1}个机器人：{bot['name']}")
-            logger.debug(bot)
-            bot_worker_num = bot.get("max_workers", DEFAULT_MAX_WORKERS)
-            bot_app_client_id = bot["dingtalk_app_client_id"]
-            bot_app_client_secret = bot["dingtalk_app_client_secret"]
-            # 根据app类型，使用不同的dify api client
-            if bot["dify_app_type"].lower() == "chatbot":
-                bot_dify_client = ChatClient(api_key=bot["dify_app_api_key"], base_url=DIFY_OPEN_API_URL)
-            elif bot["dify_app_type"].lower() == "completion":
-                bot_dify_client = CompletionClient(api_key=bot["dify_app_api_key"], base_url=DIFY_OPEN_API_URL)
-            elif bot["dify_app_type"].lower() == "workflow":
-                bot_dify_client = WorkflowClient(api_key=bot["dify_app_api_key"], base_url=DIFY_OPEN_API_URL)
-            else:
-                raise ValueError(f"不支持的机器人类型：{bot['dify_app_type']}")
-            # bot_dify_client = ChatClient(api_key=bot["dify_app_api_key"], base_url=DIFY_OPEN_API_URL)
-            handler_params = {"dify_api_client": bot_dify_client}
-            bot_handler = HandlerFactory.create_handler(bot["handler"], **handler_params)
-            for _ in range(bot_worker_num):
-                futures.append(executor.submit(start_dingtalk_stream_client, bot_app_client_id, bot_app_client_secret, bot_handler))
-        # 等待所有线程完成
-        for future in futures:
-            future.result()
+    if RUNTIME_MODE == "threads":
+        max_workers_num = sum(get_bot_connections(bot) for bot in bots_conf["bots"])
+        logger.info(f"待启动机器人数量：{bots_cnt}, 预计使用最大线程数：{max_workers_num}")
+    else:
+        logger.info(f"待启动机器人数量：{bots_cnt}, 运行模式：{RUNTIME_MODE}, 事件循环数：{RUNTIME_LOOPS}")
+    runtime = BotRuntime(mode=RUNTIME_MODE, loops=RUNTIME_LOOPS, pin_cores=RUNTIME_PIN_CORES, on_connected=STARTUP.connection_ready)
+    # 所有机器人共享的并发准入控制
+    admission_controller = AdmissionController(
+        global_limit=GLOBAL_MAX_CONCURRENCY,
+        per_user_limit=PER_USER_MAX_CONCURRENCY,
+        per_user_policy=PER_USER_POLICY,
+        max_queue=ADMISSION_QUEUE_SIZE,
+    )
+    if WORKER is not None:
+        # 处理其他 worker 转交来的消息
+        WORKER.serve(runtime.dispatch)
+    if JOURNAL_ENABLED:
+        # 多进程模式下每个 worker 写各自的文件
+        setup_journal(
+            JOURNAL_PATH if WORKER is None else worker_journal_path(JOURNAL_PATH, WORKER.index),
+            max_bytes=int(JOURNAL_MAX_MB * 1024 * 1024),
+            backup_count=JOURNAL_BACKUP_COUNT,
+            compress=JOURNAL_COMPRESS,
+            flush_interval=JOURNAL_FLUSH_INTERVAL,
+            include_query=JOURNAL_INCLUDE_QUERY,
+        )
+    if METRICS_ENABLED:
+        enable_metrics()
+        REGISTRY.register_stats("dod_admission", admission_controller.stats)
+        REGISTRY.register_stats("dod_runtime", runtime.stats)
+        REGISTRY.register_stats("dod_startup", STARTUP.stats)
+        REGISTRY.register_stats("dod_logging", writer_stats)
+        if JOURNAL_ENABLED:
+            REGISTRY.register_stats("dod_journal", journal_stats)
+        if WORKER is None:
+            start_metrics_server(port=METRICS_PORT, host=METRICS_HOST)
+        else:
+            # 由 supervisor 汇总后对外提供
+            REGISTRY.register_stats("dod_worker", WORKER.stats)
+            start_metrics_server(port=worker_metrics_port(METRICS_PORT, WORKER.index), host="127.0.0.1")
+    # 所有连接第一次建立后输出启动耗时统计（startup_summary）
+    STARTUP.expect_connections(sum(max(1, int(get_bot_connections(bot))) for bot in bots_conf["bots"]))
+    with STARTUP.phase("start_bots"):
+        # 各机器人并行创建（会话存储、卡片池等可能需要网络），任何一个失败都和原来一样直接退出
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(8, bots_cnt)), thread_name_prefix="start-bot") as pool:
+            futures = []
+            for i, bot in enumerate(bots_conf["bots"]):
+                logger.info(f"启动第{i+1}个机器人：{bot['name']}")
+                logger.debug(bot)
+                futures.append(pool.submit(start_bot, runtime, bot, admission_controller))
+            for future in futures:
+                future.result()
+    watcher = None
+    if BOTS_CONFIG_RELOAD_INTERVAL > 0:
+        # 修改 .bots.yaml 后自动生效，不需要重启
+        watcher = ConfigWatcher(
+            BOTS_CONFIG_PATH,
+            load_worker_bots_config,
+            lambda old_conf, new_conf: apply_bots_config(runtime, admission_controller, old_conf, new_conf),
+            interval=BOTS_CONFIG_RELOAD_INTERVAL,
+        ).start(bots_conf)
+        if METRICS_ENABLED:
+            REGISTRY.register_stats("dod_config", watcher.stats)
+    # 等待所有连接结束；开启热加载时机器人可能被全部删除后再添加回来，不退出
+    try:
+        runtime.run_forever(exit_when_empty=watcher is None)
+    finally:
+        shutdown_journal()
+        shutdown_logging()
 
 
-if __name__ == "__main__":
+def run_worker(index: int, workers: int, inboxes: list):
+    """多进程模式下 worker 进程的入口，由 Supervisor 启动"""
+    global WORKER
+    WORKER = WorkerContext(index, workers, inboxes)
+    logger.info(f"worker{index}/{workers}启动")
     run()
+
+
+def run_supervisor(workers: int):
+    supervisor = Supervisor(run_worker, workers)
+    if METRICS_ENABLED:
+        # 汇总各 worker 的指标
+        registry = MetricsRegistry()
+        registry.register_stats("dod_supervisor", supervisor.stats)
+        ports = [worker_metrics_port(METRICS_PORT, i) for i in range(workers)]
+        start_metrics_server(port=METRICS_PORT, host=METRICS_HOST, registry=MetricsAggregator(ports, registry))
+    logger.info(f"多进程模式：启动{workers}个worker")
+    try:
+        supervisor.start().run_forever()
+    finally:
+        shutdown_logging()
+
+
+if __name__ == "__main__":
+    if WORKER_PROCESSES > 1:
+        run_supervisor(WORKER_PROCESSES)
+    else:
+        run()
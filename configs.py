@@ -13,20 +13,59 @@ load_dotenv(override=False, verbose=True)
 try:
     # app config
     LOG_LEVEL = os.getenv("LOG_LEVEL", default="INFO")
+    # 日志：后台线程写入、逐事件 debug 日志采样比例、单条最大长度（0 不截断）、是否隐去用户提问和回答内容
+    LOG_ENQUEUE = os.getenv("LOG_ENQUEUE", default="false").lower() == "true"
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", default=10000))
+    LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", default=1))
+    LOG_MAX_LENGTH = int(os.getenv("LOG_MAX_LENGTH", default=4096))
+    LOG_REDACT_CONTENT = os.getenv("LOG_REDACT_CONTENT", default="false").lower() == "true"
     DEFAULT_MAX_WORKERS = int(os.getenv("DEFAULT_MAX_WORKERS", default=2))
+    # threads: 每个连接一个线程；asyncio: 所有连接运行在 RUNTIME_LOOPS 个共享事件循环中
+    RUNTIME_MODE = os.getenv("RUNTIME_MODE", default="threads")
+    RUNTIME_LOOPS = int(os.getenv("RUNTIME_LOOPS", default=1))
+    RUNTIME_PIN_CORES = os.getenv("RUNTIME_PIN_CORES", default="false").lower() == "true"
+    # worker 进程数，大于 1 时由 supervisor 启动多个进程分担 stream 连接，见 core.workers
+    WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", default=1))
+    # 耗时统计与 /metrics 接口
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", default="false").lower() == "true"
+    METRICS_HOST = os.getenv("METRICS_HOST", default="0.0.0.0")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", default=9100))
+    # 请求日志：每条消息一行 JSON，后台批量写入并轮转，用于离线回放，见 core.journal
+    JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", default="false").lower() == "true"
+    JOURNAL_PATH = os.getenv("JOURNAL_PATH", default="data/journal/requests.jsonl")
+    JOURNAL_MAX_MB = float(os.getenv("JOURNAL_MAX_MB", default=64))
+    JOURNAL_BACKUP_COUNT = int(os.getenv("JOURNAL_BACKUP_COUNT", default=20))
+    JOURNAL_COMPRESS = os.getenv("JOURNAL_COMPRESS", default="true").lower() == "true"
+    JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", default=1))
+    # 不设置时跟随日志脱敏：开启 LOG_REDACT_CONTENT 时请求日志也不记录提问内容
+    JOURNAL_INCLUDE_QUERY = os.getenv("JOURNAL_INCLUDE_QUERY", default=str(not LOG_REDACT_CONTENT)).lower() == "true"
+    # .bots.yaml 热加载：检查间隔（秒，0 表示不开启），以及停止/替换机器人时等待进行中消息的最长时间
+    BOTS_CONFIG_RELOAD_INTERVAL = float(os.getenv("BOTS_CONFIG_RELOAD_INTERVAL", default=10))
+    BOTS_DRAIN_TIMEOUT = float(os.getenv("BOTS_DRAIN_TIMEOUT", default=300))
     # dify service config
     DIFY_OPEN_API_URL = os.getenv("DIFY_OPEN_API_URL", default="https://api.dify.ai/v1")
+    # sync: requests + 线程池；async: aiohttp，流式读取不阻塞钉钉 stream 的事件循环
+    DEFAULT_DIFY_CLIENT_MODE = os.getenv("DEFAULT_DIFY_CLIENT_MODE", default="async")
+    DIFY_CONVERSATION_REMAIN_TIME = int(os.getenv("DIFY_CONVERSATION_REMAIN_TIME", default=15))
+    # 并发准入控制，0 表示不限制
+    GLOBAL_MAX_CONCURRENCY = int(os.getenv("GLOBAL_MAX_CONCURRENCY", default=0))
+    PER_USER_MAX_CONCURRENCY = int(os.getenv("PER_USER_MAX_CONCURRENCY", default=1))
+    PER_USER_POLICY = os.getenv("PER_USER_POLICY", default="queue")
+    ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", default=100))
 except (TypeError, ValueError) as e:
     logger.error(f"Error converting environment variable: {e}")
     raise e
 
 
-def load_bots_config():
+BOTS_CONFIG_PATH = ".bots.yaml"
+
+
+def load_bots_config(path: str = BOTS_CONFIG_PATH):
     """
     load bots config from file
     :return:
     """
-    with open(".bots.yaml", "r") as f:
+    with open(path, "r") as f:
         bots_conf = yaml.safe_load(f)
     return bots_conf
 
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import threading
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Optional
+
+from loguru import logger
+
+# 更新排队位置的后台任务，保留引用避免执行中被垃圾回收
+_position_tasks = set()
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class Ticket(object):
+    """一次生成的准入凭证"""
+
+    def __init__(self, bot: str, user: str):
+        self.bot = bot
+        self.user = user
+        self.granted = False
+        self.released = False
+        self.merged_into: Optional["Ticket"] = None  # 被合并到的排队请求
+        self.extra_queries = []  # 合并进来的后续消息
+        self.position = 0
+        self._loop = None
+        self._future = None
+        self._on_position = None
+
+
+class AdmissionController(object):
+    """
+    生成请求的准入控制，所有 bot、所有 stream 连接线程共享一个实例：
+    - global_limit：全局同时进行的生成数，0 表示不限制；
+    - 每个 bot 的并发数通过 set_bot_limit 设置，0 表示不限制；
+    - per_user_limit：每个用户同时进行的生成数，同一用户的后续消息排队（queue）或合并到已排队的请求中（merge）；
+    - max_queue：等待队列长度，队列满时直接拒绝。
+    每个线程有自己的事件循环，所以这里用线程锁保护状态，再通过 call_soon_threadsafe 唤醒各自循环上的等待者。
+    """
+
+    def __init__(self, global_limit: int = 0, per_user_limit: int = 1, per_user_policy: str = "queue", max_queue: int = 100):
+        if per_user_policy not in ("queue", "merge"):
+            raise ValueError(f"不支持的用户排队策略：{per_user_policy}")
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self.per_user_policy = per_user_policy
+        self.max_queue = max_queue
+        self._bot_limits = {}
+        self._lock = threading.Lock()
+        self._running = 0
+        self._running_bot = defaultdict(int)
+        self._running_user = defaultdict(int)
+        self._queue = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.merged = 0
+        self.rejected = 0
+
+    def set_bot_limit(self, bot: str, limit: int):
+        with self._lock:
+            self._bot_limits[bot] = int(limit or 0)
+            granted = self._dispatch()
+        self._notify(granted)
+
+    def _can_run(self, bot: str, user: str) -> bool:
+        if self.global_limit and self._running >= self.global_limit:
+            return False
+        bot_limit = self._bot_limits.get(bot, 0)
+        if bot_limit and self._running_bot.get(bot, 0) >= bot_limit:
+            return False
+        if self.per_user_limit and self._running_user.get((bot, user), 0) >= self.per_user_limit:
+            return False
+        return True
+
+    def _grant(self, ticket: Ticket):
+        ticket.granted = True
+        self._running += 1
+        self._running_bot[ticket.bot] += 1
+        self._running_user[(ticket.bot, ticket.user)] += 1
+        self.admitted += 1
+
+    def _dispatch(self) -> list:
+        # 按排队顺序放行能运行的请求，返回被放行的 ticket 和位置有变化的 ticket
+        granted = []
+        for ticket in list(self._queue):
+            if self._can_run(ticket.bot, ticket.user):
+                self._queue.remove(ticket)
+                self._grant(ticket)
+                granted.append(ticket)
+        moved = []
+        for i, ticket in enumerate(self._queue):
+            if ticket.position != i + 1:
+                ticket.position = i + 1
+                moved.append(ticket)
+        return granted + moved
+
+    @staticmethod
+    def _notify(tickets: list):
+        for ticket in tickets:
+            if ticket._loop is None or ticket._loop.is_closed():
+                continue
+            if ticket.granted:
+                ticket._loop.call_soon_threadsafe(AdmissionController._wake, ticket)
+            elif ticket._on_position is not None:
+                ticket._loop.call_soon_threadsafe(AdmissionController._report_position, ticket)
+
+    @staticmethod
+    def _wake(ticket: Ticket):
+        if not ticket._future.done():
+            ticket._future.set_result(True)
+
+    @staticmethod
+    def _report_position(ticket: Ticket):
+        if not ticket.granted:
+            task = asyncio.ensure_future(ticket._on_position(ticket.position))
+            _position_tasks.add(task)
+            task.add_done_callback(AdmissionController._position_reported)
+
+    @staticmethod
+    def _position_reported(task: asyncio.Future):
+        _position_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.opt(exception=task.exception()).warning("更新排队位置失败")
+
+    async def acquire(self, bot: str, user: str, query: str = None, on_queued: Callable[[int], Awaitable] = None) -> Ticket:
+        """
+        申请运行一次生成，可能需要排队等待。
+        :param query: 用户消息，merge 策略下会追加到同一用户已在排队的请求的 extra_queries 中
+        :param on_queued: 排队及排队位置变化时回调，参数为当前排第几位
+        :return: Ticket；如果 merged_into 不为空，说明本次消息被合并到了同一用户已在排队的请求中，调用方无需再生成
+        :raise AdmissionRejected: 队列已满
+        """
+        ticket = Ticket(bot, user)
+        with self._lock:
+            if self.per_user_policy == "merge":
+                for waiting in self._queue:
+                    if waiting.bot == bot and waiting.user == user:
+                        ticket.merged_into = waiting
+                        if query:
+                            waiting.extra_queries.append(query)
+                        self.merged += 1
+                        return ticket
+            if self._can_run(bot, user):
+                self._grant(ticket)
+                return ticket
+            if len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected(f"queue is full, size={len(self._queue)}")
+            ticket._loop = asyncio.get_running_loop()
+            ticket._future = ticket._loop.create_future()
+            ticket._on_position = on_queued
+            self._queue.append(ticket)
+            ticket.position = len(self._queue)
+            self.queued += 1
+
+        if on_queued is not None:
+            await on_queued(ticket.position)
+        try:
+            await ticket._future
+        except asyncio.CancelledError:
+            # 排队中被取消
+            self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self._running -= 1
+                self._running_bot[ticket.bot] -= 1
+                self._running_user[(ticket.bot, ticket.user)] -= 1
+                if not self._running_user[(ticket.bot, ticket.user)]:
+                    del self._running_user[(ticket.bot, ticket.user)]
+            elif ticket in self._queue:
+                self._queue.remove(ticket)
+            changed = self._dispatch()
+        try:
+            self._notify(changed)
+        except RuntimeError as e:
+            logger.warning(f"唤醒排队请求失败：{e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._running,
+                "waiting": len(self._queue),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "merged": self.merged,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import threading
+import unicodedata
+from typing import Awaitable, Callable
+
+from core.cache import Cache
+
+# 归一化时去掉的结尾标点
+_TRAILING_PUNCTUATION = "?!.,;~。，；！？～、 "
+
+
+def normalize_query(query: str) -> str:
+    """全角转半角、合并空白、转小写并去掉结尾标点，“每月几号发工资？”与“每月几号发工资 ?”视为同一个问题"""
+    text = unicodedata.normalize("NFKC", query or "")
+    text = " ".join(text.split()).lower()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+class AnswerCache(object):
+    """
+    无状态的 completion/workflow 应用的回答缓存：
+    - key 由 bot、归一化后的问题和 inputs（去掉 ignore_inputs 中的字段）组成；
+    - 回答按 ttl 过期，最多保留 max_size 条；
+    - 相同问题同时有多个请求时只有第一个调用 Dify，其余的等待它的结果（single-flight），
+      等待者可能在其他线程的事件循环中，所以用 concurrent.futures.Future 传递结果；
+    - 命中时按 replay_chunk_size 个字符、每隔 replay_interval 秒回放到卡片上，保持流式输出的效果。
+    """
+
+    def __init__(
+        self,
+        ttl: float = 3600,
+        max_size: int = 1000,
+        ignore_inputs: list = ("sys_user_id",),
+        replay_chunk_size: int = 30,
+        replay_interval: float = 0.05,
+    ):
+        self._answers = Cache(expiry_time=ttl, max_size=max_size)
+        self.ignore_inputs = frozenset(ignore_inputs or ())
+        self.replay_chunk_size = max(1, int(replay_chunk_size))
+        self.replay_interval = replay_interval
+        self._inflight = {}  # key -> concurrent.futures.Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.coalesced = 0  # 等待同一问题的进行中请求得到的结果
+        self.misses = 0
+
+    def make_key(self, bot: str, query: str, inputs: dict = None) -> str:
+        inputs = {k: v for k, v in (inputs or {}).items() if k not in self.ignore_inputs}
+        raw = json.dumps([bot, normalize_query(query), inputs], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def lookup(self, key: str):
+        """
+        :return: (answer, flight)；命中时 answer 不为空；
+                 未命中时返回 flight，调用方负责生成并调用 complete(key, flight, answer)，失败时 answer 传 None
+        """
+        while True:
+            with self._lock:
+                answer = self._answers.get(key)
+                if answer is not None:
+                    self.hits += 1
+                    return answer, None
+                flight = self._inflight.get(key)
+                if flight is None:
+                    flight = self._inflight[key] = concurrent.futures.Future()
+                    self.misses += 1
+                    return None, flight
+            # 等待者被取消（卡片投递失败、停止服务）时不能取消共享的 flight，否则其他等待者和生成者都会受影响
+            answer = await asyncio.shield(asyncio.wrap_future(flight))
+            if answer is not None:
+                with self._lock:
+                    self.coalesced += 1
+                return answer, None
+            # 进行中的请求失败了，重新竞争由谁来生成
+
+    def complete(self, key: str, flight: concurrent.futures.Future, answer: str = None):
+        with self._lock:
+            if answer:
+                self._answers.set(key, answer)
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+        try:
+            flight.set_result(answer or None)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    async def replay(self, answer: str, update: Callable[[str], Awaitable]):
+        """按块回放缓存的回答，update 接收全量内容"""
+        size = self.replay_chunk_size
+        for end in range(size, len(answer), size):
+            await update(answer[:end])
+            if self.replay_interval:
+                await asyncio.sleep(self.replay_interval)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.coalesced + self.misses
+            return {
+                "size": len(self._answers),
+                "hits": self.hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "inflight": len(self._inflight),
+                "hit_ratio": (self.hits + self.coalesced) / total if total else 0.0,
+            }
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+图片、文件消息：从钉钉下载后上传到 Dify（/files/upload），得到的文件 id 作为 query 的 files 参数。
+- 一条消息中的多个附件并行下载、上传；
+- 下载时边读边计算 sha256，内容按块写入临时存储（小文件在内存中，超过 spool_size 的写入临时文件），上传时再按块读取；
+- 同一用户发送（或转发）相同内容的文件时直接使用缓存的文件 id，不重复上传。
+"""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import tempfile
+import threading
+
+from dingtalk_stream import ChatbotMessage
+
+from core.cache import Cache
+from core.dify_client import AsyncDifyClient, DifyClient
+from core.dingtalk_api import get_dingtalk_app, get_http_session
+
+# 扩展名 -> Dify 的文件类型，其余为 custom
+FILE_TYPES = {
+    "image": ("jpg", "jpeg", "png", "gif", "webp", "svg"),
+    "document": ("txt", "md", "markdown", "pdf", "html", "htm", "xlsx", "xls", "docx", "csv", "eml", "msg", "pptx", "ppt", "xml", "epub"),
+    "audio": ("mp3", "m4a", "wav", "webm", "amr"),
+    "video": ("mp4", "mov", "mpeg", "mpga"),
+}
+_FILE_TYPE_BY_EXTENSION = {ext: file_type for file_type, extensions in FILE_TYPES.items() for ext in extensions}
+
+# 钉钉图片消息没有文件名，按文件头判断格式
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png", "image/png"),
+    (b"\xff\xd8\xff", "jpg", "image/jpeg"),
+    (b"GIF8", "gif", "image/gif"),
+)
+
+
+class AttachmentError(Exception):
+    pass
+
+
+class Attachment(object):
+    """消息中的一个附件，download_code 用于向钉钉换取下载地址"""
+
+    __slots__ = ("download_code", "filename")
+
+    def __init__(self, download_code: str, filename: str = None):
+        self.download_code = download_code
+        self.filename = filename
+
+    def __repr__(self):
+        return f"Attachment({self.filename or 'image'})"
+
+
+def file_type(filename: str) -> str:
+    return _FILE_TYPE_BY_EXTENSION.get(os.path.splitext(filename or "")[1].lstrip(".").lower(), "custom")
+
+
+def sniff_image(head: bytes) -> tuple:
+    """根据文件头返回 (扩展名, content_type)，识别不了时按 png 处理"""
+    for signature, extension, content_type in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension, content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return "png", "image/png"
+
+
+def get_message_text(incoming_message: ChatbotMessage) -> str:
+    """消息中的文字：文本消息的内容或者富文本中的文字段落，其他类型为空字符串"""
+    if incoming_message.message_type == "text":
+        return incoming_message.text.content
+    if incoming_message.message_type == "richText" and incoming_message.rich_text_content is not None:
+        return "".join(item["text"] for item in incoming_message.rich_text_content.rich_text_list if "text" in item)
+    return ""
+
+
+def extract_attachments(incoming_message: ChatbotMessage) -> list:
+    """图片、富文本中的图片以及文件消息中的附件，同一个附件只取一次"""
+    attachments = []
+    if incoming_message.message_type == "picture" and incoming_message.image_content is not None:
+        attachments.append(Attachment(incoming_message.image_content.download_code))
+    elif incoming_message.message_type == "richText" and incoming_message.rich_text_content is not None:
+        for item in incoming_message.rich_text_content.rich_text_list:
+            if item.get("downloadCode"):
+                attachments.append(Attachment(item["downloadCode"]))
+    elif incoming_message.message_type == "file":
+        # SDK 不解析文件消息，内容在 extensions 中：{"downloadCode": ..., "fileName": ..., "fileId": ...}
+        content = incoming_message.extensions.get("content") or {}
+        if content.get("downloadCode"):
+            attachments.append(Attachment(content["downloadCode"], content.get("fileName") or "file"))
+    seen = set()
+    return [a for a in attachments if a.download_code and not (a.download_code in seen or seen.add(a.download_code))]
+
+
+class _SpooledFile(object):
+    """下载内容的临时存储，不超过 spool_size 时保存在内存中，超过后转存到临时文件"""
+
+    def __init__(self, spool_size: int):
+        self.spool_size = spool_size
+        self.file = io.BytesIO()
+        self.size = 0
+        self.head = b""
+        self._digest = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        if len(self.head) < 16:
+            self.head += chunk[: 16 - len(self.head)]
+        self._digest.update(chunk)
+        self.size += len(chunk)
+        if isinstance(self.file, io.BytesIO) and self.size > self.spool_size:
+            disk_file = tempfile.TemporaryFile()
+            disk_file.write(self.file.getbuffer())
+            self.file = disk_file
+        self.file.write(chunk)
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+
+async def get_download_url(dingtalk_client, download_code: str) -> str:
+    """用消息中的 downloadCode 换取文件的下载地址。https://open.dingtalk.com/document/isvapp/download-the-file-content-of-the-robot-receiving-message"""
+    body = {"robotCode": dingtalk_client.credential.client_id, "downloadCode": download_code}
+    response = await get_dingtalk_app(dingtalk_client.credential).request(
+        "POST", "/v1.0/robot/messageFiles/download", body, retry=True, error_class=AttachmentError
+    )
+    return response["downloadUrl"]
+
+
+class AttachmentUploader(object):
+    """
+    每个 bot 一个，handler 在收到图片/文件消息时调用 upload，与投放卡片同时进行。
+    文件 id 按 (用户, 内容 sha256) 缓存：Dify 只允许上传者本人使用上传的文件，不同用户之间不能共用。
+    :param max_size: 单个附件的最大 MB 数，超过时不再下载
+    :param max_parallel: 一条消息中同时下载、上传的附件数
+    :param cache_size: 缓存的文件 id 数量，0 表示不缓存
+    :param cache_ttl: 文件 id 的缓存秒数
+    :param spool_size: 附件在内存中暂存的最大字节数，超过后写入临时文件
+    """
+
+    def __init__(
+        self, max_size: float = 15, max_parallel: int = 4, cache_size: int = 1000, cache_ttl: float = 3600, spool_size: int = 1024 * 1024
+    ):
+        self.max_size = int(float(max_size) * 1024 * 1024)
+        self.max_parallel = max(1, int(max_parallel))
+        self.spool_size = int(spool_size)
+        self.file_ids = Cache(expiry_time=cache_ttl, max_size=cache_size) if cache_size else None
+        # 正在上传的 (用户, sha256) -> Future，同时收到相同内容的附件时只上传一次；handler 可能被多个事件循环共享，用线程安全的 Future
+        self._uploading = {}
+        self._lock = threading.Lock()
+        self.uploaded = 0
+        self.reused = 0
+        self.failures = 0
+        self.uploaded_bytes = 0
+
+    async def upload(self, dingtalk_client, dify_client: DifyClient, attachments: list, user: str) -> list:
+        """下载并上传全部附件，返回 Dify query 的 files 参数；任何一个失败时抛出 AttachmentError"""
+        semaphore = asyncio.Semaphore(self.max_parallel)
+
+        async def upload_one(attachment: Attachment) -> dict:
+            async with semaphore:
+                return await self._upload_one(dingtalk_client, dify_client, attachment, user)
+
+        tasks = [asyncio.ensure_future(upload_one(a)) for a in attachments]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except Exception:
+            self.failures += 1
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def _upload_one(self, dingtalk_client, dify_client: DifyClient, attachment: Attachment, user: str) -> dict:
+        spooled = await self._download(await get_download_url(dingtalk_client, attachment.download_code))
+        try:
+            if attachment.filename:
+                filename, content_type = attachment.filename, mimetypes.guess_type(attachment.filename)[0]
+            else:
+                extension, content_type = sniff_image(spooled.head)
+                filename = f"image.{extension}"
+            key = (user, spooled.hexdigest())
+            while True:
+                uploading = None
+                with self._lock:
+                    file_id = self.file_ids.get(key) if self.file_ids is not None else None
+                    if file_id is None:
+                        uploading = self._uploading.get(key)
+                        if uploading is None:
+                            self._uploading[key] = future = concurrent.futures.Future()
+                if uploading is None:
+                    break
+                # 等待者被取消时不能取消共享的 Future；上传失败或被取消时结果为 None，重新竞争由谁来上传
+                file_id = await asyncio.shield(asyncio.wrap_future(uploading))
+                if file_id is not None:
+                    break
+            if file_id is not None:
+                self.reused += 1
+            else:
+                try:
+                    spooled.file.seek(0)
+                    file_id = await self._upload_to_dify(dify_client, user, filename, spooled.file, content_type)
+                    # 先写缓存再结束 Future，之后到达的请求总能在其中之一找到
+                    if self.file_ids is not None:
+                        self.file_ids.set(key, file_id)
+                finally:
+                    with self._lock:
+                        self._uploading.pop(key, None)
+                    try:
+                        future.set_result(file_id)
+                    except concurrent.futures.InvalidStateError:
+                        pass
+                self.uploaded += 1
+                self.uploaded_bytes += spooled.size
+        finally:
+            spooled.close()
+        return {"type": file_type(filename), "transfer_method": "local_file", "upload_file_id": file_id}
+
+    async def _download(self, url: str) -> _SpooledFile:
+        spooled = _SpooledFile(self.spool_size)
+        try:
+            async with get_http_session().get(url) as response:
+                if response.status >= 400:
+                    raise AttachmentError(f"下载文件失败：status={response.status}")
+                if (response.content_length or 0) > self.max_size:
+                    raise AttachmentError(f"文件超过{self.max_size // 1024 // 1024}MB，无法处理")
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    if spooled.size + len(chunk) > self.max_size:
+                        raise AttachmentError(f"文件超过{self.max_size // 1024 // 1024}MB，无法处理")
+                    spooled.write(chunk)
+        except BaseException:
+            spooled.close()
+            raise
+        return spooled
+
+    @staticmethod
+    async def _upload_to_dify(dify_client: DifyClient, user: str, filename: str, fileobj, content_type: str = None) -> str:
+        files = {"file": (filename, fileobj, content_type or "application/octet-stream")}
+        if isinstance(dify_client, AsyncDifyClient):
+            response = await dify_client.file_upload(user, files)
+            status, text = response.status, await response.text()
+        else:
+            response = await asyncio.to_thread(dify_client.file_upload, user, files)
+            status, text = response.status_code, response.text
+        try:
+            body = json.loads(text)
+        except ValueError:
+            body = {}
+        if status not in (200, 201) or not isinstance(body, dict) or not body.get("id"):
+            raise AttachmentError(f"上传文件到Dify失败：status={status}, response={text}")
+        return body["id"]
+
+    def stats(self) -> dict:
+        stats = {"uploaded": self.uploaded, "reused": self.reused, "failures": self.failures, "uploaded_bytes": self.uploaded_bytes}
+        if self.file_ids is not None:
+            stats["cached"] = len(self.file_ids)
+        return stats
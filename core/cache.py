@@ -1,41 +1,112 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # __author__ = 'zfanswer'
+import threading
 import time
+import weakref
+from collections import OrderedDict
 
 
 class Cache:
-    def __init__(self, expiry_time=60):
-        self.cache = {}  # 普通的字典来存储数据
+    """
+    线程安全的 LRU + TTL 缓存。
+    - get/set 均为 O(1)，超过 max_size 时淘汰最久未使用的 key；
+    - 过期时间从 set 时开始计算，读取到过期 key 时删除；
+    - sweep_interval > 0 时启动后台线程定期清理过期 key，避免不再访问的 key 一直占用内存。
+    """
+
+    def __init__(self, expiry_time=60, max_size=10000, sweep_interval=0):
+        self.cache = OrderedDict()  # key -> (value, 写入时间)，按最近使用排序
         self.expiry_time = expiry_time
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._sweeper_stop = None
+        if sweep_interval and sweep_interval > 0:
+            self.start_sweeper(sweep_interval)
 
-    def _is_expired(self, key):
-        return time.time() - self.cache[key][1] > self.expiry_time
+    def _is_expired(self, key, now=None):
+        return (now or time.monotonic()) - self.cache[key][1] > self.expiry_time
 
     def set(self, key, value):
         # 插入新的key-value，并存储当前时间戳
-        self.cache[key] = (value, time.time())
+        with self._lock:
+            self.cache[key] = (value, time.monotonic())
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+                self.evictions += 1
 
     def get(self, key):
-        if key in self.cache:
-            if not self._is_expired(key):
-                return self.cache[key][0]  # 返回值
-            else:
-                del self.cache[key]  # 如果过期，删除该key
+        with self._lock:
+            if key in self.cache:
+                if not self._is_expired(key):
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return self.cache[key][0]  # 返回值
+                else:
+                    del self.cache[key]  # 如果过期，删除该key
+                    self.expirations += 1
+            self.misses += 1
         return None
 
+    def delete(self, key):
+        with self._lock:
+            self.cache.pop(key, None)
+
     def cleanup(self):
         # 清除过期的缓存
-        keys_to_delete = []
-        for key in list(self.cache):
-            if self._is_expired(key):
-                keys_to_delete.append(key)
-        for key in keys_to_delete:
-            del self.cache[key]
+        now = time.monotonic()
+        with self._lock:
+            keys_to_delete = [key for key in self.cache if self._is_expired(key, now)]
+            for key in keys_to_delete:
+                del self.cache[key]
+            self.expirations += len(keys_to_delete)
+        return len(keys_to_delete)
+
+    def start_sweeper(self, interval):
+        if self._sweeper_stop is not None:
+            return
+        self._sweeper_stop = threading.Event()
+        # 线程里只持有弱引用，缓存对象被回收后线程自动退出
+        threading.Thread(
+            target=Cache._sweep_forever, args=(weakref.ref(self), self._sweeper_stop, interval), name="cache-sweeper", daemon=True
+        ).start()
+
+    def stop_sweeper(self):
+        if self._sweeper_stop is not None:
+            self._sweeper_stop.set()
+            self._sweeper_stop = None
+
+    @staticmethod
+    def _sweep_forever(cache_ref, stop_event, interval):
+        while not stop_event.wait(interval):
+            cache = cache_ref()
+            if cache is None:
+                break
+            cache.cleanup()
+            del cache
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __len__(self):
+        return len(self.cache)
 
     def __str__(self):
         # 用于查看缓存内容
-        return str({k: v[0] for k, v in self.cache.items()})
+        with self._lock:
+            return str({k: v[0] for k, v in self.cache.items()})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import deque
+
+from dingtalk_stream import AICardReplier
+from loguru import logger
+
+from core.dingtalk_api import get_dingtalk_app
+
+
+class CardStreamingError(Exception):
+    pass
+
+
+class CardCreationError(Exception):
+    pass
+
+
+class DifyAICardReplier(AICardReplier):
+    """
+    在 SDK 的 AICardReplier 基础上：
+    - 创建、投放卡片拆成 async_create_card / async_deliver_card 两步，卡片实例与接收人无关，可以提前创建（见 CardPool）；
+    - 所有请求复用 aiohttp 会话，并受应用的调用频率限制，共用 access token（见 core.dingtalk_api）；
+    - 失败时抛出异常（SDK 只记录日志），流式更新失败时调用方可以据此降级为全量覆盖。
+    """
+
+    async def _post(self, path: str, body: dict, error_class=CardCreationError, retry: bool = True):
+        # 创建、投放卡片失败时整个回答都看不到了，默认在限流时重试
+        await get_dingtalk_app(self.dingtalk_client.credential).request("POST", path, body, retry=retry, error_class=error_class)
+
+    async def async_create_card(self, card_template_id: str, card_data: dict, card_instance_id: str = None, retry: bool = True) -> str:
+        """
+        创建卡片实例，不投放。https://open.dingtalk.com/document/orgapp/interface-for-creating-a-card-instance
+        :param retry: 被限流时是否重试，预创建卡片时不需要
+        :return: 卡片的实例ID
+        """
+        card_instance_id = card_instance_id or uuid.uuid4().hex
+        body = {
+            "cardTemplateId": card_template_id,
+            "outTrackId": card_instance_id,
+            "cardData": {"cardParamMap": card_data},
+            "callbackType": "STREAM",
+            "imGroupOpenSpaceModel": {"supportForward": True},
+            "imRobotOpenSpaceModel": {"supportForward": True},
+        }
+        await self._post("/v1.0/card/instances", body, retry=retry)
+        return card_instance_id
+
+    async def async_deliver_card(self, card_instance_id: str, at_sender: bool = False):
+        """把卡片投放到消息所在的会话。https://open.dingtalk.com/document/orgapp/delivery-card-interface"""
+        message = self.incoming_message
+        body = {"outTrackId": card_instance_id, "userIdType": 1}
+        extension = None
+        if message.hosting_context is not None:
+            extension = {"hostingRepliedContext": json.dumps({"userId": message.hosting_context.user_id})}
+        # 2：群聊，1：单聊
+        if message.conversation_type == "2":
+            body["openSpaceId"] = f"dtv1.card//IM_GROUP.{message.conversation_id}"
+            body["imGroupOpenDeliverModel"] = {"robotCode": self.dingtalk_client.credential.client_id}
+            if at_sender:
+                body["imGroupOpenDeliverModel"]["atUserIds"] = {message.sender_staff_id: message.sender_nick}
+            if extension:
+                body["imGroupOpenDeliverModel"]["extension"] = extension
+        elif message.conversation_type == "1":
+            body["openSpaceId"] = f"dtv1.card//IM_ROBOT.{message.sender_staff_id}"
+            body["imRobotOpenDeliverModel"] = {"spaceType": "IM_ROBOT"}
+            if extension:
+                body["imRobotOpenDeliverModel"]["extension"] = extension
+        await self._post("/v1.0/card/instances/deliver", body)
+
+    async def async_streaming(
+        self,
+        card_instance_id: str,
+        content_key: str,
+        content_value: str,
+        append: bool,
+        finished: bool,
+        failed: bool,
+    ):
+        body = {
+            "outTrackId": card_instance_id,
+            "guid": str(uuid.uuid1()),
+            "key": content_key,
+            "content": content_value,
+            "isFull": not append,
+            "isFinalize": finished,
+            "isError": failed,
+        }
+        # 结束（或失败）更新只有一次，优先发送并在限流时重试；中间的更新被限流时由下一次更新覆盖
+        final = finished or failed
+        await get_dingtalk_app(self.dingtalk_client.credential).request(
+            "PUT", "/v1.0/card/streaming", body, urgent=final, retry=final, error_class=CardStreamingError
+        )
+
+
+class CardPool(object):
+    """
+    提前创建好的空白卡片实例，收到消息时只需要投放，省掉一次创建卡片的往返。
+    卡片实例与接收人无关，但不能无限期保留，超过 max_age 秒的直接丢弃。
+    同一个 handler 可能被多个事件循环共享，这里只保存卡片ID，补充卡片的任务在取卡片的事件循环上运行。
+    创建连续失败（模板有误、被限流）时按 retry_delay 指数退避，期间不补充，之后每次只试创建一张，避免占用卡片更新的调用额度。
+    """
+
+    def __init__(
+        self,
+        card_template_id: str,
+        card_data: dict,
+        size: int = 10,
+        max_age: float = 1800,
+        retry_delay: float = 1,
+        max_retry_delay: float = 300,
+    ):
+        self.card_template_id = card_template_id
+        self.card_data = card_data
+        self.size = size
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._cards = deque()  # (card_instance_id, created_at)
+        self._creating = 0
+        self._consecutive_failures = 0
+        self._retry_at = 0.0
+        # 保留补充任务的引用，避免执行中被垃圾回收
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.failures = 0
+
+    def acquire(self, dingtalk_client) -> str:
+        """
+        取出一张预先创建的卡片并在后台补充，没有可用的卡片时返回 None；需要在事件循环中调用。
+        """
+        card_instance_id = None
+        now = time.monotonic()
+        with self._lock:
+            while self._cards:
+                card_id, created_at = self._cards.popleft()
+                if now - created_at <= self.max_age:
+                    card_instance_id = card_id
+                    break
+                self.expired += 1
+            if card_instance_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            missing = self.size - len(self._cards) - self._creating
+            if self._consecutive_failures:
+                # 退避期间不补充，之后先试一张
+                missing = min(missing, 1) if now >= self._retry_at and not self._creating else 0
+            missing = max(0, missing)
+            self._creating += missing
+        for _ in range(missing):
+            task = asyncio.ensure_future(self._create(dingtalk_client))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return card_instance_id
+
+    async def _create(self, dingtalk_client):
+        try:
+            card_id = await DifyAICardReplier(dingtalk_client, None).async_create_card(self.card_template_id, self.card_data, retry=False)
+        except Exception as e:
+            with self._lock:
+                self._creating -= 1
+                self.failures += 1
+                self._consecutive_failures += 1
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** (self._consecutive_failures - 1))
+                self._retry_at = time.monotonic() + delay
+            logger.warning(f"预创建卡片失败，{delay:.1f}秒内不再补充：{e}")
+            return
+        with self._lock:
+            self._creating -= 1
+            self._consecutive_failures = 0
+            self._cards.append((card_id, time.monotonic()))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "available": len(self._cards),
+                "creating": self._creating,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "failures": self.failures,
+                "consecutive_failures": self._consecutive_failures,
+            }
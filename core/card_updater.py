@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+# send(content, append, finished, failed) -> awaitable，负责真正调用钉钉的流式更新接口，失败时抛出异常
+SendFunc = Callable[[str, bool, bool, bool], Awaitable]
+
+
+class CardUpdater(object):
+    """
+    立即更新：每次 update 都等待钉钉接口返回，保持原有行为。
+    update 传入的都是当前累计的全量内容，由 append 决定实际发送全量内容还是只发送新增部分：
+    append 模式下记录卡片上已确认的内容，只发送之后的增量；如果上一次更新失败，
+    或者新内容不是已确认内容的延续（例如被替换成了错误信息），则自动退回全量覆盖。
+    """
+
+    def __init__(self, send: SendFunc, append: bool = False):
+        self._send = send
+        self.append = bool(append)
+        self._acked = ""  # 卡片上已确认显示的内容，None 表示状态未知
+        self._finished = False
+        self.updates_sent = 0
+        self.append_updates = 0
+        self.full_updates = 0
+        self.failed_updates = 0
+        self.bytes_sent = 0
+        self.full_bytes = 0  # 同样的更新全部使用全量覆盖时需要发送的字节数，用于对比两种模式
+
+    def start(self):
+        return self
+
+    async def update(self, content: str):
+        if self._finished:
+            return
+        await self._do_send(content, finished=False, failed=False)
+
+    async def finish(self, content: str, failed: bool = False):
+        # 保证只会发送一次结束（或失败）更新
+        if self._finished:
+            return
+        self._finished = True
+        if not await self._do_send(content, finished=not failed, failed=failed) and self.append:
+            # 结束更新失败后没有下一次机会了，立即用全量覆盖重试一次
+            await self._do_send(content, finished=not failed, failed=failed)
+
+    def close(self):
+        """放弃后续的所有更新，例如卡片投放失败时"""
+        self._finished = True
+
+    async def _do_send(self, content: str, finished: bool, failed: bool) -> bool:
+        use_append = self.append and not failed and self._acked is not None and content.startswith(self._acked)
+        payload = content[len(self._acked) :] if use_append else content
+        self.updates_sent += 1
+        if use_append:
+            self.append_updates += 1
+        else:
+            self.full_updates += 1
+        self.bytes_sent += len(payload.encode("utf-8"))
+        self.full_bytes += len(content.encode("utf-8"))
+        try:
+            await self._send(payload, use_append, finished, failed)
+        except Exception as e:
+            logger.warning(f"卡片更新失败：{e}")
+            self.failed_updates += 1
+            self._acked = None
+            return False
+        self._acked = content
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "mode": "append" if self.append else "full",
+            "updates_sent": self.updates_sent,
+            "append_updates": self.append_updates,
+            "full_updates": self.full_updates,
+            "failed_updates": self.failed_updates,
+            "bytes_sent": self.bytes_sent,
+            "full_bytes": self.full_bytes,
+        }
+
+
+class CoalescingCardUpdater(CardUpdater):
+    """
+    合并更新：update 只记录最新内容并唤醒后台任务后立即返回，不会因为钉钉接口慢而拖住 SSE 的读取。
+    后台任务在距离上次刷新超过 min_interval 秒，或待发送内容超过 max_pending 个字符时才刷新一次。
+    """
+
+    def __init__(self, send: SendFunc, append: bool = False, min_interval: float = 0.5, max_pending: int = 200):
+        super().__init__(send, append)
+        self.min_interval = float(min_interval)
+        self.max_pending = int(max_pending)
+        self._latest = ""
+        self._sent = ""
+        self._final = None  # (content, failed)
+        self._last_flush = 0.0
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def update(self, content: str):
+        if self._final is not None:
+            return
+        self._latest = content
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def finish(self, content: str, failed: bool = False):
+        if self._final is not None:
+            return
+        self._final = (content, failed)
+        if self._task is None:
+            # 未启动后台任务时直接发送最终结果
+            await super().finish(content, failed)
+            return
+        self._wakeup.set()
+        await self._task
+
+    def close(self):
+        super().close()
+        if self._final is None:
+            self._final = ("", False)
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def _pending_size(self) -> int:
+        return len(self._latest) - len(self._sent)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._final is None:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # 等到距离上次刷新满 min_interval，期间积压过多或收到结束信号则提前刷新
+            while self._final is None and self._pending_size() < self.max_pending:
+                remaining = self.min_interval - (loop.time() - self._last_flush)
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                    self._wakeup.clear()
+                except asyncio.TimeoutError:
+                    break
+            if self._final is None and self._latest != self._sent:
+                content = self._latest
+                # 失败时由 _do_send 标记，下次刷新自动全量覆盖
+                await self._do_send(content, finished=False, failed=False)
+                self._sent = content
+                self._last_flush = loop.time()
+        content, failed = self._final
+        await CardUpdater.finish(self, content, failed)
+
+
+def create_card_updater(send: SendFunc, mode: str = "coalesce", **options) -> CardUpdater:
+    """
+    根据配置创建卡片更新器
+    :param send: 调用钉钉流式更新接口的协程函数
+    :param mode: coalesce 合并更新；immediate 每次都立即更新
+    :param options: append 是否只发送增量；以及 coalesce 模式下的 min_interval、max_pending
+    """
+    mode = (mode or "coalesce").lower()
+    if mode == "coalesce":
+        return CoalescingCardUpdater(send, **options)
+    elif mode == "immediate":
+        return CardUpdater(send, append=options.get("append", False))
+    raise ValueError(f"不支持的卡片更新模式：{mode}")
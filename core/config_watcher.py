@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import hashlib
+import os
+import threading
+from typing import Callable
+
+from loguru import logger
+
+
+def diff_bots(old_bots: list, new_bots: list) -> dict:
+    """
+    按 name 对比新旧机器人列表
+    :return: {"added": [bot], "removed": [bot], "changed": [(old_bot, new_bot)]}
+    """
+    old = {bot["name"]: bot for bot in old_bots or []}
+    new = {bot["name"]: bot for bot in new_bots or []}
+    return {
+        "added": [bot for name, bot in new.items() if name not in old],
+        "removed": [bot for name, bot in old.items() if name not in new],
+        "changed": [(old[name], bot) for name, bot in new.items() if name in old and old[name] != bot],
+    }
+
+
+def changed_keys(old_bot: dict, new_bot: dict) -> set:
+    return {k for k in set(old_bot) | set(new_bot) if old_bot.get(k) != new_bot.get(k)}
+
+
+def validate_bots_config(bots_conf: dict):
+    """配置有误时抛出 ValueError，热加载时保留原配置"""
+    if not isinstance(bots_conf, dict) or not isinstance(bots_conf.get("bots"), list):
+        raise ValueError("配置中缺少bots列表")
+    names = set()
+    for bot in bots_conf["bots"]:
+        for key in ("name", "dingtalk_app_client_id", "dingtalk_app_client_secret", "dify_app_type", "dify_app_api_key", "handler"):
+            if not isinstance(bot, dict) or not bot.get(key):
+                raise ValueError(f"机器人配置缺少{key}：{bot.get('name') if isinstance(bot, dict) else bot}")
+        if bot["name"] in names:
+            raise ValueError(f"机器人名称重复：{bot['name']}")
+        names.add(bot["name"])
+
+
+class ConfigWatcher(object):
+    """
+    定期检查配置文件，内容变化时重新加载并回调 on_change(old_conf, new_conf)。
+    on_change 返回实际生效的配置（部分机器人应用失败时与 new_conf 不同），下次变化时与它对比；返回 None 表示全部生效。
+    只比较修改时间和内容摘要，不依赖 inotify；加载或回调失败时保留原配置，等文件下次变化再试。
+    """
+
+    def __init__(self, path: str, load: Callable[[str], dict], on_change: Callable[[dict, dict], dict], interval: float = 10):
+        self.path = path
+        self.load = load
+        self.on_change = on_change
+        self.interval = interval
+        self.reloads = 0
+        self.failures = 0
+        self._conf = None
+        self._mtime = None
+        self._digest = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, current_conf: dict):
+        """current_conf 为启动时已经加载并生效的配置"""
+        self._conf = current_conf
+        self._mtime, self._digest = self._fingerprint()
+        self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _fingerprint(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, "rb") as f:
+                return mtime, hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None, None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self) -> bool:
+        """文件变化并且成功应用时返回 True"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f"读取配置文件失败：{e}")
+            return False
+        if mtime == self._mtime:
+            return False
+        mtime, digest = self._fingerprint()
+        self._mtime = mtime
+        if digest == self._digest:
+            # 只是 touch 了一下，内容没变
+            return False
+        self._digest = digest
+        try:
+            new_conf = self.load(self.path)
+            validate_bots_config(new_conf)
+            applied = self.on_change(self._conf, new_conf)
+        except Exception as e:
+            self.failures += 1
+            logger.opt(exception=e).error(f"热加载配置失败，继续使用原配置：{e}")
+            return False
+        self._conf = new_conf if applied is None else applied
+        self.reloads += 1
+        return True
+
+    def stats(self) -> dict:
+        return {"reloads": self.reloads, "failures": self.failures}
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from loguru import logger
+
+from core.cache import Cache
+
+
+class ConversationStore(object):
+    """
+    用户 -> dify conversation_id 的存储接口，DifyAiCardBotHandler 通过它维持用户各自的会话上下文。
+    key 会自动加上 namespace（一般是 bot 名称）前缀，多个 bot 可以共用同一个后端。
+    """
+
+    def __init__(self, namespace: str = "", expiry_time: float = 900):
+        self.namespace = namespace
+        self.expiry_time = expiry_time
+
+    def _key(self, key) -> str:
+        return f"{self.namespace}:{key}" if self.namespace else str(key)
+
+    def get(self, key):
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    async def async_get(self, key):
+        # 在事件循环中读取：sqlite/redis 可能要读盘或访问网络，放到线程池里执行
+        return await asyncio.to_thread(self.get, key)
+
+    def set(self, key, value):
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def delete(self, key):
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def flush(self):
+        # 立即写入还未落盘的数据
+        pass
+
+    def close(self):
+        self.flush()
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryConversationStore(ConversationStore):
+    """进程内存储，只在当前进程内有效"""
+
+    def __init__(self, namespace: str = "", expiry_time: float = 900, max_size: int = 10000, sweep_interval: float = 60):
+        super().__init__(namespace, expiry_time)
+        self.cache = Cache(expiry_time=expiry_time, max_size=max_size, sweep_interval=sweep_interval)
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    async def async_get(self, key):
+        return self.get(key)
+
+    def set(self, key, value):
+        self.cache.set(self._key(key), value)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
+
+    def close(self):
+        self.cache.stop_sweeper()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class _BatchWriter(object):
+    """
+    后台批量写入：set 只放入待写队列，由后台线程每隔 flush_interval 秒或积攒 max_batch 条后一次性写入后端。
+    同一个 key 多次写入只保留最后一次。
+    """
+
+    def __init__(self, write_batch, flush_interval: float = 0.5, max_batch: int = 100, name: str = "store-writer"):
+        self._write_batch = write_batch  # write_batch(list[(key, value)])，value 为 None 表示删除
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.batches = 0
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            self._pending.move_to_end(key)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wakeup.set()
+
+    def get_pending(self, key):
+        # 返回 (是否在待写队列中, 值)
+        with self._lock:
+            if key in self._pending:
+                return True, self._pending[key]
+        return False, None
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch = list(self._pending.items())
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # 写入失败时保留在队列里，下次再试
+                logger.error(f"会话存储批量写入失败：{e}")
+                return
+            with self._lock:
+                # 只移除写入期间没有被再次修改过的 key
+                for key, value in batch:
+                    if key in self._pending and self._pending[key] == value:
+                        del self._pending[key]
+            self.batches += 1
+            self.written += len(batch)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    本地 SQLite 文件存储，开启 WAL，同一台机器上的多个进程可以共享。
+    - 写：后台批量写入，不阻塞消息处理；
+    - 读：先查本进程的短时缓存和待写队列，未命中再查 SQLite。
+    """
+
+    def __init__(
+        self,
+        namespace: str = "",
+        expiry_time: float = 900,
+        path: str = "data/conversations.db",
+        flush_interval: float = 0.5,
+        max_batch: int = 100,
+        local_ttl: float = 5,
+        local_size: int = 10000,
+    ):
+        super().__init__(namespace, expiry_time)
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        # 各线程创建的连接，close 时统一关闭
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS conversations (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self._local_cache = Cache(expiry_time=local_ttl, max_size=local_size) if local_ttl > 0 else None
+        self._writer = _BatchWriter(self._write_batch, flush_interval, max_batch, name="sqlite-store-writer")
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程使用，每个线程各自一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _write_batch(self, batch):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations (key, value, updated_at) VALUES (?, ?, ?)",
+                [(k, v, now) for k, v in batch if v is not None],
+            )
+            conn.executemany("DELETE FROM conversations WHERE key = ?", [(k,) for k, v in batch if v is None])
+            # 顺带清理过期会话
+            conn.execute("DELETE FROM conversations WHERE updated_at < ?", (now - self.expiry_time,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        key = self._key(key)
+        if self._local_cache is not None:
+            value = self._local_cache.get(key)
+            if value is not None:
+                return value
+        pending, value = self._writer.get_pending(key)
+        if not pending:
+            row = (
+                self._connect()
+                .execute("SELECT value FROM conversations WHERE key = ? AND updated_at >= ?", (key, time.time() - self.expiry_time))
+                .fetchone()
+            )
+            value = row[0] if row else None
+        if value is not None and self._local_cache is not None:
+            self._local_cache.set(key, value)
+        return value
+
+    def set(self, key, value):
+        key = self._key(key)
+        if self._local_cache is not None:
+            self._local_cache.set(key, value)
+        self._writer.put(key, value)
+
+    def delete(self, key):
+        key = self._key(key)
+        if self._local_cache is not None:
+            self._local_cache.delete(key)
+        self._writer.put(key, None)
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+    def stats(self) -> dict:
+        stats = {"batches": self._writer.batches, "written": self._writer.written}
+        if self._local_cache is not None:
+            stats.update({f"local_{k}": v for k, v in self._local_cache.stats().items()})
+        return stats
+
+
+class RedisError(Exception):
+    pass
+
+
+class _RedisConnection(object):
+    """只实现了本项目用到的 RESP 协议子集"""
+
+    def __init__(self, host: str, port: int, password: str = None, db: int = 0, timeout: float = 2):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    @staticmethod
+    def _pack(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def execute(self, *args):
+        self.sock.sendall(self._pack(args))
+        return self._read_reply()
+
+    def pipeline(self, commands):
+        # 一次发送多条命令，再依次读取结果
+        self.sock.sendall(b"".join(self._pack(args) for args in commands))
+        return [self._read_reply() for _ in commands]
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode("utf-8")
+        if prefix == b"-":
+            raise RedisError(rest.decode("utf-8"))
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return self.reader.read(length + 2)[:-2].decode("utf-8")
+        if prefix == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f"unknown reply: {line!r}")
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisConversationStore(ConversationStore):
+    """
+    Redis 协议存储，适用于多副本部署。url 形如 redis://:password@127.0.0.1:6379/0。
+    写入走后台批量 pipeline，读取先查本进程的短时缓存。
+    """
+
+    def __init__(
+        self,
+        namespace: str = "",
+        expiry_time: float = 900,
+        url: str = "redis://127.0.0.1:6379/0",
+        key_prefix: str = "dod:conversation:",
+        pool_size: int = 4,
+        timeout: float = 2,
+        flush_interval: float = 0.2,
+        max_batch: int = 100,
+        local_ttl: float = 5,
+        local_size: int = 10000,
+    ):
+        super().__init__(namespace, expiry_time)
+        parsed = urlparse(url)
+        self._conn_args = dict(
+            host=parsed.hostname or "127.0.0.1",
+            port=parsed.port or 6379,
+            password=parsed.password,
+            db=int((parsed.path or "/0").lstrip("/") or 0),
+            timeout=timeout,
+        )
+        self.key_prefix = key_prefix
+        self.pool_size = pool_size
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        self._local_cache = Cache(expiry_time=local_ttl, max_size=local_size) if local_ttl > 0 else None
+        self._writer = _BatchWriter(self._write_batch, flush_interval, max_batch, name="redis-store-writer")
+
+    def _key(self, key) -> str:
+        return self.key_prefix + super()._key(key)
+
+    def _execute(self, func):
+        with self._pool_lock:
+            conn = self._pool.pop() if self._pool else None
+        if conn is None:
+            conn = _RedisConnection(**self._conn_args)
+        try:
+            result = func(conn)
+        except (OSError, ConnectionError):
+            # 连接异常时丢弃该连接
+            conn.close()
+            raise
+        with self._pool_lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        return result
+
+    def _write_batch(self, batch):
+        ttl = max(1, int(self.expiry_time))
+        commands = [("SET", k, v, "EX", ttl) if v is not None else ("DEL", k) for k, v in batch]
+        self._execute(lambda conn: conn.pipeline(commands))
+
+    def get(self, key):
+        key = self._key(key)
+        if self._local_cache is not None:
+            value = self._local_cache.get(key)
+            if value is not None:
+                return value
+        pending, value = self._writer.get_pending(key)
+        if not pending:
+            try:
+                value = self._execute(lambda conn: conn.execute("GET", key))
+            except (OSError, ConnectionError, RedisError) as e:
+                # 读取失败时当作没有上下文处理，开启新会话
+                logger.error(f"读取会话存储失败：{e}")
+                return None
+        if value is not None and self._local_cache is not None:
+            self._local_cache.set(key, value)
+        return value
+
+    def set(self, key, value):
+        key = self._key(key)
+        if self._local_cache is not None:
+            self._local_cache.set(key, value)
+        self._writer.put(key, value)
+
+    def delete(self, key):
+        key = self._key(key)
+        if self._local_cache is not None:
+            self._local_cache.delete(key)
+        self._writer.put(key, None)
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+        with self._pool_lock:
+            for conn in self._pool:
+                conn.close()
+            self._pool = []
+
+    def stats(self) -> dict:
+        stats = {"batches": self._writer.batches, "written": self._writer.written}
+        if self._local_cache is not None:
+            stats.update({f"local_{k}": v for k, v in self._local_cache.stats().items()})
+        return stats
+
+
+CONVERSATION_STORES = {
+    "memory": MemoryConversationStore,
+    "sqlite": SQLiteConversationStore,
+    "redis": RedisConversationStore,
+}
+
+
+def create_conversation_store(conf: dict = None, namespace: str = "", expiry_time: float = 900) -> ConversationStore:
+    """
+    根据 .bots.yaml 中的 conversation_store 配置创建存储
+    :param conf: {"backend": "memory|sqlite|redis", 以及对应后端的参数}
+    :param namespace: key 前缀，一般是 bot 名称
+    :param expiry_time: 会话过期时间，单位秒
+    """
+    conf = dict(conf or {})
+    backend = conf.pop("backend", "memory").lower()
+    store_class = CONVERSATION_STORES.get(backend)
+    if store_class is None:
+        raise ValueError(f"不支持的会话存储类型：{backend}")
+    return store_class(namespace=namespace, expiry_time=expiry_time, **conf)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import threading
+
+from core.cache import Cache
+
+PROCESSING = "processing"
+DONE = "done"
+
+
+class MessageDeduplicator(object):
+    """
+    按钉钉消息 msgId 去重。
+    ack 慢时钉钉会重新投递同一条消息，而且同一 bot 的多个 stream 连接都可能收到，
+    这里在时间窗口内只放行第一次，之后无论第一次是否处理完，重复消息都直接 ack 掉。
+    同一 bot 的所有连接共享一个 handler，因此也共享同一个去重器。
+    """
+
+    def __init__(self, window: float = 600, max_size: int = 100000):
+        self._seen = Cache(expiry_time=window, max_size=max_size)
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.duplicates_processing = 0  # 第一次还在处理中时收到的重复消息
+        self.duplicates_done = 0  # 第一次已处理完后收到的重复消息
+
+    def acquire(self, message_id: str) -> bool:
+        """
+        首次出现返回 True，调用方负责处理；时间窗口内重复出现返回 False。
+        """
+        if not message_id:
+            return True
+        with self._lock:
+            state = self._seen.get(message_id)
+            if state is None:
+                self._seen.set(message_id, PROCESSING)
+                self.accepted += 1
+                return True
+            if state == PROCESSING:
+                self.duplicates_processing += 1
+            else:
+                self.duplicates_done += 1
+            return False
+
+    def complete(self, message_id: str):
+        if not message_id:
+            return
+        with self._lock:
+            if self._seen.get(message_id) is not None:
+                self._seen.set(message_id, DONE)
+
+    def release(self, message_id: str):
+        # 还没开始生成就失败了，允许钉钉重新投递时再处理一次
+        if not message_id:
+            return
+        with self._lock:
+            self._seen.delete(message_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "accepted": self.accepted,
+                "duplicates": self.duplicates_processing + self.duplicates_done,
+                "duplicates_processing": self.duplicates_processing,
+                "duplicates_done": self.duplicates_done,
+            }
@@ -1,36 +1,248 @@
+import asyncio
+import io
+import os
+import threading
+import uuid
+import weakref
+
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from core.sse import aiter_sse_events, iter_sse_events
+from core.upstream import RETRYABLE_STATUS, CircuitBreaker, backoff_delay
+
+
+class MultipartBody(object):
+    """
+    multipart/form-data 请求体，文件部分在发送时按块读取。
+    requests 的 files 参数会先把整个文件读进内存拼成请求体，这里作为 data 传入，配合 Content-Length 流式发送。
+    :param files: {字段名: (文件名, 文件对象, content_type)}，文件对象需要支持 seek
+    """
+
+    def __init__(self, fields: dict, files: dict):
+        self.boundary = uuid.uuid4().hex
+        self._parts = []
+        for name, value in (fields or {}).items():
+            self._parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+        for name, (filename, fileobj, content_type) in files.items():
+            filename = filename.replace("\\", "\\\\").replace('"', '\\"')
+            self._parts.append(
+                (
+                    f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                    f"Content-Type: {content_type or 'application/octet-stream'}\r\n\r\n"
+                ).encode("utf-8")
+            )
+            self._parts.append(fileobj)
+            self._parts.append(b"\r\n")
+        self._parts.append(f"--{self.boundary}--\r\n".encode("utf-8"))
+        self._length = 0
+        for part in self._parts:
+            if isinstance(part, bytes):
+                self._length += len(part)
+            else:
+                start = part.tell()
+                self._length += part.seek(0, os.SEEK_END) - start
+                part.seek(start)
+        self._index = 0
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._length
+        out = io.BytesIO()
+        while out.tell() < size and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, bytes):
+                chunk = part[: size - out.tell()]
+                rest = part[len(chunk) :]
+                if rest:
+                    self._parts[self._index] = rest
+                else:
+                    self._index += 1
+            else:
+                chunk = part.read(size - out.tell())
+                if not chunk:
+                    self._index += 1
+            out.write(chunk)
+        return out.getvalue()
 
 
 class DifyClient:
-    def __init__(self, api_key, base_url: str = "https://api.dify.ai/v1"):
+    # 幂等请求遇到这些状态码时重试
+    RETRY_STATUS = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        api_key,
+        base_url: str = "https://api.dify.ai/v1",
+        pool_size: int = 10,
+        keep_alive: bool = True,
+        connect_timeout: float = 5,
+        read_timeout: float = 120,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        first_byte_timeout: float = 30,
+        stream_retries: int = 2,
+        circuit_breaker: CircuitBreaker = None,
+    ):
+        """
+        :param pool_size: 连接池最大连接数
+        :param keep_alive: 是否复用连接，关闭后每个请求都会新建连接
+        :param connect_timeout: 建立连接超时时间，单位秒
+        :param read_timeout: 读超时时间（两次收到数据的最大间隔，流式响应中即空闲超时），单位秒
+        :param max_retries: 幂等 GET 请求失败时的最大重试次数
+        :param backoff_factor: 重试退避系数，第 n 次重试前等待 0 ~ backoff_factor * 2^(n-1) 秒（随机抖动）
+        :param first_byte_timeout: 连接建立后等待响应头的最长时间，单位秒
+        :param stream_retries: 流式请求在还没有输出任何内容之前失败时的最大重试次数，见 handlers
+        :param circuit_breaker: 上游熔断器，见 core.upstream，为空时使用默认参数
+        """
         self.api_key = api_key
         self.base_url = base_url
+        self.pool_size = int(pool_size)
+        self.keep_alive = bool(keep_alive)
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.first_byte_timeout = float(first_byte_timeout)
+        self.stream_retries = int(stream_retries)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def set_api_key(self, api_key):
+        """热加载配置时替换 api key：每次请求都在发出时读取 self.api_key，替换后新请求立即使用新 key，进行中的请求不受影响"""
+        self.api_key = api_key
 
     def query(self, *args, **kwargs):
         # interface for subclasses to implement the api call entry point
         raise NotImplementedError("Subclasses must implement this method.")
 
+    def _get_session(self) -> requests.Session:
+        # 同一 bot 的所有监听线程共享一个 Session，urllib3 连接池本身是线程安全的
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    retry = Retry(
+                        total=self.max_retries,
+                        backoff_factor=self.backoff_factor,
+                        status_forcelist=self.RETRY_STATUS,
+                        allowed_methods=frozenset(["GET"]),
+                        raise_on_status=False,
+                    )
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    if not self.keep_alive:
+                        session.headers["Connection"] = "close"
+                    self._session = session
+        return self._session
+
+    @staticmethod
+    def iter_events(response):
+        """流式响应的 SSE 事件，见 core.sse"""
+        return iter_sse_events(response)
+
+    def pool_stats(self) -> dict:
+        """
+        连接池统计：new_connections 为新建的连接数，reused_connections 为复用已有连接的请求数。
+        """
+        new_connections = 0
+        requests_cnt = 0
+        if self._session is not None:
+            # http/https 挂载的是同一个 adapter，需要去重
+            for adapter in {id(a): a for a in self._session.adapters.values()}.values():
+                for key in list(adapter.poolmanager.pools.keys()):
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool is None:
+                        continue
+                    new_connections += pool.num_connections
+                    requests_cnt += pool.num_requests
+        return {
+            "requests": requests_cnt,
+            "new_connections": new_connections,
+            "reused_connections": max(0, requests_cnt - new_connections),
+        }
+
+    def _record_status(self, status: int):
+        # 4xx（除 429）说明上游能正常响应，只是请求本身有问题
+        if status in RETRYABLE_STATUS:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
     def _send_request(self, method, endpoint, json=None, params=None, stream=False):
         headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
         url = f"{self.base_url}{endpoint}"
-        response = requests.request(method, url, json=json, params=params, headers=headers, stream=stream)
+        self.circuit_breaker.before_request()
+        try:
+            response = self._get_session().request(
+                method,
+                url,
+                json=json,
+                params=params,
+                headers=headers,
+                stream=stream,
+                # 流式请求只等 first_byte_timeout 秒的响应头，之后的读超时见 _set_idle_timeout
+                timeout=(self.connect_timeout, self.first_byte_timeout if stream else self.read_timeout),
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            self.circuit_breaker.record_failure()
+            raise
+        self._record_status(response.status_code)
+        if stream:
+            self._set_idle_timeout(response)
         return response
 
+    def _set_idle_timeout(self, response: requests.Response):
+        # requests 只能为整个请求设置一个读超时，收到响应头后直接修改 socket 的超时，作为流式读取的空闲超时
+        try:
+            response.raw.connection.sock.settimeout(self.read_timeout)
+        except AttributeError:
+            pass
+
     def _send_request_with_files(self, method, endpoint, data, files):
-        headers = {"Authorization": f"Bearer {self.api_key}"}
+        # 文件按块读取发送，不整个读进内存，见 MultipartBody
+        body = MultipartBody(data, files)
+        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": body.content_type}
         url = f"{self.base_url}{endpoint}"
-        response = requests.request(method, url, data=data, headers=headers, files=files)
+        self.circuit_breaker.before_request()
+        try:
+            response = self._get_session().request(
+                method, url, data=body, headers=headers, timeout=(self.connect_timeout, self.read_timeout)
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            self.circuit_breaker.record_failure()
+            raise
+        self._record_status(response.status_code)
         return response
 
     def message_feedback(self, message_id, rating, user):
         data = {"rating": rating, "user": user}
         return self._send_request("POST", f"/messages/{message_id}/feedbacks", data)
 
+    def stop_generation(self, task_id, user):
+        """停止流式生成，task_id 取自流式返回的事件；各类型应用的接口地址不同"""
+        raise NotImplementedError("Subclasses must implement this method.")
+
     def get_application_parameters(self, user):
         params = {"user": user}
         return self._send_request("GET", "/parameters", params=params)
 
     def file_upload(self, user, files):
+        """
+        上传文件，返回的 id 用于 query 的 files 参数，见 core.attachments
+        :param files: {"file": (文件名, 文件对象, content_type)}
+        """
         data = {"user": user}
         return self._send_request_with_files("POST", "/files/upload", data=data, files=files)
 
@@ -56,6 +268,9 @@ class ChatClient(DifyClient):
         streaming = True if response_mode == "streaming" else False
         return self._send_request("POST", "/chat-messages", data, stream=streaming)
 
+    def stop_generation(self, task_id, user):
+        return self._send_request("POST", f"/chat-messages/{task_id}/stop", {"user": user})
+
     def get_conversation_messages(self, user, conversation_id=None, first_id=None, limit=None):
         params = {"user": user}
         if conversation_id:
@@ -85,6 +300,9 @@ class CompletionClient(DifyClient):
         streaming = True if response_mode == "streaming" else False
         return self._send_request("POST", "/completion-messages", data, stream=streaming)
 
+    def stop_generation(self, task_id, user):
+        return self._send_request("POST", f"/completion-messages/{task_id}/stop", {"user": user})
+
 
 class WorkflowClient(DifyClient):
     def query(self, inputs, query, user, response_mode="blocking", files=None, **kwargs):
@@ -96,6 +314,136 @@ class WorkflowClient(DifyClient):
         streaming = True if response_mode == "streaming" else False
         return self._send_request("POST", "/workflows/run", data, stream=streaming)
 
+    def stop_generation(self, task_id, user):
+        return self._send_request("POST", f"/workflows/tasks/{task_id}/stop", {"user": user})
+
+
+class AsyncDifyClient(DifyClient):
+    """
+    基于 aiohttp 的异步客户端，请求方法与同步客户端一致，只是返回 awaitable。
+    同一个 client 会被同一 bot 的多个 DingTalkStreamClient 线程共享，而每个线程都有自己的事件循环，
+    所以这里按事件循环各自维护一个 ClientSession。
+    """
+
+    def __init__(self, api_key, base_url: str = "https://api.dify.ai/v1", **kwargs):
+        super().__init__(api_key, base_url, **kwargs)
+        self._sessions = weakref.WeakKeyDictionary()
+        self._sessions_lock = threading.Lock()
+        self._stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+        self._stats_lock = threading.Lock()
+
+    def _incr_stat(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    @staticmethod
+    def iter_events(response: aiohttp.ClientResponse):
+        """流式响应的 SSE 事件，用 async for 迭代"""
+        return aiter_sse_events(response)
+
+    def pool_stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self._incr_stat("requests")
+
+        async def on_connection_create_end(session, ctx, params):
+            self._incr_stat("new_connections")
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._incr_stat("reused_connections")
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        connector = aiohttp.TCPConnector(limit=self.pool_size, force_close=not self.keep_alive)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config])
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        with self._sessions_lock:
+            session = self._sessions.get(loop)
+            if session is None or session.closed:
+                session = self._create_session()
+                self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        # 关闭当前事件循环上的 session
+        with self._sessions_lock:
+            session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    async def _send_request(self, method, endpoint, json=None, params=None, stream=False):
+        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+        url = f"{self.base_url}{endpoint}"
+        if params:
+            # aiohttp 不接受值为 None 的 query 参数
+            params = {k: v for k, v in params.items() if v is not None}
+        # 只对幂等的 GET 请求做退避重试
+        retries = self.max_retries if method.upper() == "GET" else 0
+        attempt = 0
+        while True:
+            self.circuit_breaker.before_request()
+            try:
+                # sock_read 在整个响应期间生效（流式响应中即空闲超时），响应头另外限制在 first_byte_timeout 秒内
+                response = await asyncio.wait_for(
+                    self._get_session().request(method, url, json=json, params=params, headers=headers),
+                    self.connect_timeout + self.first_byte_timeout,
+                )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.circuit_breaker.record_failure()
+                if attempt >= retries:
+                    raise
+            else:
+                self._record_status(response.status)
+                if response.status in self.RETRY_STATUS and attempt < retries:
+                    response.release()
+                else:
+                    if not stream:
+                        # 非流式请求直接读完响应体并释放连接
+                        await response.read()
+                    return response
+            attempt += 1
+            await asyncio.sleep(backoff_delay(attempt, self.backoff_factor))
+
+    async def _send_request_with_files(self, method, endpoint, data, files):
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        url = f"{self.base_url}{endpoint}"
+        # 文件名按原样（UTF-8）发送，不做百分号编码
+        form = aiohttp.FormData(quote_fields=False)
+        for k, v in (data or {}).items():
+            form.add_field(k, v)
+        for name, (filename, fileobj, content_type) in files.items():
+            form.add_field(name, fileobj, filename=filename, content_type=content_type)
+        self.circuit_breaker.before_request()
+        try:
+            response = await self._get_session().request(method, url, data=form, headers=headers)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            self.circuit_breaker.record_failure()
+            raise
+        self._record_status(response.status)
+        await response.read()
+        return response
+
+
+class AsyncChatClient(AsyncDifyClient, ChatClient):
+    pass
+
+
+class AsyncCompletionClient(AsyncDifyClient, CompletionClient):
+    pass
+
+
+class AsyncWorkflowClient(AsyncDifyClient, WorkflowClient):
+    pass
+
 
 if __name__ == "__main__":
     client = ChatClient(api_key="app-xxx", base_url="http://192.168.250.64/v1")
@@ -113,13 +461,11 @@ if __name__ == "__main__":
     response = client.query(inputs, query, user, response_mode, files, conversation_id=conversation_id)
 
     # 处理sse流式返回
-    from sseclient import SSEClient
     import json
 
     if response.status_code != 200:
         print(response.text)
         exit(1)
-    sse_client = SSEClient(response)
-    for event in sse_client.events():
+    for event in client.iter_events(response):
         # print(event.data)
-        print(json.loads(event.data))
+        print(json.loads(event.raw))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+钉钉 OpenAPI 的调用额度按应用计算，同一个应用的所有机器人、所有 stream 连接（可能在不同线程、不同事件循环中）共享：
+- 令牌桶限制每秒调用次数，卡片的结束更新优先于中间的流式更新；
+- 遇到限流（429 或 QpsLimit 错误码）时立即降速并暂停，之后在 recovery_time 秒内逐步恢复；
+- access token 按应用缓存，过期前统一刷新，同一时间只有一个请求去获取。
+"""
+
+import asyncio
+import json
+import threading
+import time
+import weakref
+
+import aiohttp
+import requests
+from dingtalk_stream import Credential
+from dingtalk_stream.utils import DINGTALK_OPENAPI_ENDPOINT
+from loguru import logger
+
+_sessions = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    # 每个事件循环复用一个 session，避免每次更新卡片都重新建立连接
+    loop = asyncio.get_running_loop()
+    with _sessions_lock:
+        session = _sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession()
+            _sessions[loop] = session
+    return session
+
+
+async def close_http_session():
+    # 关闭当前事件循环上的 session，事件循环结束前调用
+    with _sessions_lock:
+        session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+class DingTalkAPIError(Exception):
+    pass
+
+
+# 默认的每秒调用次数，略低于钉钉应用默认的 20 次/秒
+DEFAULT_QPS = 18
+
+
+def is_throttled(status: int, text: str = None) -> bool:
+    # 超过调用频率时钉钉返回 403 Forbidden.AccessDenied.QpsLimitForApi / QpsLimitForAppkeyAndApi 等
+    return status == 429 or (status == 403 and "QpsLimit" in (text or ""))
+
+
+class RateLimiter(object):
+    """
+    线程安全的令牌桶，等待时只 sleep 所在的事件循环。
+    urgent 的请求有排队时，普通请求让出令牌；被限流后速率减半并暂停，之后线性恢复到 qps。
+    :param qps: 每秒调用次数上限，0 表示不限制
+    :param burst: 令牌桶容量，即空闲后允许的瞬时调用数，默认为 qps 的 10%；任意一秒内的调用数不超过 qps + burst
+    :param min_qps: 限流后降速的下限
+    :param recovery_time: 从降速后恢复到 qps 所需的秒数
+    """
+
+    def __init__(self, qps: float = DEFAULT_QPS, burst: int = None, min_qps: float = 1, recovery_time: float = 30):
+        self._lock = threading.Lock()
+        self._rate = None
+        self.configure(qps, burst, min_qps, recovery_time)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._urgent_waiting = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.throttled_count = 0
+
+    def configure(self, qps: float = DEFAULT_QPS, burst: int = None, min_qps: float = 1, recovery_time: float = 30):
+        """热加载时修改配置，降速状态保留"""
+        with self._lock:
+            self.qps = max(0.0, float(qps))
+            self.burst = max(1, int(burst or round(self.qps * 0.1)))
+            self.min_qps = max(0.1, min(float(min_qps), self.qps or float(min_qps)))
+            self.recovery_time = max(0.1, float(recovery_time))
+            self._rate = self.qps if self._rate is None else min(self._rate, self.qps)
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self._rate < self.qps:
+            self._rate = min(self.qps, self._rate + elapsed * self.qps / self.recovery_time)
+        self._tokens = min(float(self.burst), self._tokens + elapsed * self._rate)
+
+    def _take(self, urgent: bool) -> float:
+        """拿到令牌时返回 0，否则返回建议等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            if not urgent and self._urgent_waiting:
+                return 1 / self._rate
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self._rate
+
+    async def acquire(self, urgent: bool = False):
+        if not self.qps:
+            return
+        wait = self._take(urgent)
+        if wait:
+            begin = time.monotonic()
+            if urgent:
+                with self._lock:
+                    self._urgent_waiting += 1
+            try:
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self._take(urgent)
+            finally:
+                if urgent:
+                    with self._lock:
+                        self._urgent_waiting -= 1
+            self.waited += 1
+            self.wait_seconds += time.monotonic() - begin
+        self.acquired += 1
+
+    def throttled(self, retry_after: float = None):
+        """收到限流响应：清空令牌、暂停，同一次暂停期间的多个限流响应只降速一次"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.throttled_count += 1
+            if not self.qps or now < self._paused_until:
+                return
+            self._rate = max(self.min_qps, self._rate / 2)
+            self._tokens = 0.0
+            self._paused_until = now + (retry_after if retry_after else 1 / self._rate)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "qps": self.qps,
+                "current_qps": round(self._rate, 2),
+                "tokens": round(self._tokens, 2),
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "throttled": self.throttled_count,
+            }
+
+
+class AccessTokenCache(object):
+    """
+    应用的 access token，所有连接共用；提前 refresh_before 秒刷新，刷新时其他线程等待同一次结果。
+    get/reset 与 SDK 的 DingTalkStreamClient.get_access_token/reset_access_token 兼容，见 core.runtime。
+    """
+
+    def __init__(self, credential: Credential, refresh_before: float = 300):
+        self.credential = credential
+        self.refresh_before = refresh_before
+        self._token = None
+        self._expire_at = 0.0
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.failures = 0
+
+    def _valid_token(self) -> str:
+        return self._token if self._token and time.monotonic() < self._expire_at else None
+
+    def get(self) -> str:
+        """获取失败时返回 None（与 SDK 一致）"""
+        token = self._valid_token()
+        if token:
+            return token
+        with self._lock:
+            token = self._valid_token()
+            if token:
+                return token
+            try:
+                token, expire_in = self._fetch()
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"获取钉钉access token失败：{e}")
+                return None
+            self.fetches += 1
+            self._token, self._expire_at = token, time.monotonic() + max(0, expire_in - self.refresh_before)
+            return token
+
+    async def async_get(self) -> str:
+        return self._valid_token() or await asyncio.to_thread(self.get)
+
+    def reset(self, token: str = None):
+        """token 失效（401）时调用；只作废传入的 token，避免已经刷新过的新 token 被其他请求重复作废"""
+        # 不加锁：刷新中的线程持有锁，这里不必等待
+        if token is None or token == self._token:
+            self._token = None
+
+    def _fetch(self) -> tuple:
+        """https://open.dingtalk.com/document/orgapp/obtain-the-access_token-of-an-internal-app"""
+        response = requests.post(
+            DINGTALK_OPENAPI_ENDPOINT + "/v1.0/oauth2/accessToken",
+            json={"appKey": self.credential.client_id, "appSecret": self.credential.client_secret},
+            timeout=10,
+        )
+        if response.status_code >= 400:
+            raise DingTalkAPIError(f"status={response.status_code}, response.text={response.text}")
+        result = response.json()
+        return result["accessToken"], float(result["expireIn"])
+
+
+class DingTalkApp(object):
+    """
+    一个钉钉应用的 OpenAPI 调用入口，通过 get_dingtalk_app 获取，同一个应用只有一个实例。
+    :param throttle_retries: 必须成功的请求被限流后的重试次数；中间的流式更新不重试，由后续更新覆盖
+    """
+
+    def __init__(self, credential: Credential):
+        self.credential = credential
+        self.tokens = AccessTokenCache(credential)
+        self.limiter = RateLimiter()
+        self.throttle_retries = 3
+
+    def configure(self, throttle_retries: int = 3, share: float = 1, qps: float = DEFAULT_QPS, burst: int = None, **limiter_conf):
+        """
+        :param share: 本进程分到的调用额度比例，多进程模式下同一个应用的调用额度由各 worker 分摊，见 core.workers
+        """
+        self.throttle_retries = max(0, int(throttle_retries))
+        self.limiter.configure(qps=float(qps) * share, burst=max(1, round(burst * share)) if burst else None, **limiter_conf)
+
+    async def request(
+        self, method: str, path: str, body: dict, urgent: bool = False, retry: bool = False, error_class=DingTalkAPIError
+    ) -> dict:
+        """
+        调用 OpenAPI 并返回响应的 json，失败时抛出 error_class
+        :param urgent: 是否优先获取调用额度，卡片的结束更新使用
+        :param retry: 被限流时是否降速后重试，卡片创建、投放、结束更新以及文件下载等没有后续请求可以弥补的使用
+        """
+        url = DINGTALK_OPENAPI_ENDPOINT + path
+        attempts = 1 + (self.throttle_retries if retry else 0)
+        for attempt in range(attempts):
+            await self.limiter.acquire(urgent)
+            access_token = await self.tokens.async_get()
+            if not access_token:
+                raise error_class("cannot get dingtalk access token")
+            headers = {"Content-Type": "application/json", "Accept": "*/*", "x-acs-dingtalk-access-token": access_token}
+            async with get_http_session().request(method, url, headers=headers, json=body) as response:
+                text = await response.text()
+                if response.status < 400:
+                    return json.loads(text) if text else {}
+                if response.status == 401:
+                    self.tokens.reset(access_token)
+                if is_throttled(response.status, text):
+                    retry_after = response.headers.get("Retry-After")
+                    self.limiter.throttled(float(retry_after) if retry_after and retry_after.isdigit() else None)
+                    if attempt + 1 < attempts:
+                        logger.warning(f"钉钉接口限流，降速后重试：url={url}")
+                        continue
+                raise error_class(f"url={url}, status={response.status}, response.text={text}")
+
+    def stats(self) -> dict:
+        return dict(self.limiter.stats(), token_fetches=self.tokens.fetches, token_failures=self.tokens.failures)
+
+
+_apps = {}  # client_id -> DingTalkApp
+_apps_lock = threading.Lock()
+
+
+def get_dingtalk_app(credential: Credential) -> DingTalkApp:
+    """同一个应用（client_id）的所有机器人、连接共享一个 DingTalkApp；secret 变化时重新获取 token"""
+    with _apps_lock:
+        app = _apps.get(credential.client_id)
+        if app is None:
+            app = _apps[credential.client_id] = DingTalkApp(credential)
+        elif app.credential.client_secret != credential.client_secret:
+            app.credential = credential
+            app.tokens = AccessTokenCache(credential)
+        return app
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import concurrent.futures
+import re
+import threading
+from typing import Optional
+
+# 中日韩字符大约一个字一个 token，其余按 4 个字符一个 token 粗略估算
+_CJK_RE = re.compile(r"[　-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class Generation(object):
+    """一个用户正在进行的生成"""
+
+    def __init__(self, key: tuple, task: asyncio.Task, state):
+        self.key = key
+        self.task = task
+        self.loop = task.get_loop()
+        self.state = state  # handlers._StreamState，同步客户端在线程中读取 SSE 时通过 state.cancelled 得知被取消
+        self.reason = None  # 被取消的原因：superseded / stopped
+        # 注销（并释放并发名额）后完成，取代它的新消息等它完成后再申请名额；新消息可能在其他线程的事件循环中
+        self.released = concurrent.futures.Future()
+
+
+class GenerationTracker(object):
+    """
+    按用户记录进行中的生成，用户发来新消息或停止指令时取消之前的生成。
+    同一 bot 的多个 stream 连接可能在不同线程的事件循环中，取消时通过 call_soon_threadsafe 交给生成所在的事件循环。
+    """
+
+    def __init__(self):
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.superseded = 0
+        self.stopped = 0
+        self.tokens_saved = 0
+        self.updates_saved = 0
+        # 正常完成的回答的平均 token 数与卡片更新次数，用于估算取消后省下的量
+        self._avg_tokens = 0.0
+        self._avg_updates = 0.0
+
+    def register(self, key: tuple, task: asyncio.Task, state) -> Generation:
+        generation = Generation(key, task, state)
+        with self._lock:
+            self._generations[key] = generation
+        return generation
+
+    def unregister(self, generation: Generation):
+        with self._lock:
+            if self._generations.get(generation.key) is generation:
+                del self._generations[generation.key]
+        try:
+            generation.released.set_result(True)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    def complete(self, generation: Generation) -> bool:
+        """
+        回答生成完、发送最终卡片之前注销，之后的停止指令和新消息不再取消它；
+        已经被取消（取消还没送达）时返回 False
+        """
+        with self._lock:
+            if self._generations.get(generation.key) is generation:
+                del self._generations[generation.key]
+            return generation.reason is None
+
+    def cancel(self, key: tuple, reason: str) -> bool:
+        """取消 key 对应的进行中的生成，没有时返回 False"""
+        return self.cancel_generation(key, reason) is not None
+
+    def cancel_generation(self, key: tuple, reason: str) -> Optional[Generation]:
+        """同 cancel，返回被取消的生成，没有时返回 None"""
+        with self._lock:
+            generation = self._generations.pop(key, None)
+            if generation is None or generation.task.done():
+                return None
+            generation.reason = reason
+            generation.state.cancelled = True
+        generation.loop.call_soon_threadsafe(generation.task.cancel)
+        return generation
+
+    def record_completed(self, tokens: int, updates: int):
+        with self._lock:
+            self.completed += 1
+            # 指数移动平均，前几次直接取平均
+            weight = max(1.0 / self.completed, 0.05)
+            self._avg_tokens += (tokens - self._avg_tokens) * weight
+            self._avg_updates += (updates - self._avg_updates) * weight
+
+    def record_cancelled(self, reason: str, tokens: int, updates: int) -> dict:
+        """记录一次被取消的生成，返回估算省下的 token 数和卡片更新次数"""
+        with self._lock:
+            if reason == "stopped":
+                self.stopped += 1
+            else:
+                self.superseded += 1
+            saved = {
+                "tokens_saved": max(0, int(self._avg_tokens) - tokens),
+                "updates_saved": max(0, int(round(self._avg_updates)) - updates),
+            }
+            self.tokens_saved += saved["tokens_saved"]
+            self.updates_saved += saved["updates_saved"]
+            return saved
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": len(self._generations),
+                "completed": self.completed,
+                "superseded": self.superseded,
+                "stopped": self.stopped,
+                "estimated_tokens_saved": self.tokens_saved,
+                "estimated_updates_saved": self.updates_saved,
+            }
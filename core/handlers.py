@@ -1,17 +1,73 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # __author__ = 'zfanswer'
-import json
+import asyncio
 import os
 import hashlib
-from typing import Callable
+import time
+from typing import Awaitable, Callable
 
-from dingtalk_stream import AckMessage, ChatbotHandler, CallbackHandler, CallbackMessage, ChatbotMessage, AICardReplier
+import aiohttp
+import requests
+from dingtalk_stream import AckMessage, ChatbotHandler, CallbackHandler, CallbackMessage, ChatbotMessage
 from loguru import logger
-from sseclient import SSEClient
 
-from core.cache import Cache
-from core.dify_client import ChatClient, DifyClient
+from configs import DIFY_CONVERSATION_REMAIN_TIME
+from core.admission import AdmissionController, AdmissionRejected
+from core.answer_cache import AnswerCache
+from core.attachments import AttachmentError, AttachmentUploader, extract_attachments, get_message_text
+from core.card_replier import CardPool, DifyAICardReplier
+from core.card_updater import create_card_updater
+from core.conversation_store import ConversationStore, MemoryConversationStore
+from core.dedup import MessageDeduplicator
+from core.dify_client import AsyncDifyClient, DifyClient
+from core.generations import GenerationTracker, estimate_tokens
+from core.journal import hash_user, journal_enabled, record_request
+from core.log import debug_enabled, redact, redacting, sample_debug
+from core.metrics import NULL_TIMINGS, create_request_timings
+from core.sse import SSEDispatcher, find_event_type, peek_task_id
+from core.upstream import RETRYABLE_STATUS, CircuitOpenError, UpstreamError, backoff_delay
+from core.workers import WorkerContext
+
+QUEUED_CARD_TEXT = "当前提问的人有点多，正在排队中，你排在第{position}位，请稍候~"
+BUSY_CARD_TEXT = "当前提问的人太多啦，请稍后再试~"
+MERGED_CARD_TEXT = "收到，这条消息会和你上一条还在排队的问题一起回答~"
+SUPERSEDED_CARD_TEXT = "\n\n（已停止：收到了你的新消息）"
+STOPPED_CARD_TEXT = "\n\n（已停止生成）"
+STOP_REPLY_TEXT = "已停止生成"
+NOTHING_TO_STOP_TEXT = "当前没有正在生成的回答~"
+UPSTREAM_BUSY_CARD_TEXT = "模型服务暂时不可用，请稍后再试~"
+UNSUPPORTED_TEXT = "对不起，我目前只看得懂文字喔~"
+UNSUPPORTED_WITH_ATTACHMENTS_TEXT = "对不起，我目前只看得懂文字、图片和文件喔~"
+ATTACHMENT_FAILED_CARD_TEXT = "附件处理失败：{error}"
+# 只发了图片/文件没有文字时的提问
+ATTACHMENT_ONLY_QUERY = "请查看附件"
+# 新消息取代之前的生成时，最多等待多少秒让它释放并发名额
+SUPERSEDE_RELEASE_TIMEOUT = 5
+
+# Dify 事件类型 -> DifyAiCardBotHandler 上的处理方法
+STREAM_EVENT_HANDLERS = {
+    "message": "_on_message",
+    "agent_message": "_on_message",
+    "text_chunk": "_on_text_chunk",
+    "agent_log": "_on_agent_log",
+    "node_finished": "_on_node_finished",
+    "message_end": "_on_message_end",
+}
+# 不需要处理的事件，不做 JSON 解析直接跳过，其中 node_started、agent_thought 等可能带有很大的输入输出
+IGNORED_STREAM_EVENTS = frozenset(
+    [
+        "ping",
+        "agent_thought",
+        "message_file",  # 生成文件：可在此扩展卡片附件渲染
+        "workflow_started",
+        "workflow_finished",  # 在主循环结束后会发送 finished=True；这里无需处理
+        "node_started",
+        "parallel_branch_started",
+        "parallel_branch_message",
+        "parallel_branch_finished",
+    ]
+)
 
 
 class HandlerFactory(object):
@@ -26,217 +82,612 @@ class HandlerFactory(object):
 
 class DifyAiCardBotHandler(ChatbotHandler):
 
-    def __init__(self, dify_api_client: DifyClient):
+    def __init__(
+        self,
+        dify_api_client: DifyClient,
+        card_update_conf: dict = None,
+        conversation_store: ConversationStore = None,
+        deduplicator: MessageDeduplicator = None,
+        admission_controller: AdmissionController = None,
+        bot_name: str = "",
+        answer_cache: AnswerCache = None,
+        card_conf: dict = None,
+        attachment_uploader: AttachmentUploader = None,
+        router: WorkerContext = None,
+    ):
         super().__init__()
+        self.bot_name = bot_name
         self.dify_api_client = dify_api_client
-        self.cache = Cache(expiry_time=60 * int(os.getenv("DIFY_CONVERSATION_REMAIN_TIME")))  # 每个用户维持会话时间xx秒
+        # 卡片更新策略，见 core.card_updater.create_card_updater
+        self.card_update_conf = card_update_conf or {}
+        # 用户 -> conversation_id，默认只保存在进程内存中，见 core.conversation_store
+        self.cache = conversation_store or MemoryConversationStore(
+            expiry_time=60 * DIFY_CONVERSATION_REMAIN_TIME,  # 每个用户维持会话时间xx秒
+            max_size=int(os.getenv("DIFY_CONVERSATION_CACHE_SIZE", "10000")),  # 最多保留多少个用户的会话
+            sweep_interval=60,  # 每分钟后台清理一次过期会话
+        )
+        # 钉钉重复投递的消息去重，见 core.dedup
+        self.deduplicator = deduplicator or MessageDeduplicator(window=int(os.getenv("MESSAGE_DEDUP_WINDOW", "600")))
+        # 并发准入控制，所有 bot 共享，见 core.admission；为空时不做限制
+        self.admission_controller = admission_controller
+        # 回答缓存，只用于无状态的 completion/workflow 应用，见 core.answer_cache；为空时不缓存
+        self.answer_cache = answer_cache
+        # AI卡片配置在启动时确定，模版id默认使用环境变量 https://open-dev.dingtalk.com/fe/card
+        card_conf = card_conf or {}
+        self.card_template_id = card_conf.get("template_id") or os.getenv("DINGTALK_AI_CARD_TEMPLATE_ID")
+        self.card_content_key = card_conf.get("content_key", "content")
+        # 预创建的卡片池，为空时每条消息都先创建再投放
+        self.card_pool = None
+        if card_conf.get("pool_size"):
+            self.card_pool = CardPool(
+                self.card_template_id,
+                {self.card_content_key: ""},
+                size=card_conf["pool_size"],
+                max_age=card_conf.get("pool_max_age", 1800),
+            )
+        # 图片、文件消息下载后上传到 Dify，见 core.attachments；为空时只处理文字消息
+        self.attachment_uploader = attachment_uploader
+        # 多进程模式下按发送人把消息转交给固定的 worker 处理，见 core.workers；为空时都在本进程处理
+        self.router = router
+        # 每个用户进行中的生成，新消息或停止指令会取消之前的生成，见 core.generations
+        self.generations = GenerationTracker()
+        self.supersede = os.getenv("SUPERSEDE_GENERATION", "true").lower() == "true"
+        self.stop_keywords = frozenset(k.strip().lower() for k in os.getenv("STOP_KEYWORDS", "停止,stop").split(",") if k.strip())
+        # 已经 ack 但还在更新卡片的消息，热加载替换 handler 或停止连接时等待它们结束，见 core.runtime
+        self._inflight = set()
+        # SSE 事件按类型分发，见 core.sse
+        self._stream_dispatcher = SSEDispatcher(
+            {evt: getattr(self, name) for evt, name in STREAM_EVENT_HANDLERS.items()}, ignored=IGNORED_STREAM_EVENTS
+        )
+
+    def inflight(self, loop: asyncio.AbstractEventLoop = None) -> int:
+        """进行中的消息数，loop 不为空时只统计该事件循环上的"""
+        tasks = list(self._inflight)
+        if loop is None:
+            return len(tasks)
+        return sum(1 for task in tasks if task.get_loop() is loop)
 
     async def process(self, callback_msg: CallbackMessage):
-        logger.debug(callback_msg)
+        if debug_enabled():
+            logger.debug("收到钉钉回调：{}", callback_msg.headers.message_id if redacting() else callback_msg)
+        if self.router is not None and self.router.route(self.bot_name, callback_msg):
+            return AckMessage.STATUS_OK, "OK"
         incoming_message = ChatbotMessage.from_dict(callback_msg.data)
 
-        logger.info(f"收到用户消息：{incoming_message}")
+        # 同一条消息（msgId 相同）只处理一次，重复投递的直接 ack
+        message_id = incoming_message.message_id
+        if not self.deduplicator.acquire(message_id):
+            logger.info(f"忽略重复投递的消息：{message_id}, 去重统计：{self.deduplicator.stats()}")
+            return AckMessage.STATUS_OK, "OK"
+        # 耗时统计，未开启指标和请求日志时是空操作，见 core.metrics
+        timings = create_request_timings(self.bot_name, message_id, record=journal_enabled())
+        try:
+            return await self._process_message(incoming_message, timings)
+        except Exception:
+            # 还没开始生成就失败了，允许重新投递时再处理
+            self.deduplicator.release(message_id)
+            raise
+
+    async def _process_message(self, incoming_message: ChatbotMessage, timings=NULL_TIMINGS):
+        logger.info("收到用户消息：{}", _loggable_message(incoming_message))
 
-        if incoming_message.message_type != "text":
-            self.reply_text("对不起，我目前只看得懂文字喔~", incoming_message)
+        query_text = get_message_text(incoming_message)
+        attachments = extract_attachments(incoming_message) if self.attachment_uploader is not None else []
+        if incoming_message.message_type != "text" and not (query_text or attachments):
+            reply = UNSUPPORTED_TEXT if self.attachment_uploader is None else UNSUPPORTED_WITH_ATTACHMENTS_TEXT
+            await asyncio.to_thread(self.reply_text, reply, incoming_message)
+            self.deduplicator.complete(incoming_message.message_id)
+            timings.mark("ack")
+            self._journal_request(timings.finish("unsupported"), incoming_message, query_text)
             return AckMessage.STATUS_OK, "OK"
 
-        # 在企业开发者后台配置的卡片模版id https://open-dev.dingtalk.com/fe/card
-        card_template_id = os.getenv("DINGTALK_AI_CARD_TEMPLATE_ID")
-        content_key = "content"
-        card_data = {content_key: ""}
-        card_instance = AICardReplier(self.dingtalk_client, incoming_message)
-        # 先投放卡片
-        card_instance_id = card_instance.create_and_send_card(card_template_id, card_data, callback_type="STREAM")
+        generation_key = (incoming_message.conversation_id, incoming_message.sender_staff_id)
+        if not attachments and query_text.strip().lower() in self.stop_keywords:
+            # 停止指令：取消该用户进行中的生成，不调用 Dify
+            stopped = self.generations.cancel(generation_key, "stopped")
+            await asyncio.to_thread(self.reply_text, STOP_REPLY_TEXT if stopped else NOTHING_TO_STOP_TEXT, incoming_message)
+            self.deduplicator.complete(incoming_message.message_id)
+            timings.mark("ack")
+            self._journal_request(timings.finish("stop"), incoming_message, query_text)
+            return AckMessage.STATUS_OK, "OK"
+        superseded = self.generations.cancel_generation(generation_key, "superseded") if self.supersede else None
+        if superseded is not None:
+            logger.info(f"用户发来新消息，取消之前的生成：{generation_key}")
+
+        card_instance = DifyAICardReplier(self.dingtalk_client, incoming_message)
+
+        async def open_card() -> str:
+            # 创建（或从卡片池中取出）并投放卡片，与调用 Dify 同时进行
+            timings.mark("card_create_start")
+            card_instance_id = self.card_pool.acquire(self.dingtalk_client) if self.card_pool is not None else None
+            if card_instance_id is None:
+                card_instance_id = await card_instance.async_create_card(self.card_template_id, {self.card_content_key: ""})
+            await card_instance.async_deliver_card(card_instance_id)
+            timings.mark("card_created")
+            return card_instance_id
+
+        async def send_card(content_value: str, append: bool, finished: bool, failed: bool):
+            # 卡片投放完成前的输出积压在 card_updater 中，投放后合并发送
+            card_instance_id = await card_task
+            timings.card_update(len(content_value.encode("utf-8")))
+            await card_instance.async_streaming(
+                card_instance_id,
+                content_key=self.card_content_key,
+                content_value=content_value,
+                append=append,  # 由 card_updater 决定全量覆盖还是增量追加
+                finished=finished,
+                failed=failed,
+            )
 
         # 快速返回 ack，避免钉钉超时重试
         # 钉钉允许在返回 ack 后继续更新卡片
-        import asyncio
-
         async def update_card():
+            card_updater = create_card_updater(send_card, **self.card_update_conf).start()
+            ticket = generation = None
+            status = "ok"
+            cache_key = flight = None
+            state = _StreamState()
             try:
-                full_content_value = self._call_dify_with_stream(
-                    incoming_message,
-                    lambda content_value: card_instance.streaming(
-                        card_instance_id,
-                        content_key=content_key,
-                        content_value=content_value,
-                        append=False,   # 用全量覆盖的方式递增刷新；若想逐条追加可改 True
-                        finished=False,
-                        failed=False,
-                    ),
+                if self.answer_cache is not None and files_task is None:
+                    # 命中缓存或等到了同一问题进行中请求的结果时直接回放，不占用并发名额；带附件的消息不缓存
+                    cache_key = self.answer_cache.make_key(self.bot_name, query_text, self._build_inputs(incoming_message))
+                    cached_answer, flight = await self.answer_cache.lookup(cache_key)
+                    if cached_answer is not None:
+                        status = "cached"
+                        timings.first_token()
+                        await self.answer_cache.replay(cached_answer, card_updater.update)
+                        timings.answer_chars = len(cached_answer)
+                        await card_updater.finish(cached_answer)
+                        return
+                if self.dify_api_client.circuit_breaker.is_open():
+                    # 上游熔断中：不排队、不调用 Dify，直接回复繁忙
+                    raise CircuitOpenError()
+                if superseded is not None:
+                    # 等被取代的生成释放并发名额后再申请，新消息不会排在它后面
+                    try:
+                        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(superseded.released)), SUPERSEDE_RELEASE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        logger.warning(f"等待被取代的生成释放超时：{generation_key}")
+                if self.admission_controller is not None:
+                    # 并发控制：超出并发时排队并在卡片上显示排队位置，队列满时直接拒绝
+                    try:
+                        ticket = await self.admission_controller.acquire(
+                            self.bot_name,
+                            incoming_message.sender_staff_id,
+                            query=query_text,
+                            on_queued=lambda position: card_updater.update(QUEUED_CARD_TEXT.format(position=position)),
+                        )
+                    except AdmissionRejected as e:
+                        logger.warning(f"请求被拒绝：{e}, 准入统计：{self.admission_controller.stats()}")
+                        status = "rejected"
+                        await card_updater.finish(BUSY_CARD_TEXT)
+                        return
+                    if ticket.merged_into is not None:
+                        status = "merged"
+                        await card_updater.finish(MERGED_CARD_TEXT)
+                        return
+                extra_queries = ticket.extra_queries if ticket is not None else None
+                # 排队中的消息不登记，同一用户排队期间的新消息仍然按准入控制合并
+                generation = self.generations.register(generation_key, asyncio.current_task(), state)
+                # 附件在收到消息时就开始上传，与投放卡片、排队同时进行
+                files = await files_task if files_task is not None else None
+                if isinstance(self.dify_api_client, AsyncDifyClient):
+                    # 异步客户端：读取 SSE 与更新卡片都不会阻塞事件循环
+                    full_content_value = await self._async_call_dify_with_stream(
+                        incoming_message, card_updater.update, extra_queries=extra_queries, timings=timings, state=state, files=files
+                    )
+                else:
+                    # 同步客户端：放到线程池里执行，避免阻塞事件循环；卡片更新仍交回事件循环处理
+                    loop = asyncio.get_running_loop()
+                    full_content_value = await asyncio.to_thread(
+                        self._call_dify_with_stream,
+                        incoming_message,
+                        lambda content_value: asyncio.run_coroutine_threadsafe(card_updater.update(content_value), loop).result(),
+                        extra_queries=extra_queries,
+                        timings=timings,
+                        state=state,
+                        files=files,
+                    )
+                timings.answer_chars = len(full_content_value)
+                self.generations.record_completed(estimate_tokens(full_content_value), card_updater.updates_sent)
+                if flight is not None:
+                    # 合并了其他消息的回答和原问题对不上，不缓存
+                    self.answer_cache.complete(cache_key, flight, None if extra_queries else full_content_value)
+                # 回答已经生成完，发送最终卡片期间的停止指令、新消息不再取消它
+                if not self.generations.complete(generation):
+                    # 取消已经发出还没送达，等它送达后按取消处理
+                    await asyncio.get_running_loop().create_future()
+                generation = None
+                await card_updater.finish(full_content_value)
+            except asyncio.CancelledError:
+                if generation is None or generation.reason is None:
+                    # 卡片投放失败等其他原因的取消
+                    raise
+                status = generation.reason
+                timings.answer_chars = len(state.full_content)
+                # 先释放并发名额，取代它的新消息不用等停止生成和结束旧卡片
+                if ticket is not None:
+                    self.admission_controller.release(ticket)
+                    ticket = None
+                self.generations.unregister(generation)
+                note = STOPPED_CARD_TEXT if generation.reason == "stopped" else SUPERSEDED_CARD_TEXT
+                # 通知 Dify 停止生成的同时结束旧卡片
+                await asyncio.gather(
+                    self._stop_dify_generation(state.task_id, incoming_message.sender_nick),
+                    card_updater.finish(state.full_content + note),
                 )
-                card_instance.streaming(
-                    card_instance_id,
-                    content_key=content_key,
-                    content_value=full_content_value,
-                    append=False,
-                    finished=True,
-                    failed=False,
+                saved = self.generations.record_cancelled(
+                    generation.reason, estimate_tokens(state.full_content), card_updater.updates_sent
                 )
+                logger.info(
+                    {"generation_cancelled": generation.reason, "task_id": state.task_id, **saved, "generations": self.generations.stats()}
+                )
+            except CircuitOpenError as e:
+                logger.warning(f"{e}, 熔断统计：{self.dify_api_client.circuit_breaker.stats()}")
+                status = "circuit_open"
+                await card_updater.finish(UPSTREAM_BUSY_CARD_TEXT)
+            except AttachmentError as e:
+                logger.warning(f"{e}, 附件统计：{self.attachment_uploader.stats()}")
+                status = "attachment_failed"
+                await card_updater.finish(ATTACHMENT_FAILED_CARD_TEXT.format(error=e), failed=True)
             except Exception as e:
                 logger.exception(e)
-                card_instance.streaming(
-                    card_instance_id,
-                    content_key=content_key,
-                    content_value=f"出现了异常: {e}",
-                    append=False,
-                    finished=False,
-                    failed=True,
-                )
+                status = "error"
+                await card_updater.finish(f"出现了异常: {e}", failed=True)
+            finally:
+                if card_task.done() and not card_task.cancelled() and card_task.exception() is not None:
+                    status = "card_failed"
+                    logger.error(f"投放卡片失败：{card_task.exception()}")
+                card_updater.close()
+                if files_task is not None:
+                    # 排队被拒绝等没有用到附件的情况，停止上传并取走异常
+                    files_task.cancel()
+                    files_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                if generation is not None:
+                    self.generations.unregister(generation)
+                if flight is not None:
+                    # 没有拿到回答时让等待同一问题的请求自己生成
+                    self.answer_cache.complete(cache_key, flight, None)
+                if ticket is not None:
+                    self.admission_controller.release(ticket)
+                self.deduplicator.complete(incoming_message.message_id)
+                self._journal_request(timings.finish(status), incoming_message, query_text, state, len(attachments))
+            logger.info({"card_update_stats": card_updater.stats()})
 
-        # 启动异步任务更新卡片
-        asyncio.create_task(update_card())
+        # 投放卡片、上传附件与调用 Dify 同时进行，卡片投放失败时没有必要继续生成，直接取消
+        files_task = None
+        if attachments:
+            files_task = asyncio.create_task(
+                self.attachment_uploader.upload(self.dingtalk_client, self.dify_api_client, attachments, incoming_message.sender_nick)
+            )
+        card_task = asyncio.create_task(open_card())
+        update_task = asyncio.create_task(update_card())
+        self._inflight.add(update_task)
+        update_task.add_done_callback(self._inflight.discard)
+        card_task.add_done_callback(lambda t: t.cancelled() or t.exception() is None or update_task.cancel())
 
         # 立即返回 ack
+        timings.mark("ack")
         return AckMessage.STATUS_OK, "OK"
 
-    def _call_dify_with_stream(self, incoming_message: ChatbotMessage, callback: Callable[[str], None]):
-        """
-        核心增强点：
-        - 继续支持 message / text_chunk 的增量；
-        - 新增 agent_log( Final Answer ) 与 node_finished(agent) 的增量切片流式；
-        - 通过 MD5 去重避免多次推送同样的 Final Answer。
-        """
-        def _split_chunks(s: str, size: int = 140):
-            s = s or ""
-            size = max(40, int(size or 140))
-            return [s[i:i + size] for i in range(0, len(s), size)]
+    @staticmethod
+    def _journal_request(timings_record: dict, incoming_message: ChatbotMessage, query_text: str, state=None, attachments: int = 0):
+        """请求日志（见 core.journal），在耗时统计结束后记录，未开启时 timings_record 为空或直接返回"""
+        if timings_record is None or not journal_enabled():
+            return
+        timings_record.pop("card_bytes", None)
+        timings_record.pop("chars_per_second", None)
+        record_request(
+            dict(
+                timings_record,
+                ts=round(time.time() - timings_record["timings"]["finished"], 3),
+                user=hash_user(incoming_message.sender_staff_id),
+                conversation_type=incoming_message.conversation_type,
+                msgtype=incoming_message.message_type,
+                query=query_text,
+                query_chars=len(query_text),
+                attachments=attachments,
+                events=state.events if state is not None else None,
+            )
+        )
 
-        chunk_size = int(os.getenv("DIFY_STREAM_CHUNK_SIZE", "140"))
+    @staticmethod
+    def _build_inputs(incoming_message: ChatbotMessage) -> dict:
+        return {"sys_user_id": incoming_message.sender_staff_id}
 
-        if incoming_message.message_type != "text":
-            request_content = ""
-        else:
-            request_content = incoming_message.text.content
+    def _build_dify_request(self, incoming_message: ChatbotMessage, conversation_id: str, extra_queries: list = None, files: list = None):
+        request_content = get_message_text(incoming_message)
+        if files and not request_content.strip():
+            request_content = ATTACHMENT_ONLY_QUERY
+        if extra_queries:
+            # 排队期间同一用户追加的消息合并到一起提问
+            request_content = "\n".join([request_content] + extra_queries)
 
-        conversation_id = self.cache.get(incoming_message.sender_staff_id)
-        response = self.dify_api_client.query(
-            inputs={"sys_user_id": incoming_message.sender_staff_id},
+        request_kwargs = dict(
+            inputs=self._build_inputs(incoming_message),
             query=request_content,
             user=incoming_message.sender_nick,
             response_mode="streaming",
-            files=None,
+            files=files or None,
             conversation_id=conversation_id,  # 需要考虑下怎么让一个用户的回话保持自己的上下文
         )
+        return request_content, request_kwargs
+
+    def _call_dify_with_stream(
+        self,
+        incoming_message: ChatbotMessage,
+        callback: Callable[[str], None],
+        extra_queries: list = None,
+        timings=NULL_TIMINGS,
+        state: "_StreamState" = None,
+        files: list = None,
+    ):
+        """
+        同步客户端的流式调用，事件处理逻辑见 _handle_stream_event。
+        还没有向卡片输出任何内容之前失败时，按 stream_retries 退避重试，见 _should_retry。
+        """
+        conversation_id = self.cache.get(incoming_message.sender_staff_id)
+        request_content, request_kwargs = self._build_dify_request(incoming_message, conversation_id, extra_queries, files)
+        state = state or _StreamState()
+        attempt = 0
+        while True:
+            try:
+                self._stream_once(request_kwargs, incoming_message, callback, timings, state)
+                break
+            except UpstreamError as e:
+                attempt += 1
+                if not self._should_retry(e, state, attempt):
+                    raise
+                logger.warning(f"调用模型服务失败，第{attempt}次重试：{e}")
+                state.reset()
+                time.sleep(backoff_delay(attempt, self.dify_api_client.backoff_factor))
+
+        self._log_stream_result(request_content, state.full_content)
+        return state.full_content
+
+    def _stream_once(self, request_kwargs: dict, incoming_message: ChatbotMessage, callback, timings, state: "_StreamState"):
+        timings.mark("dify_request")
+        try:
+            response = self.dify_api_client.query(**request_kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise UpstreamError(f"连接模型服务失败：{e}", retryable=True) from e
+        timings.mark("dify_response")
         if response.status_code != 200:
-            raise Exception(f"调用模型服务失败，返回码：{response.status_code}，返回内容：{response.text}")
+            raise UpstreamError(
+                f"调用模型服务失败，返回码：{response.status_code}，返回内容：{response.text}",
+                status=response.status_code,
+                retryable=response.status_code in RETRYABLE_STATUS,
+            )
 
-        sse_client = SSEClient(response)
-        full_content = ""     # 我们对卡片采取“全量覆盖”的逐步刷新策略
-        length = 0            # 发流频控（按累计长度差 > 10 再发）
-        streamed_final = False
-        final_hash = None     # 避免 agent_log 与 node_finished(agent) 重复推送
+        try:
+            for event in self.dify_api_client.iter_events(response):
+                if state.cancelled:
+                    # 生成已被取消（事件循环那边不再等待结果），关闭连接不再读取后续事件
+                    response.close()
+                    break
+                timings.mark("dify_first_event")
+                for content in self._handle_stream_event(event.raw, state, incoming_message):
+                    state.pushed = True
+                    timings.first_token()
+                    callback(content)
+        except requests.RequestException as e:
+            # 读取中断或空闲超时
+            self.dify_api_client.circuit_breaker.record_failure()
+            raise UpstreamError(f"读取模型服务输出中断：{e}", retryable=True) from e
 
-        for event in sse_client.events():
-            # 兼容非 JSON 片段（比如心跳、DONE）
+    async def _async_call_dify_with_stream(
+        self,
+        incoming_message: ChatbotMessage,
+        callback: Callable[[str], Awaitable],
+        extra_queries: list = None,
+        timings=NULL_TIMINGS,
+        state: "_StreamState" = None,
+        files: list = None,
+    ):
+        """
+        异步客户端的流式调用，与 _call_dify_with_stream 共用事件处理逻辑和重试策略。
+        """
+        # sqlite/redis 会话存储的读取不阻塞事件循环
+        conversation_id = await self.cache.async_get(incoming_message.sender_staff_id)
+        request_content, request_kwargs = self._build_dify_request(incoming_message, conversation_id, extra_queries, files)
+        state = state or _StreamState()
+        attempt = 0
+        while True:
             try:
-                r = json.loads(event.data)
-            except Exception:
-                logger.debug(f"收到无法解析的事件：{event.data}")
-                continue
-
-            logger.debug(f"接收到模型服务返回：{r}")
-            evt = r.get("event")
-
-            # --- 常规 message / agent_message（对话/Agent文本） ---
-            if evt in ["message", "agent_message"]:
-                # Dify: {"event": "message", "answer": "..."}
-                delta = r.get("answer", "")
-                if delta:
-                    full_content += delta
-                    full_content_length = len(full_content)
-                    if full_content_length - length > 10:
-                        callback(full_content)
-                        logger.debug(
-                            f'调用流式接口更新内容：message/agent_message, current_length={length}, next_length={full_content_length}'
-                        )
-                        length = full_content_length
-                continue
-
-            # --- 完成式模型 text_chunk（逐块 token） ---
-            if evt in ["text_chunk"]:
-                # Dify: {"event": "text_chunk", "data": {"text": "..."}}
-                delta = (r.get("data") or {}).get("text", "")
-                if delta:
-                    full_content += delta
-                    full_content_length = len(full_content)
-                    if full_content_length - length > 10:
-                        callback(full_content)
-                        logger.debug(
-                            f'调用流式接口更新内容：text_chunk, current_length={length}, next_length={full_content_length}'
-                        )
-                        length = full_content_length
-                continue
-
-            # --- 新增：Agent 推理日志（抓 Final Answer）---
-            if evt == "agent_log":
-                d = r.get("data") or {}
-                status = d.get("status")
-                dd = d.get("data") or {}
-                action = dd.get("action") or dd.get("action_name")
-                # 只在成功时抓 Final Answer
-                if status == "success" and action == "Final Answer":
-                    text = dd.get("action_input") or ""
-                    if text:
-                        h = hashlib.md5(text.encode("utf-8")).hexdigest()
-                        if h != final_hash:
-                            for ch in _split_chunks(text, size=chunk_size):
-                                full_content += ch
-                                callback(full_content)
-                            streamed_final = True
-                            final_hash = h
-                            logger.debug("已按 agent_log.Final Answer 推送流式文本")
-                continue
-
-            # --- 新增：节点结束（兜底 Agent 输出）---
-            if evt == "node_finished":
-                data = r.get("data") or {}
-                node_type = data.get("node_type")
-                outputs = data.get("outputs") or {}
-                # 有些策略把最终话术放这里
-                if node_type == "agent":
-                    text = outputs.get("text")
-                    if text:
-                        h = hashlib.md5(text.encode("utf-8")).hexdigest()
-                        if h != final_hash:
-                            for ch in _split_chunks(text, size=chunk_size):
-                                full_content += ch
-                                callback(full_content)
-                            streamed_final = True
-                            final_hash = h
-                            logger.debug("已按 node_finished(agent).outputs.text 推送流式文本")
-                # 其他节点忽略
-                continue
-
-            # --- Agent 思考/工具/文件事件：只记录日志 ---
-            if evt in ["agent_thought", "message_file", "workflow_started", "workflow_finished",
-                       "node_started", "parallel_branch_started", "parallel_branch_message",
-                       "parallel_branch_finished"]:
-                if evt == "message_file":
-                    # 生成文件：可在此扩展卡片附件渲染
-                    pass
-                elif evt == "workflow_finished":
-                    # 在主循环结束后会发送 finished=True；这里无需处理
-                    pass
-                else:
-                    logger.debug(f"Ignoring event: {evt}")
-                continue
+                await self._async_stream_once(request_kwargs, incoming_message, callback, timings, state)
+                break
+            except UpstreamError as e:
+                attempt += 1
+                if not self._should_retry(e, state, attempt):
+                    raise
+                logger.warning(f"调用模型服务失败，第{attempt}次重试：{e}")
+                state.reset()
+                await asyncio.sleep(backoff_delay(attempt, self.dify_api_client.backoff_factor))
 
-            # --- 对话结束：记录会话ID，便于上下文保持 ---
-            if evt == "message_end":
-                # Dify: {'event':'message_end', 'conversation_id':'...', 'metadata':{...}}
-                self.cache.set(incoming_message.sender_staff_id, r.get("conversation_id"))
-                continue
+        self._log_stream_result(request_content, state.full_content)
+        return state.full_content
 
-            # 其它未知事件
-            logger.debug(f"未知事件（忽略）：{evt}")
+    async def _async_stream_once(self, request_kwargs: dict, incoming_message: ChatbotMessage, callback, timings, state: "_StreamState"):
+        timings.mark("dify_request")
+        try:
+            response = await self.dify_api_client.query(**request_kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            raise UpstreamError(f"连接模型服务失败：{e!r}", retryable=True) from e
+        timings.mark("dify_response")
+        async with response:
+            if response.status != 200:
+                raise UpstreamError(
+                    f"调用模型服务失败，返回码：{response.status}，返回内容：{await response.text()}",
+                    status=response.status,
+                    retryable=response.status in RETRYABLE_STATUS,
+                )
+
+            try:
+                async for event in self.dify_api_client.iter_events(response):
+                    timings.mark("dify_first_event")
+                    for content in self._handle_stream_event(event.raw, state, incoming_message):
+                        state.pushed = True
+                        timings.first_token()
+                        await callback(content)
+            except asyncio.CancelledError:
+                # 被取消时直接关闭连接，不把读了一半的连接放回连接池
+                response.close()
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 读取中断或空闲超时（sock_read）
+                response.close()
+                self.dify_api_client.circuit_breaker.record_failure()
+                raise UpstreamError(f"读取模型服务输出中断：{e!r}", retryable=True) from e
 
+    def _should_retry(self, error: UpstreamError, state: "_StreamState", attempt: int) -> bool:
+        # 已经向卡片输出过内容的不重试，否则用户会看到重复或错乱的回答；熔断中的也不重试
+        return (
+            error.retryable
+            and not isinstance(error, CircuitOpenError)
+            and attempt <= self.dify_api_client.stream_retries
+            and not state.pushed
+            and not state.cancelled
+        )
+
+    @staticmethod
+    def _log_stream_result(request_content: str, full_content: str):
         logger.info(
             {
-                "request_content": request_content,
-                "full_response": full_content,
+                "request_content": redact(request_content),
+                "full_response": redact(full_content),
                 "full_response_length": len(full_content),
             }
         )
-        return full_content
+
+    def _handle_stream_event(self, event_data, state: "_StreamState", incoming_message: ChatbotMessage) -> list:
+        """
+        处理单个 SSE 事件（str 或原始 bytes），返回需要推送到卡片的全量内容列表（可能为空）。
+        核心增强点：
+        - 继续支持 message / text_chunk 的增量；
+        - 新增 agent_log( Final Answer ) 与 node_finished(agent) 的增量切片流式；
+        - 通过 MD5 去重避免多次推送同样的 Final Answer；
+        - 按事件类型分发，忽略的事件不做 JSON 解析，见 STREAM_EVENT_HANDLERS / IGNORED_STREAM_EVENTS。
+        """
+        if state.task_id is None:
+            state.task_id = peek_task_id(event_data)
+        if state.events is not None:
+            evt = find_event_type(event_data) or "other"
+            state.events[evt] = state.events.get(evt, 0) + 1
+        return self._stream_dispatcher.dispatch(event_data, state, incoming_message) or []
+
+    async def _stop_dify_generation(self, task_id: str, user: str):
+        """调用 Dify 的停止生成接口，失败只记录日志"""
+        if not task_id:
+            return
+        try:
+            if isinstance(self.dify_api_client, AsyncDifyClient):
+                await self.dify_api_client.stop_generation(task_id, user)
+            else:
+                await asyncio.to_thread(self.dify_api_client.stop_generation, task_id, user)
+        except Exception as e:
+            logger.warning(f"停止 Dify 生成失败：task_id={task_id}, {e}")
+
+    @staticmethod
+    def _append_delta(delta: str, state: "_StreamState", evt: str) -> list:
+        updates = []
+        if delta:
+            state.full_content += delta
+            full_content_length = len(state.full_content)
+            # 发流频控（按累计长度差 > 10 再发）
+            if full_content_length - state.length > 10:
+                updates.append(state.full_content)
+                if sample_debug():
+                    logger.debug("调用流式接口更新内容：{}, current_length={}, next_length={}", evt, state.length, full_content_length)
+                state.length = full_content_length
+        return updates
+
+    @staticmethod
+    def _append_final(text: str, state: "_StreamState") -> list:
+        # agent_log 与 node_finished(agent) 可能给出同一个最终回答，按 MD5 去重后切片推送
+        updates = []
+        h = hashlib.md5(text.encode("utf-8")).hexdigest()
+        if h != state.final_hash:
+            chunk_size = max(40, int(os.getenv("DIFY_STREAM_CHUNK_SIZE", "140") or 140))
+            for i in range(0, len(text), chunk_size):
+                state.full_content += text[i : i + chunk_size]
+                updates.append(state.full_content)
+            state.streamed_final = True
+            state.final_hash = h
+        return updates
+
+    def _on_message(self, r: dict, state: "_StreamState", incoming_message: ChatbotMessage) -> list:
+        # --- 常规 message / agent_message（对话/Agent文本） ---
+        # Dify: {"event": "message", "answer": "..."}
+        return self._append_delta(r.get("answer", ""), state, r.get("event"))
+
+    def _on_text_chunk(self, r: dict, state: "_StreamState", incoming_message: ChatbotMessage) -> list:
+        # --- 完成式模型 text_chunk（逐块 token） ---
+        # Dify: {"event": "text_chunk", "data": {"text": "..."}}
+        return self._append_delta((r.get("data") or {}).get("text", ""), state, "text_chunk")
+
+    def _on_agent_log(self, r: dict, state: "_StreamState", incoming_message: ChatbotMessage) -> list:
+        # --- Agent 推理日志（抓 Final Answer）---
+        d = r.get("data") or {}
+        dd = d.get("data") or {}
+        action = dd.get("action") or dd.get("action_name")
+        # 只在成功时抓 Final Answer
+        if d.get("status") == "success" and action == "Final Answer":
+            text = dd.get("action_input") or ""
+            if text:
+                logger.debug("已按 agent_log.Final Answer 推送流式文本")
+                return self._append_final(text, state)
+        return []
+
+    def _on_node_finished(self, r: dict, state: "_StreamState", incoming_message: ChatbotMessage) -> list:
+        # --- 节点结束（兜底 Agent 输出）---
+        data = r.get("data") or {}
+        # 有些策略把最终话术放这里，其他节点忽略
+        if data.get("node_type") == "agent":
+            text = (data.get("outputs") or {}).get("text")
+            if text:
+                logger.debug("已按 node_finished(agent).outputs.text 推送流式文本")
+                return self._append_final(text, state)
+        return []
+
+    def _on_message_end(self, r: dict, state: "_StreamState", incoming_message: ChatbotMessage) -> list:
+        # --- 对话结束：记录会话ID，便于上下文保持 ---
+        # Dify: {'event':'message_end', 'conversation_id':'...', 'metadata':{...}}
+        self.cache.set(incoming_message.sender_staff_id, r.get("conversation_id"))
+        return []
+
+
+class _StreamState(object):
+    """一次流式调用过程中的累积状态"""
+
+    def __init__(self):
+        self.full_content = ""  # 我们对卡片采取“全量覆盖”的逐步刷新策略
+        self.length = 0  # 发流频控（按累计长度差 > 10 再发）
+        self.streamed_final = False
+        self.final_hash = None  # 避免 agent_log 与 node_finished(agent) 重复推送
+        self.task_id = None  # 停止生成时使用
+        self.cancelled = False  # 同步客户端在线程中读取 SSE，通过这个标记得知已被取消
+        self.pushed = False  # 是否已经向卡片输出过内容，之后失败不再重试
+        self.events = {} if journal_enabled() else None  # 各类 SSE 事件数，只在开启请求日志时统计，重试时不清空
+
+    def reset(self):
+        """重试前清空上一次请求累积的内容，保留取消标记"""
+        self.full_content = ""
+        self.length = 0
+        self.streamed_final = False
+        self.final_hash = None
+        self.task_id = None
+
+
+def _loggable_message(incoming_message: ChatbotMessage):
+    """收到消息时的日志内容，开启 LOG_REDACT_CONTENT 时不输出消息内容"""
+    if not redacting():
+        return incoming_message
+    text = incoming_message.text.content if incoming_message.text is not None else ""
+    return {
+        "message_id": incoming_message.message_id,
+        "conversation_id": incoming_message.conversation_id,
+        "conversation_type": incoming_message.conversation_type,
+        "sender_staff_id": incoming_message.sender_staff_id,
+        "message_type": incoming_message.message_type,
+        "text": redact(text),
+    }
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+请求日志（journal，见 setup_journal）：每条消息处理结束后记录一行精简的 JSON，用于离线回放真实的负载（tests/benchmarks/replay.py）：
+- 机器人、用户 id 的哈希、提问、各阶段耗时、SSE 事件数、卡片更新次数和回答长度；
+- 消息处理时只把记录放入有界队列，由后台线程序列化后批量追加到文件，队列满时丢弃并计数，不会等待磁盘；
+- 文件超过 max_bytes 后轮转为 {文件名}-{时间}.jsonl，可以再压缩为 .gz，只保留最近 backup_count 个。
+"""
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+_journal = None
+
+
+def hash_user(user_id: str) -> str:
+    """记录中不直接保存用户 id，同一用户的哈希相同，回放时仍然按用户排队"""
+    return hashlib.sha256((user_id or "").encode("utf-8")).hexdigest()[:16]
+
+
+class JournalWriter(object):
+    """
+    :param batch_size: 一次最多写入的记录数
+    :param flush_interval: 不满 batch_size 时最多等待的秒数
+    :param max_bytes: 单个文件的最大字节数，超过后轮转，0 表示不轮转
+    :param backup_count: 保留的轮转文件数
+    :param compress: 轮转后的文件是否压缩为 .gz
+    :param include_query: 是否记录提问内容，关闭时只记录长度，回放时用等长的占位文字
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 200,
+        flush_interval: float = 1,
+        max_bytes: int = 64 * 1024 * 1024,
+        backup_count: int = 20,
+        compress: bool = False,
+        include_query: bool = True,
+        max_queue: int = 10000,
+    ):
+        self.path = path
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.max_bytes = int(max_bytes)
+        self.backup_count = max(0, int(backup_count))
+        self.compress = compress
+        self.include_query = include_query
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, record: dict):
+        """只入队不阻塞，调用后不要再修改 record"""
+        if not self.include_query and "query" in record:
+            record["query"] = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: list):
+        try:
+            self._file.write("".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in batch))
+            self._file.flush()
+            self.written += len(batch)
+            self.batches += 1
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self._rotate()
+        except Exception:  # noqa
+            # 写请求日志失败不能影响消息处理，计数后丢弃这一批
+            self.errors += 1
+
+    def _rotate(self):
+        self._file.close()
+        root, ext = os.path.splitext(self.path)
+        rotated = f"{root}-{time.strftime('%Y%m%d-%H%M%S')}-{self.rotations % 1000:03d}{ext}"
+        os.replace(self.path, rotated)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self.rotations += 1
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        for old in journal_files(self.path)[:-1][: -self.backup_count or None]:
+            os.remove(old)
+
+    def stop(self, timeout: float = 5):
+        """写完队列中已有的记录后关闭文件"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._file.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "rotations": self.rotations,
+            "errors": self.errors,
+        }
+
+
+def worker_journal_path(path: str, index: int) -> str:
+    """多进程模式下每个 worker 写自己的文件：requests.jsonl -> requests.worker0.jsonl"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{index}{ext}"
+
+
+def journal_files(path: str) -> list:
+    """按时间顺序排列的轮转文件（含压缩后的）和当前文件"""
+    root, ext = os.path.splitext(path)
+    pattern = glob.escape(root) + "-*" + ext
+    rotated = sorted(glob.glob(pattern) + glob.glob(pattern + ".gz"), key=lambda p: p[:-3] if p.endswith(".gz") else p)
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def read_journal(path: str):
+    """逐条读取 path 及其轮转文件中的记录，跳过进程退出时没写完整的行"""
+    for file_path in journal_files(path) if not path.endswith(".gz") else [path]:
+        opener = gzip.open if file_path.endswith(".gz") else open
+        with opener(file_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def setup_journal(path: str, **kwargs):
+    """开启请求日志，只在进程启动时调用一次，参数见 JournalWriter"""
+    global _journal
+    shutdown_journal()
+    _journal = JournalWriter(path, **kwargs)
+    return _journal
+
+
+def shutdown_journal():
+    global _journal
+    if _journal is not None:
+        _journal.stop()
+        _journal = None
+
+
+def journal_enabled() -> bool:
+    return _journal is not None
+
+
+def record_request(record: dict):
+    if _journal is not None:
+        _journal.record(record)
+
+
+def journal_stats() -> dict:
+    return _journal.stats() if _journal is not None else {"queued": 0, "written": 0, "dropped": 0}
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+日志配置（见 setup_logging）以及热路径上的日志辅助函数：
+- 后台写日志：loguru 在调用线程中格式化好之后只放入有界队列，由后台线程批量写到 stdout，队列满时丢弃并计数；
+- 逐事件的 debug 日志按比例采样，debug 关闭时连参数都不构造；
+- 超长日志截断；
+- 按配置隐去用户提问、回答等内容，只保留长度。
+"""
+
+import queue
+import random
+import sys
+import threading
+
+from loguru import logger
+
+_settings = {
+    # 没有调用 setup_logging 时与 loguru 默认的 DEBUG 级别一致
+    "debug": True,
+    "sample_rate": 1.0,
+    "max_length": 0,
+    "redact": False,
+}
+_writer = None
+_writer_sink = None  # (loguru 的 handler id, level)
+
+
+class BackgroundWriter(object):
+    """loguru 的 sink：write 只入队不阻塞，后台线程每次取出队列中已有的全部日志一起写入 stream"""
+
+    def __init__(self, stream=None, max_queue: int = 10000):
+        self.stream = stream or sys.stdout
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self.written = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message: str):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in batch
+            lines = [m for m in batch if m is not None]
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except Exception:  # noqa
+                # 写日志失败不能影响消息处理，也没有别的地方可以报告
+                pass
+            self.written += len(lines)
+            if stop:
+                return
+
+    def stop(self, timeout: float = 5):
+        """写完队列中已有的日志后退出"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+
+def _truncate_record(record):
+    limit = _settings["max_length"]
+    if limit and len(record["message"]) > limit:
+        record["message"] = f"{record['message'][:limit]}...(截断，共{len(record['message'])}字符)"
+
+
+def setup_logging(
+    level: str = "INFO",
+    enqueue: bool = False,
+    queue_size: int = 10000,
+    sample_rate: float = 1.0,
+    max_length: int = 0,
+    redact: bool = False,
+    stream=None,
+):
+    """
+    替换 loguru 默认的输出，只在进程启动时调用一次
+    :param enqueue: 是否由后台线程写日志
+    :param sample_rate: 逐事件 debug 日志（SSE 事件等）的采样比例
+    :param max_length: 单条日志的最大字符数，0 表示不截断
+    :param redact: 是否隐去用户提问、回答等内容
+    """
+    global _writer, _writer_sink
+    stream = stream or sys.stdout
+    _settings.update(
+        debug=logger.level(level.upper()).no <= logger.level("DEBUG").no,
+        sample_rate=min(1.0, max(0.0, float(sample_rate))),
+        max_length=max(0, int(max_length)),
+        redact=bool(redact),
+    )
+    logger.remove()
+    if _writer is not None:
+        _writer.stop()
+        _writer = _writer_sink = None
+    logger.configure(patcher=_truncate_record)
+    if enqueue:
+        _writer = BackgroundWriter(stream, queue_size)
+        handler_id = logger.add(_writer.write, level=level, colorize=getattr(stream, "isatty", lambda: False)())
+        _writer_sink = (handler_id, level)
+    else:
+        logger.add(stream, level=level)
+
+
+def shutdown_logging():
+    """进程退出前写完队列中的日志，之后的日志直接同步写入"""
+    global _writer, _writer_sink
+    if _writer is None:
+        return
+    handler_id, level = _writer_sink
+    logger.remove(handler_id)
+    _writer.stop()
+    logger.add(_writer.stream, level=level)
+    _writer = _writer_sink = None
+
+
+def writer_stats() -> dict:
+    return _writer.stats() if _writer is not None else {"queued": 0, "written": 0, "dropped": 0}
+
+
+def debug_enabled() -> bool:
+    return _settings["debug"]
+
+
+def sample_debug() -> bool:
+    """逐事件的 debug 日志是否输出：debug 开启并且被采样到"""
+    if not _settings["debug"]:
+        return False
+    rate = _settings["sample_rate"]
+    return rate >= 1 or random.random() < rate
+
+
+def redacting() -> bool:
+    return _settings["redact"]
+
+
+def redact(text) -> str:
+    """开启隐去内容时只保留长度"""
+    if not _settings["redact"] or text is None:
+        return text
+    return f"<{len(str(text))}字符>"
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import bisect
+import threading
+import time
+from typing import Callable
+
+from loguru import logger
+
+# 默认的耗时分桶，单位秒
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{k}="{v}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labelvalues, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # labelvalues -> [各分桶计数..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labelvalues)
+            if values is None:
+                values = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def get(self, *labelvalues) -> dict:
+        values = self._values.get(labelvalues)
+        if values is None:
+            return {"sum": 0, "count": 0}
+        return {"sum": values[-2], "count": values[-1]}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        for labelvalues, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {values[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {values[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues)} {values[-1]}")
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    指标注册表，除了 Counter/Histogram 之外，各组件已有的 stats() 字典可以通过 register_stats 直接导出为 gauge。
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._stats = []  # (prefix, labels, stats_func)
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Counter(name, documentation, labelnames)
+            return self._metrics[name]
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, documentation, labelnames, buckets)
+            return self._metrics[name]
+
+    def register_stats(self, prefix: str, stats_func: Callable[[], dict], **labels):
+        """stats_func 返回的字典中数值类型的项会导出为 {prefix}_{key}"""
+        with self._lock:
+            self._stats.append((prefix, labels, stats_func))
+
+    def unregister_stats(self, prefix: str, **labels):
+        with self._lock:
+            self._stats = [s for s in self._stats if not (s[0] == prefix and s[1] == labels)]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            stats = list(self._stats)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        gauges = {}
+        for prefix, labels, stats_func in stats:
+            try:
+                values = stats_func()
+            except Exception as e:
+                logger.warning(f"采集指标{prefix}失败：{e}")
+                continue
+            label_str = _format_labels(tuple(labels.keys()), tuple(labels.values()))
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                gauges.setdefault(f"{prefix}_{key}", []).append(f"{prefix}_{key}{label_str} {value}")
+        for name, samples in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+ACK_SECONDS = REGISTRY.histogram("dod_ack_seconds", "收到消息到返回ack的耗时", ("bot",))
+CARD_CREATE_SECONDS = REGISTRY.histogram("dod_card_create_seconds", "创建并投放AI卡片的耗时", ("bot",))
+DIFY_TTFB_SECONDS = REGISTRY.histogram("dod_dify_ttfb_seconds", "收到消息到Dify返回响应头的耗时", ("bot",))
+DIFY_FIRST_EVENT_SECONDS = REGISTRY.histogram("dod_dify_first_event_seconds", "收到消息到Dify第一个SSE事件的耗时", ("bot",))
+FIRST_TOKEN_SECONDS = REGISTRY.histogram("dod_first_token_seconds", "收到消息到第一段回答内容推送到卡片的耗时", ("bot",))
+CARD_UPDATE_GAP_SECONDS = REGISTRY.histogram("dod_card_update_gap_seconds", "两次卡片更新之间的间隔", ("bot",))
+REQUEST_SECONDS = REGISTRY.histogram("dod_request_duration_seconds", "收到消息到卡片结束更新的总耗时", ("bot",))
+CARD_UPDATES = REGISTRY.histogram("dod_card_updates", "每次回答的卡片更新次数", ("bot",), buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+CARD_UPDATE_BYTES = REGISTRY.histogram(
+    "dod_card_update_bytes", "每次回答发送到卡片的字节数", ("bot",), buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576)
+)
+STREAM_CHARS_PER_SECOND = REGISTRY.histogram(
+    "dod_stream_chars_per_second", "首段内容出现后的回答输出速度（字符/秒）", ("bot",), buckets=(5, 10, 20, 50, 100, 200, 500, 1000)
+)
+REQUESTS_TOTAL = REGISTRY.counter("dod_requests_total", "处理的消息数", ("bot", "status"))
+
+
+class RequestTimings(object):
+    """
+    单次请求的耗时记录，所有时间点都是相对收到消息时刻的单调时钟秒数。
+    :param export: 是否导出到指标并输出 request_timings 日志，关闭指标只开启请求日志时为 False
+    """
+
+    def __init__(self, bot: str, message_id: str = None, export: bool = True):
+        self.bot = bot
+        self.message_id = message_id
+        self.export = export
+        self.start = time.monotonic()
+        self.marks = {}
+        self.card_updates = 0
+        self.card_bytes = 0
+        self.answer_chars = 0
+        self._last_update = None
+
+    def mark(self, name: str):
+        # 同一个时间点只记录第一次
+        if name not in self.marks:
+            self.marks[name] = time.monotonic() - self.start
+
+    def card_update(self, nbytes: int):
+        now = time.monotonic()
+        if self._last_update is not None and self.export:
+            CARD_UPDATE_GAP_SECONDS.observe(now - self._last_update, self.bot)
+        self._last_update = now
+        self.card_updates += 1
+        self.card_bytes += nbytes
+
+    def first_token(self):
+        """推送第一段 Dify 回答（或缓存的回答）时调用；排队位置、繁忙等提示文字不算"""
+        self.mark("first_token")
+
+    def finish(self, status: str = "ok", **extra):
+        self.mark("finished")
+        marks = self.marks
+        chars_per_second = None
+        if "first_token" in marks and marks["finished"] > marks["first_token"] and self.answer_chars:
+            chars_per_second = self.answer_chars / (marks["finished"] - marks["first_token"])
+        record = {
+            "bot": self.bot,
+            "message_id": self.message_id,
+            "status": status,
+            "timings": {k: round(v, 4) for k, v in marks.items()},
+            "card_updates": self.card_updates,
+            "card_bytes": self.card_bytes,
+            "answer_chars": self.answer_chars,
+            "chars_per_second": round(chars_per_second, 1) if chars_per_second else None,
+        }
+        record.update(extra)
+        if not self.export:
+            return record
+        for name, histogram in (
+            ("ack", ACK_SECONDS),
+            ("dify_response", DIFY_TTFB_SECONDS),
+            ("dify_first_event", DIFY_FIRST_EVENT_SECONDS),
+            ("first_token", FIRST_TOKEN_SECONDS),
+            ("finished", REQUEST_SECONDS),
+        ):
+            if name in marks:
+                histogram.observe(marks[name], self.bot)
+        if "card_created" in marks and "card_create_start" in marks:
+            CARD_CREATE_SECONDS.observe(marks["card_created"] - marks["card_create_start"], self.bot)
+        if chars_per_second:
+            STREAM_CHARS_PER_SECOND.observe(chars_per_second, self.bot)
+        CARD_UPDATES.observe(self.card_updates, self.bot)
+        CARD_UPDATE_BYTES.observe(self.card_bytes, self.bot)
+        REQUESTS_TOTAL.inc(1, self.bot, status)
+        logger.info({"request_timings": record})
+        return record
+
+
+class NullRequestTimings(object):
+    """关闭指标时使用，所有方法都是空操作"""
+
+    bot = None
+    message_id = None
+    marks = {}
+    card_updates = 0
+    card_bytes = 0
+    answer_chars = 0
+
+    def mark(self, name: str):
+        pass
+
+    def card_update(self, nbytes: int):
+        pass
+
+    def first_token(self):
+        pass
+
+    def __setattr__(self, name, value):
+        # 共享的单例，忽略赋值
+        pass
+
+    def finish(self, status: str = "ok", **extra):
+        return None
+
+
+NULL_TIMINGS = NullRequestTimings()
+
+_enabled = False
+
+
+def enable_metrics(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+
+def metrics_enabled() -> bool:
+    return _enabled
+
+
+def create_request_timings(bot: str, message_id: str = None, record: bool = False):
+    """:param record: 关闭指标时也记录耗时（请求日志需要），只是不导出"""
+    if _enabled:
+        return RequestTimings(bot, message_id)
+    if record:
+        return RequestTimings(bot, message_id, export=False)
+    return NULL_TIMINGS
+
+
+def start_metrics_server(port: int = 9100, host: str = "0.0.0.0", registry: MetricsRegistry = REGISTRY):
+    """在后台线程中启动 /metrics 接口，返回 ThreadingHTTPServer"""
+    # 只在开启指标时才需要，http.server 的导入耗时不计入每次启动
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"指标接口已启动：http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import concurrent.futures
+import functools
+import os
+import threading
+import time
+from typing import Callable
+
+import dingtalk_stream
+from dingtalk_stream import CallbackHandler
+from loguru import logger
+
+from core.dingtalk_api import close_http_session, get_dingtalk_app
+
+
+def get_rss_bytes() -> int:
+    """当前进程的常驻内存，单位字节"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    # 非 Linux 系统只能拿到峰值
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopThread(object):
+    """一个独立线程中运行的事件循环"""
+
+    def __init__(self, name: str, cpu: int = None):
+        self.name = name
+        self.cpu = cpu
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        if self.cpu is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                # Linux 下 pid=0 表示当前线程
+                os.sched_setaffinity(0, {self.cpu})
+            except OSError as e:
+                logger.warning(f"事件循环线程绑定CPU失败：{e}")
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+
+class _Connection(object):
+    """一个钉钉 stream 连接"""
+
+    def __init__(self, loop_thread: LoopThread, client: dingtalk_stream.DingTalkStreamClient, on_connected: Callable = None):
+        self.loop_thread = loop_thread
+        self.client = client
+        self.on_connected = on_connected
+        self.connects = 0  # 建立 websocket 的次数，大于 1 说明发生过重连
+        self.task = None
+        self.future = loop_thread.submit(self._serve())
+
+    async def _serve(self):
+        self.task = asyncio.current_task()
+        client = self.client
+        open_connection = getattr(client, "open_connection", None)
+        if open_connection is not None:
+            # SDK 在事件循环中同步调用 open_connection（requests.post 获取 ticket），多个连接共享事件循环时会串行阻塞；
+            # 第一次先放到线程池中并行获取，之后的重连仍然走 SDK 原来的逻辑
+            prefetched = await asyncio.to_thread(open_connection)
+
+            def open_prefetched():
+                client.open_connection = open_connection
+                return prefetched if prefetched else open_connection()
+
+            client.open_connection = open_prefetched
+        keepalive = getattr(client, "keepalive", None)
+        if keepalive is not None:
+            # SDK 在 websocket 建立后立即调用 keepalive，借此得知连接已就绪
+            def keepalive_and_notify(websocket, *args, **kwargs):
+                self.connects += 1
+                if self.connects == 1 and self.on_connected is not None:
+                    self.on_connected()
+                return keepalive(websocket, *args, **kwargs)
+
+            client.keepalive = keepalive_and_notify
+        await client.start()
+
+    async def _shutdown(self):
+        # SDK 的 start() 捕获 CancelledError 后会等待 10 秒重连，需要反复取消直到真正退出
+        while self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.wait([self.task], timeout=0.1)
+
+    def close(self, timeout: float = 10):
+        """断开连接，已经收到的消息会继续处理"""
+        try:
+            self.loop_thread.submit(self._shutdown()).result(timeout)
+        except (concurrent.futures.TimeoutError, RuntimeError) as e:
+            logger.warning(f"断开钉钉连接超时：{e}")
+            self.future.cancel()
+
+
+class BotRuntime(object):
+    """
+    管理所有机器人的钉钉 stream 连接：
+    - threads：每个连接一个线程和事件循环（原有方式）；
+    - asyncio：所有机器人的所有连接都运行在 loops 个共享的事件循环中，
+      单个连接内的消息本来就是并发处理的，并发量由准入控制（AdmissionController）决定，而不是线程数。
+    热加载配置时可以增删机器人、调整连接数和替换 handler，见 app.apply_bots_config。
+    """
+
+    def __init__(self, mode: str = "threads", loops: int = 1, pin_cores: bool = False, on_connected: Callable[[str], None] = None):
+        """
+        :param on_connected: 每个连接第一次建立 websocket 时调用，参数为机器人名称，用于统计启动耗时
+        """
+        if mode not in ("threads", "asyncio"):
+            raise ValueError(f"不支持的运行模式：{mode}")
+        self.mode = mode
+        self.bots = {}  # name -> [_Connection]
+        self.handlers = {}  # name -> CallbackHandler
+        self._credentials = {}  # name -> dingtalk_stream.Credential
+        self.on_connected = on_connected
+        self._lock = threading.RLock()
+        self._loop_threads = []
+        self._next_loop = 0
+        if mode == "asyncio":
+            cpu_count = os.cpu_count() or 1
+            for i in range(max(1, int(loops))):
+                self._loop_threads.append(LoopThread(f"dingtalk-loop-{i}", cpu=i % cpu_count if pin_cores else None))
+
+    def _pick_loop(self, name: str) -> LoopThread:
+        if self.mode == "threads":
+            loop_thread = LoopThread(f"dingtalk-{name}-{len(self.bots.get(name, []))}")
+            self._loop_threads.append(loop_thread)
+            return loop_thread
+        # 共享事件循环之间轮流分配
+        loop_thread = self._loop_threads[self._next_loop % len(self._loop_threads)]
+        self._next_loop += 1
+        return loop_thread
+
+    def _connect(self, name: str) -> _Connection:
+        client = dingtalk_stream.DingTalkStreamClient(self._credentials[name], logger)
+        # SDK 每个连接各自获取 access token，改为同一个应用的所有连接共用，见 core.dingtalk_api
+        tokens = get_dingtalk_app(self._credentials[name]).tokens
+        client.get_access_token = tokens.get
+        client.reset_access_token = tokens.reset
+        client.register_callback_handler(dingtalk_stream.ChatbotMessage.TOPIC, self.handlers[name])
+        on_connected = functools.partial(self.on_connected, name) if self.on_connected is not None else None
+        connection = _Connection(self._pick_loop(name), client, on_connected)
+        self.bots.setdefault(name, []).append(connection)
+        return connection
+
+    def add_bot(self, name: str, app_client_id: str, app_client_secret: str, callback_handler: CallbackHandler, connections: int = 1):
+        rss_before, threads_before = get_rss_bytes(), threading.active_count()
+        with self._lock:
+            self._credentials[name] = dingtalk_stream.Credential(app_client_id, app_client_secret)
+            self.handlers[name] = callback_handler
+            for _ in range(max(1, int(connections))):
+                self._connect(name)
+        logger.info(
+            f"机器人{name}已启动：模式={self.mode}, 连接数={connections}, "
+            f"新增线程数={threading.active_count() - threads_before}, 新增常驻内存={(get_rss_bytes() - rss_before) / 1024 / 1024:.1f}MB, "
+            f"当前总线程数={threading.active_count()}, 当前常驻内存={get_rss_bytes() / 1024 / 1024:.1f}MB"
+        )
+
+    def resize_bot(self, name: str, connections: int, drain_timeout: float = 300):
+        """调整连接数，多出的连接断开后等已收到的消息处理完再释放"""
+        connections = max(1, int(connections))
+        with self._lock:
+            current = self.bots.get(name, [])
+            for _ in range(connections - len(current)):
+                self._connect(name)
+            removed = current[connections:]
+            self.bots[name] = current[:connections]
+        self._drain(name, self.handlers[name], removed, drain_timeout)
+        logger.info(f"机器人{name}的连接数调整为{connections}")
+
+    def replace_handler(self, name: str, callback_handler: CallbackHandler, drain_timeout: float = 300):
+        """替换机器人的 handler，连接不断开，新消息立即交给新 handler，旧 handler 处理完已收到的消息后释放"""
+        with self._lock:
+            old_handler = self.handlers[name]
+            self.handlers[name] = callback_handler
+            for connection in self.bots.get(name, []):
+                # SDK 每收到一条消息都会从 callback_handler_map 中查找 handler
+                connection.client.register_callback_handler(dingtalk_stream.ChatbotMessage.TOPIC, callback_handler)
+            loop_threads = [c.loop_thread for c in self.bots.get(name, [])]
+        self._release_handler(name, old_handler, loop_threads, drain_timeout)
+        return old_handler
+
+    def remove_bot(self, name: str, drain_timeout: float = 300):
+        """停止机器人：先断开连接不再接收新消息，已收到的消息处理完（或超时）后释放资源"""
+        with self._lock:
+            connections = self.bots.pop(name, [])
+            handler = self.handlers.pop(name, None)
+            self._credentials.pop(name, None)
+        self._drain(name, handler, connections, drain_timeout)
+
+    def _drain(self, name: str, handler: CallbackHandler, connections: list, timeout: float):
+        if not connections:
+            return
+        for connection in connections:
+            connection.close()
+
+        def wait_and_release():
+            self._wait_inflight(handler, [c.loop_thread for c in connections], timeout)
+            if handler is not None and self.handlers.get(name) is not handler:
+                self._close_handler(handler, [c.loop_thread for c in connections])
+            if self.mode == "threads":
+                for connection in connections:
+                    self._stop_loop_thread(connection.loop_thread, handler)
+            logger.info(f"机器人{name}的{len(connections)}个连接已停止")
+
+        threading.Thread(target=wait_and_release, name=f"drain-{name}", daemon=True).start()
+
+    def _release_handler(self, name: str, handler: CallbackHandler, loop_threads: list, timeout: float):
+        def wait_and_release():
+            self._wait_inflight(handler, loop_threads, timeout)
+            self._close_handler(handler, loop_threads)
+            logger.info(f"机器人{name}的旧handler已释放")
+
+        threading.Thread(target=wait_and_release, name=f"drain-{name}", daemon=True).start()
+
+    @staticmethod
+    def _wait_inflight(handler: CallbackHandler, loop_threads: list, timeout: float):
+        inflight = getattr(handler, "inflight", None)
+        if inflight is None:
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            pending = sum(inflight(lt.loop) for lt in loop_threads)
+            if not pending:
+                return
+            time.sleep(0.5)
+        logger.warning(f"等待进行中的消息结束超时（{timeout}秒），剩余{sum(inflight(lt.loop) for lt in loop_threads)}条")
+
+    @staticmethod
+    def _close_handler(handler: CallbackHandler, loop_threads: list):
+        # 异步 Dify 客户端在每个事件循环上各有一个 ClientSession
+        dify_api_client = getattr(handler, "dify_api_client", None)
+        close = getattr(dify_api_client, "close", None)
+        if close is None:
+            return
+        for loop_thread in set(loop_threads):
+            try:
+                loop_thread.submit(close()).result(10)
+            except Exception as e:
+                logger.warning(f"关闭Dify客户端失败：{e}")
+
+    def _stop_loop_thread(self, loop_thread: LoopThread, handler: CallbackHandler = None):
+        # 先关闭绑定在这个事件循环上的 session（handler 的异步 Dify 客户端、钉钉接口），否则连接泄漏
+        if handler is not None:
+            self._close_handler(handler, [loop_thread])
+        try:
+            loop_thread.submit(close_http_session()).result(10)
+        except Exception as e:
+            logger.warning(f"关闭钉钉接口session失败：{e}")
+        loop_thread.stop()
+        with self._lock:
+            if loop_thread in self._loop_threads:
+                self._loop_threads.remove(loop_thread)
+
+    def dispatch(self, name: str, callback_msg) -> bool:
+        """把其他 worker 转交来的消息交给机器人的 handler（见 core.workers），机器人没有运行时返回 False"""
+        with self._lock:
+            handler = self.handlers.get(name)
+            connections = self.bots.get(name)
+            if handler is None or not connections:
+                return False
+            # 按消息分散到该机器人各连接的事件循环上
+            loop_thread = connections[hash(callback_msg.headers.message_id) % len(connections)].loop_thread
+        future = loop_thread.submit(handler.process(callback_msg))
+
+        def log_exception(f):
+            if not f.cancelled() and f.exception() is not None:
+                logger.opt(exception=f.exception()).error(f"机器人{name}处理转交的消息失败")
+
+        future.add_done_callback(log_exception)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            connections = [c for cs in self.bots.values() for c in cs]
+        return {
+            "bots": len(self.bots),
+            "connections": len(connections),
+            "connected": sum(1 for c in connections if c.connects),
+            "reconnects": sum(max(0, c.connects - 1) for c in connections),
+        }
+
+    def run_forever(self, exit_when_empty: bool = True):
+        """
+        :param exit_when_empty: 所有连接都结束后是否退出；开启热加载时机器人可能被全部删除后再添加，不退出
+        """
+        try:
+            while True:
+                with self._lock:
+                    futures = {c.future: (name, c) for name, connections in self.bots.items() for c in connections}
+                if not futures:
+                    if exit_when_empty:
+                        break
+                    time.sleep(1)
+                    continue
+                done, _ = concurrent.futures.wait(futures, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    # 正常情况下 stream 连接不会退出
+                    name, connection = futures[future]
+                    if not future.cancelled() and future.exception() is not None:
+                        logger.opt(exception=future.exception()).error(f"机器人{name}的连接异常退出")
+                    with self._lock:
+                        # 热加载时主动停止的连接已经不在列表中了
+                        if connection in self.bots.get(name, []):
+                            self.bots[name].remove(connection)
+                            if not self.bots[name]:
+                                del self.bots[name]
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        with self._lock:
+            for connections in self.bots.values():
+                for connection in connections:
+                    connection.future.cancel()
+            for loop_thread in self._loop_threads:
+                loop_thread.stop()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import json
+import re
+from typing import Callable, Optional
+
+from loguru import logger
+
+from core.log import redacting, sample_debug
+
+# Dify 的每个事件都是 {"event": "xxx", ...}，event 总是第一个字段
+_EVENT_TYPE_RE = re.compile(rb'\s*\{\s*"event"\s*:\s*"([^"\\]+)"')
+_TASK_ID_RE = re.compile(rb'"task_id"\s*:\s*"([^"\\]+)"')
+_ANY_EVENT_TYPE_RE = re.compile(rb'"event"\s*:\s*"([^"\\]+)"')
+
+
+class SSEEvent(object):
+    """一个 SSE 事件，data 保留原始字节，需要时再解码"""
+
+    __slots__ = ("event", "raw", "id", "retry")
+
+    def __init__(self, event: str = "message", raw: bytes = b"", id: str = None, retry: str = None):
+        self.event = event
+        self.raw = raw
+        self.id = id
+        self.retry = retry
+
+    @property
+    def data(self) -> str:
+        return self.raw.decode("utf-8")
+
+
+class SSEDecoder(object):
+    """
+    增量解析 SSE 字节流，不要求网络分块与行、事件边界对齐：
+        decoder = SSEDecoder()
+        for chunk in chunks:
+            for event in decoder.feed(chunk): ...
+        for event in decoder.flush(): ...
+    """
+
+    def __init__(self):
+        self._pending = []  # 还没遇到换行的分块，避免大事件被拆成很多分块时反复拼接
+        self._data = []
+        self._event = None
+        self._id = None
+        self._retry = None
+
+    def feed(self, chunk: bytes) -> list:
+        if b"\n" not in chunk:
+            if chunk:
+                self._pending.append(chunk)
+            return []
+        if self._pending:
+            self._pending.append(chunk)
+            chunk = b"".join(self._pending)
+            self._pending = []
+        lines = chunk.split(b"\n")
+        # 最后一段可能是不完整的行，留到下一次
+        if lines[-1]:
+            self._pending.append(lines[-1])
+        del lines[-1]
+        events = []
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                # 空行表示一个事件结束
+                if self._data:
+                    events.append(self._build())
+                else:
+                    self._event = self._id = self._retry = None
+                continue
+            if line.startswith(b"data:"):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(b" ") else value)
+            elif line.startswith(b":"):
+                # 注释行（心跳）
+                continue
+            else:
+                field, _, value = line.partition(b":")
+                if value.startswith(b" "):
+                    value = value[1:]
+                if field == b"event":
+                    self._event = value.decode("utf-8")
+                elif field == b"id":
+                    self._id = value.decode("utf-8")
+                elif field == b"retry":
+                    self._retry = value.decode("utf-8")
+        return events
+
+    def flush(self) -> list:
+        events = []
+        if self._pending:
+            events = self.feed(b"\n")
+        if self._data:
+            events.append(self._build())
+        return events
+
+    def _build(self) -> SSEEvent:
+        raw = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+        event = SSEEvent(self._event or "message", raw, self._id, self._retry)
+        self._data = []
+        self._event = self._id = self._retry = None
+        return event
+
+
+def iter_sse_events(response):
+    """requests 流式响应的 SSE 事件，按网络分块读取而不是逐字节/逐行"""
+    decoder = SSEDecoder()
+    for chunk in response.iter_content(chunk_size=None):
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_sse_events(response):
+    """aiohttp 流式响应的 SSE 事件"""
+    decoder = SSEDecoder()
+    async for chunk in response.content.iter_any():
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
+
+
+def peek_event_type(data: bytes) -> Optional[str]:
+    """不解析整个 JSON，直接从原始字节中取出 Dify 事件类型；取不到时返回 None"""
+    match = _EVENT_TYPE_RE.match(data)
+    if match is None:
+        return None
+    return match.group(1).decode("ascii", "replace")
+
+
+def find_event_type(data) -> Optional[str]:
+    """
+    事件类型，event 不是第一个字段时在整个事件中查找，只用于统计（请求日志中的事件数）：
+    查找时可能取到嵌套对象中的 event，不能用来决定是否跳过解析
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    match = _EVENT_TYPE_RE.match(data) or _ANY_EVENT_TYPE_RE.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode("ascii", "replace")
+
+
+def peek_task_id(data) -> Optional[str]:
+    """Dify 事件中的 task_id（停止生成时使用），不解析整个 JSON"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    match = _TASK_ID_RE.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode("ascii", "replace")
+
+
+class SSEDispatcher(object):
+    """
+    按事件类型分发 Dify SSE 事件：
+    - 先从原始字节中取出事件类型，忽略的和没有处理函数的事件不做 JSON 解析；
+    - 其余事件解析后交给 handlers 中对应的函数处理，处理函数签名为 handler(payload: dict, *args)。
+    """
+
+    def __init__(self, handlers: dict, ignored: frozenset = frozenset()):
+        self.handlers = handlers
+        self.ignored = ignored
+        self.parsed = 0
+        self.skipped = 0
+
+    def dispatch(self, data, *args):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        evt = peek_event_type(data)
+        if evt is not None and evt not in self.handlers:
+            self.skipped += 1
+            if evt not in self.ignored and sample_debug():
+                logger.debug("未知事件（忽略）：{}", evt)
+            return None
+        # 兼容非 JSON 片段（比如心跳、DONE）
+        try:
+            payload = json.loads(data.decode("utf-8"))
+        except ValueError:
+            if sample_debug():
+                logger.debug("收到无法解析的事件：{}", f"<{len(data)}字节>" if redacting() else data)
+            return None
+        if not isinstance(payload, dict):
+            return None
+        self.parsed += 1
+        # 逐事件的日志按 LOG_DEBUG_SAMPLE_RATE 采样，debug 关闭时不调用 logger
+        if sample_debug():
+            logger.debug("接收到模型服务返回：{}", {"event": payload.get("event"), "bytes": len(data)} if redacting() else payload)
+        handler: Optional[Callable] = self.handlers.get(payload.get("event"))
+        if handler is None:
+            return None
+        return handler(payload, *args)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+启动耗时统计，只依赖标准库，在 app.py 中最先导入：
+- 各阶段（导入、加载配置、创建机器人……）耗时，导入阶段给出 app.py 中每个 import 以及每个第三方包的耗时；
+- 从进程启动到第一个、全部钉钉 stream 连接就绪的时间；
+全部连接就绪（或等待超时）时输出一条 startup_summary 日志。
+"""
+
+import builtins
+import contextlib
+import os
+import sys
+import threading
+import time
+
+
+def process_age() -> float:
+    """进程已经运行的秒数（包括解释器自身的启动时间），取不到时返回 0"""
+    try:
+        with open("/proc/self/stat") as f:
+            # 第 22 个字段是进程启动时间（系统启动后的时钟周期数），进程名中可能有空格，从右括号之后开始数
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0.0
+
+
+class StartupProfile(object):
+
+    def __init__(self, summary_timeout: float = 30):
+        # 以进程启动时间为零点，包括解释器启动和 site 导入
+        self._origin = time.perf_counter() - process_age()
+        self.summary_timeout = summary_timeout
+        self.phases = []  # [(name, seconds)]
+        self.imports = {}  # app.py 中的 import -> 导入耗时（包含它间接导入的模块）
+        self.packages = {}  # 顶层包 -> 第一次导入时的耗时，不论是被谁导入的
+        self.expected = 0
+        self.ready = 0
+        self.first_ready = None
+        self.all_ready = None
+        self._lock = threading.Lock()
+        self._reported = False
+        self._timer = None
+        self.phases.append(("interpreter", self.elapsed()))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._origin
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, time.perf_counter() - begin))
+
+    @contextlib.contextmanager
+    def trace_imports(self):
+        """统计 with 块中 import 的耗时，只在启动时使用，结束后恢复原来的 __import__"""
+        original_import = builtins.__import__
+        depth = 0
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            nonlocal depth
+            package = name.split(".")[0] if level == 0 else None
+            new_package = package is not None and package not in sys.modules
+            if depth and not new_package:
+                return original_import(name, globals, locals, fromlist, level)
+            outermost = depth == 0
+            depth += 1
+            begin = time.perf_counter()
+            try:
+                return original_import(name, globals, locals, fromlist, level)
+            finally:
+                depth -= 1
+                cost = time.perf_counter() - begin
+                if outermost:
+                    self.imports[name] = self.imports.get(name, 0.0) + cost
+                if new_package:
+                    self.packages[package] = cost
+
+        builtins.__import__ = timed_import
+        try:
+            yield
+        finally:
+            builtins.__import__ = original_import
+
+    def expect_connections(self, count: int):
+        """设置需要等待就绪的连接数，超过 summary_timeout 秒还没有全部就绪时也输出统计"""
+        with self._lock:
+            self.expected = count
+        self._timer = threading.Timer(self.summary_timeout, self.report)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def connection_ready(self, name: str = ""):
+        with self._lock:
+            if self._reported:
+                return
+            self.ready += 1
+            now = self.elapsed()
+            if self.first_ready is None:
+                self.first_ready = now
+            done = self.ready >= self.expected
+            if done:
+                self.all_ready = now
+        if done:
+            self.report()
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases},
+                "imports": self._top(self.imports),
+                "packages": self._top(self.packages),
+                "connections": f"{self.ready}/{self.expected}",
+                "first_ready": None if self.first_ready is None else round(self.first_ready, 3),
+                "all_ready": None if self.all_ready is None else round(self.all_ready, 3),
+            }
+
+    @staticmethod
+    def _top(costs: dict, limit: int = 10) -> dict:
+        top = sorted(costs.items(), key=lambda kv: -kv[1])[:limit]
+        return {name: round(seconds, 3) for name, seconds in top if seconds >= 0.001}
+
+    def report(self):
+        """输出一次启动统计"""
+        with self._lock:
+            if self._reported:
+                return
+            self._reported = True
+        if self._timer is not None:
+            self._timer.cancel()
+        # 不在模块顶部导入，loguru 的导入耗时计入 trace_imports 的明细
+        from loguru import logger
+
+        logger.info({"startup_summary": self.summary()})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "first_ready_seconds": self.first_ready or 0.0,
+                "all_ready_seconds": self.all_ready or 0.0,
+                "import_seconds": sum(self.imports.values()),
+            }
+
+
+# 在 app.py 中最先导入，尽量贴近进程启动的时间点
+STARTUP = StartupProfile()
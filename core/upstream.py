@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import random
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 这些状态码说明上游暂时不可用，可以重试，也计入熔断
+RETRYABLE_STATUS = frozenset([429, 500, 502, 503, 504])
+
+
+class UpstreamError(Exception):
+    """调用 Dify 失败，retryable 表示换一次请求可能成功"""
+
+    def __init__(self, message: str, status: int = None, retryable: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class CircuitOpenError(UpstreamError):
+    """熔断中，请求没有发出"""
+
+    def __init__(self, retry_after: float = 0):
+        super().__init__(f"Dify服务暂时不可用，熔断中，{retry_after:.0f}秒后重试")
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt: int, factor: float, cap: float = 10) -> float:
+    """第 attempt 次（从 1 开始）重试前的等待时间：指数退避加全抖动，避免大量请求同时重试"""
+    return random.uniform(0, min(cap, factor * (2 ** (attempt - 1))))
+
+
+class CircuitBreaker(object):
+    """
+    每个 bot 的 Dify 上游熔断器：
+    - closed：正常放行，连续失败 failure_threshold 次后打开；
+    - open：直接拒绝（CircuitOpenError），recovery_time 秒后进入半开；
+    - half_open：最多放行 half_open_requests 个探测请求，成功则关闭，失败则重新打开。
+    探测请求在 probe_timeout 秒内没有结果（比如调用方没有上报）时允许新的探测，避免卡在半开状态。
+    同一 bot 的请求可能来自多个线程和事件循环，所有状态都在锁内修改。
+    failure_threshold 为 0 时不熔断。
+    """
+
+    def __init__(self, failure_threshold: int = 5, recovery_time: float = 30, half_open_requests: int = 1, probe_timeout: float = 60):
+        self.failure_threshold = int(failure_threshold)
+        self.recovery_time = float(recovery_time)
+        self.half_open_requests = max(1, int(half_open_requests))
+        self.probe_timeout = float(probe_timeout)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0  # 连续失败次数
+        self._opened_at = 0.0
+        self._probes = []  # 半开状态下放行的探测请求的开始时间
+        self.opened = 0
+        self.rejected = 0
+        self.total_failures = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.recovery_time:
+            self._state = HALF_OPEN
+            self._probes = []
+        return self._state
+
+    def is_open(self) -> bool:
+        """只检查不占用探测名额，用于在排队之前快速失败"""
+        with self._lock:
+            return self._current_state() == OPEN
+
+    def before_request(self):
+        """发出请求前调用，熔断中抛出 CircuitOpenError"""
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            now = time.monotonic()
+            if state == HALF_OPEN:
+                self._probes = [t for t in self._probes if now - t < self.probe_timeout]
+                if len(self._probes) < self.half_open_requests:
+                    self._probes.append(now)
+                    return
+                retry_after = self.probe_timeout - (now - self._probes[0])
+            else:
+                retry_after = self.recovery_time - (now - self._opened_at)
+            self.rejected += 1
+        raise CircuitOpenError(max(0.0, retry_after))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != CLOSED:
+                self._state = CLOSED
+                self._probes = []
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self.total_failures += 1
+            self._failures += 1
+            state = self._current_state()
+            if state == HALF_OPEN or (state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probes = []
+                self.opened += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            return {
+                "open": 1 if state == OPEN else 0,
+                "half_open": 1 if state == HALF_OPEN else 0,
+                "consecutive_failures": self._failures,
+                "failures": self.total_failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+多进程模式（WORKER_PROCESSES > 1）：一个进程只能用满一个 CPU 核（SSE 解析、卡片内容拼装、日志都要持有 GIL），
+supervisor 启动 N 个 worker 进程，每个 worker 运行完整的 app.run()，只负责分配给它的钉钉 stream 连接：
+- 每个机器人的连接从按名称哈希得到的 worker 开始依次分配（assign_connections），热加载时各 worker 独立计算，结果一致；
+- 钉钉把消息推送给应用的任意一个连接，收到消息的 worker 按发送人哈希把消息转交给固定的 worker 处理（WorkerContext.route），
+  同一个用户的会话上下文、进行中的生成和去重记录始终在同一个进程中；
+- worker 异常退出后由 supervisor 重新启动，转交给它的消息在队列中等待；
+- 每个 worker 在 METRICS_PORT+1+序号 上导出指标，supervisor 在 METRICS_PORT 上汇总，并加上 worker 标签。
+"""
+
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import urllib.request
+import zlib
+from typing import Callable
+
+from dingtalk_stream import CallbackMessage
+from dingtalk_stream.frames import Headers
+from loguru import logger
+
+
+def _hash(value: str) -> int:
+    # 内置 hash 对字符串加了随机盐，各进程的结果不同
+    return zlib.crc32(value.encode("utf-8"))
+
+
+def assign_connections(name: str, connections: int, workers: int) -> list:
+    """机器人的 connections 个连接在各 worker 中的数量"""
+    counts = [0] * workers
+    offset = _hash(name) % workers
+    for i in range(max(1, int(connections))):
+        counts[(offset + i) % workers] += 1
+    return counts
+
+
+def worker_metrics_port(base_port: int, index: int) -> int:
+    return base_port + 1 + index
+
+
+class WorkerContext(object):
+    """
+    worker 进程内的分配与转交，handler 通过 route 判断收到的消息是否由本进程处理。
+    :param inboxes: 所有 worker 的消息队列，由 supervisor 创建，worker 重启后继续使用
+    :param pending_timeout: 转交来的消息所属的机器人在本进程还没有启动时，最多等待多少秒
+    """
+
+    def __init__(self, index: int, workers: int, inboxes: list, pending_timeout: float = 60):
+        self.index = index
+        self.workers = workers
+        self.inboxes = inboxes
+        self.pending_timeout = pending_timeout
+        self._bots = {}  # name -> 所有 worker 合计的连接数
+        self._lock = threading.Lock()
+        self.forwarded = 0
+        self.received = 0
+        self.dropped = 0
+        self._pending = []  # (deadline, bot_name, callback_msg)
+
+    def connections(self, name: str, total: int) -> int:
+        """机器人在本进程中的连接数，0 表示本进程不运行该机器人"""
+        return assign_connections(name, total, self.workers)[self.index]
+
+    def owners(self, name: str) -> list:
+        """运行该机器人（有连接）的 worker，机器人的消息只在它们之中处理"""
+        total = self._bots.get(name)
+        if total is None:
+            return []
+        return [i for i, count in enumerate(assign_connections(name, total, self.workers)) if count]
+
+    def share(self, name: str) -> float:
+        """本进程在该机器人的消息中所占的比例，按比例分配按应用计算的调用额度等"""
+        owners = self.owners(name)
+        return 1 / len(owners) if owners else 1
+
+    def set_bot(self, name: str, total_connections: int):
+        with self._lock:
+            self._bots[name] = total_connections
+
+    def remove_bot(self, name: str):
+        with self._lock:
+            self._bots.pop(name, None)
+
+    def filter_bots_config(self, bots_conf: dict, get_total_connections: Callable[[dict], int]) -> dict:
+        """只保留在本进程中有连接的机器人"""
+        bots = [bot for bot in bots_conf["bots"] if self.connections(bot["name"], get_total_connections(bot))]
+        return dict(bots_conf, bots=bots)
+
+    def route(self, bot_name: str, callback_msg: CallbackMessage) -> bool:
+        """消息属于其他 worker 时放入它的队列并返回 True，调用方直接 ack"""
+        if "forwarded_from" in callback_msg.extensions:
+            return False
+        owners = self.owners(bot_name)
+        if len(owners) <= 1:
+            return False
+        data = callback_msg.data or {}
+        sender = data.get("senderStaffId") or data.get("senderId") or ""
+        owner = owners[_hash(sender) % len(owners)]
+        if owner == self.index:
+            return False
+        self.inboxes[owner].put((bot_name, self.index, callback_msg.headers.to_dict(), callback_msg.data))
+        self.forwarded += 1
+        return True
+
+    def serve(self, dispatch: Callable[[str, CallbackMessage], bool]):
+        """
+        在后台线程中处理其他 worker 转交来的消息
+        :param dispatch: (机器人名称, 消息) -> 是否已交给 handler；机器人还没有启动时返回 False，稍后重试
+        """
+        threading.Thread(target=self._serve, args=(dispatch,), name="worker-inbox", daemon=True).start()
+        return self
+
+    def _serve(self, dispatch: Callable[[str, CallbackMessage], bool]):
+        inbox = self.inboxes[self.index]
+        while True:
+            try:
+                bot_name, from_index, headers, data = inbox.get(timeout=0.5)
+            except queue.Empty:
+                pass
+            else:
+                callback_msg = CallbackMessage()
+                callback_msg.headers = Headers.from_dict(headers)
+                callback_msg.data = data
+                callback_msg.extensions["forwarded_from"] = from_index
+                self.received += 1
+                self._pending.append((time.monotonic() + self.pending_timeout, bot_name, callback_msg))
+            pending, self._pending = self._pending, []
+            for deadline, bot_name, callback_msg in pending:
+                if dispatch(bot_name, callback_msg):
+                    continue
+                if time.monotonic() < deadline:
+                    self._pending.append((deadline, bot_name, callback_msg))
+                else:
+                    self.dropped += 1
+                    logger.error(f"机器人{bot_name}没有在本进程中运行，丢弃转交来的消息：{callback_msg.headers.message_id}")
+
+    def stats(self) -> dict:
+        return {"forwarded": self.forwarded, "received": self.received, "pending": len(self._pending), "dropped": self.dropped}
+
+
+def _add_label(sample: str, label: str) -> str:
+    end = len(sample)
+    for sep in ("{", " "):
+        position = sample.find(sep)
+        if 0 <= position < end:
+            end = position
+    if sample[end : end + 1] == "{":
+        rest = sample[end + 1 :]
+        return f"{sample[:end]}{{{label}{'' if rest.startswith('}') else ','}{rest}"
+    return f"{sample[:end]}{{{label}}}{sample[end:]}"
+
+
+def merge_metrics(texts: dict) -> str:
+    """合并各 worker 的 /metrics 输出：同名指标放在一起，每个样本加上 worker 标签"""
+    families = {}  # 指标名 -> [注释行, 样本行]
+    for index, text in sorted(texts.items()):
+        family = families.setdefault("", [[], []])
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], [[], []])
+                    if line not in family[0]:
+                        family[0].append(line)
+                continue
+            family[1].append(_add_label(line, f'worker="{index}"'))
+    lines = []
+    for comments, samples in families.values():
+        lines.extend(comments)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class MetricsAggregator(object):
+    """supervisor 的 /metrics：拉取各 worker 的指标后合并，再加上 supervisor 自己的统计（见 start_metrics_server 的 registry 参数）"""
+
+    def __init__(self, ports: list, registry, host: str = "127.0.0.1", timeout: float = 2):
+        self.ports = ports
+        self.registry = registry
+        self.host = host
+        self.timeout = timeout
+
+    def render(self) -> str:
+        texts = {}
+        for index, port in enumerate(self.ports):
+            try:
+                with urllib.request.urlopen(f"http://{self.host}:{port}/metrics", timeout=self.timeout) as response:
+                    texts[index] = response.read().decode("utf-8")
+            except OSError as e:
+                # worker 正在重启
+                logger.warning(f"获取worker{index}的指标失败：{e}")
+        return merge_metrics(texts) + self.registry.render()
+
+
+class Supervisor(object):
+    """
+    启动并看护 worker 进程，worker 以 target(index, workers, inboxes) 的方式运行。
+    使用 spawn 启动 worker：父进程中已有的线程（日志、指标接口）不会被带到子进程里。
+    :param restart_delay: worker 退出后重启前的等待秒数，启动后很快又退出时逐次加倍，最多 max_restart_delay
+    """
+
+    def __init__(self, target: Callable, workers: int, restart_delay: float = 1, max_restart_delay: float = 60):
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self._context = multiprocessing.get_context("spawn")
+        self.inboxes = [self._context.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self._started_at = [0.0] * workers
+        self._delays = [restart_delay] * workers
+        self._restart_at = [None] * workers
+        self._stopping = threading.Event()
+
+    def _start(self, index: int):
+        process = self._context.Process(
+            target=self.target, args=(index, self.workers, self.inboxes), name=f"dod-worker-{index}", daemon=False
+        )
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.info(f"worker{index}已启动：pid={process.pid}")
+
+    def start(self):
+        for index in range(self.workers):
+            self._start(index)
+        return self
+
+    def check(self):
+        """重启已经退出的 worker，run_forever 中定期调用"""
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if self._restart_at[index] is not None:
+                if now >= self._restart_at[index]:
+                    self._restart_at[index] = None
+                    self.restarts[index] += 1
+                    self._start(index)
+                continue
+            if process is None or process.is_alive():
+                continue
+            # 运行了足够长时间后退出的按初始间隔重启，启动后很快又退出的逐次加长间隔
+            if now - self._started_at[index] > self.max_restart_delay:
+                self._delays[index] = self.restart_delay
+            else:
+                self._delays[index] = min(self.max_restart_delay, self._delays[index] * 2)
+            delay = self._delays[index]
+            logger.error(f"worker{index}异常退出：exitcode={process.exitcode}，{delay:.0f}秒后重启")
+            self._restart_at[index] = now + delay
+
+    def run_forever(self, interval: float = 0.5):
+        def handle_signal(signum, frame):
+            self._stopping.set()
+
+        signal.signal(signal.SIGTERM, handle_signal)
+        try:
+            while not self._stopping.wait(interval):
+                self.check()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout: float = 10):
+        self._stopping.set()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            if process is not None:
+                process.join(max(0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.kill()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "alive": sum(1 for p in self.processes if p is not None and p.is_alive()),
+            "restarts": sum(self.restarts),
+        }
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from core import admission
+from core.admission import AdmissionController, AdmissionRejected
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+
+    async def test_per_user_queue(self):
+        controller = AdmissionController(per_user_limit=1)
+        positions = []
+
+        async def on_queued(position):
+            positions.append(position)
+
+        first = await controller.acquire("bot", "u1")
+        waiting = asyncio.create_task(controller.acquire("bot", "u1", on_queued=on_queued))
+        other = await controller.acquire("bot", "u2")  # 其他用户不受影响
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        self.assertEqual([1], positions)
+
+        controller.release(first)
+        second = await asyncio.wait_for(waiting, 1)
+        self.assertTrue(second.granted)
+        controller.release(second)
+        controller.release(other)
+        self.assertEqual({"running": 0, "waiting": 0, "admitted": 3, "queued": 1, "merged": 0, "rejected": 0}, controller.stats())
+
+    async def test_position_update_failed(self):
+        controller = AdmissionController(global_limit=1)
+        calls = []
+
+        async def on_queued(position):
+            calls.append(position)
+            if len(calls) > 1:
+                raise RuntimeError("card failed")
+
+        running = await controller.acquire("bot", "u1")
+        first = asyncio.create_task(controller.acquire("bot", "u2"))
+        second = asyncio.create_task(controller.acquire("bot", "u3", on_queued=on_queued))
+        await asyncio.sleep(0.01)
+        with mock.patch.object(admission.logger, "opt") as opt:
+            # 排队位置前移时在后台更新卡片，失败时记录日志
+            first.cancel()
+            await asyncio.sleep(0.01)
+            self.assertEqual([2, 1], calls)
+            opt.return_value.warning.assert_called_once()
+        self.assertEqual(set(), admission._position_tasks)
+        controller.release(running)
+        controller.release(await asyncio.wait_for(second, 1))
+
+    async def test_limits_and_reject(self):
+        controller = AdmissionController(global_limit=2, per_user_limit=0, max_queue=1)
+        controller.set_bot_limit("bot1", 1)
+        t1 = await controller.acquire("bot1", "u1")
+        t2 = await controller.acquire("bot2", "u2")
+        waiting = asyncio.create_task(controller.acquire("bot1", "u3"))
+        await asyncio.sleep(0.01)
+        with self.assertRaises(AdmissionRejected):
+            await controller.acquire("bot2", "u4")
+
+        # 释放 bot2 的请求并不能让 bot1 的排队请求运行
+        controller.release(t2)
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        controller.release(t1)
+        controller.release(await asyncio.wait_for(waiting, 1))
+        self.assertEqual(1, controller.stats()["rejected"])
+
+    async def test_merge(self):
+        controller = AdmissionController(per_user_limit=1, per_user_policy="merge")
+        running = await controller.acquire("bot", "u1", query="q1")
+        waiting = asyncio.create_task(controller.acquire("bot", "u1", query="q2"))
+        await asyncio.sleep(0.01)
+        merged = await controller.acquire("bot", "u1", query="q3")
+        self.assertIsNotNone(merged.merged_into)
+
+        controller.release(running)
+        ticket = await asyncio.wait_for(waiting, 1)
+        self.assertEqual(["q3"], ticket.extra_queries)
+        controller.release(ticket)
+
+    async def test_cancel_waiting(self):
+        controller = AdmissionController(global_limit=1)
+        running = await controller.acquire("bot", "u1")
+        waiting = asyncio.create_task(controller.acquire("bot", "u2"))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(0, controller.stats()["waiting"])
+        controller.release(running)
+        self.assertEqual(0, controller.stats()["running"])
+
+    async def test_wake_across_threads(self):
+        # 不同 stream 连接线程各自有事件循环
+        controller = AdmissionController(global_limit=1)
+        running = await controller.acquire("bot", "u1")
+        result = {}
+
+        def other_thread():
+            async def wait():
+                ticket = await controller.acquire("bot", "u2")
+                result["granted"] = ticket.granted
+                controller.release(ticket)
+
+            asyncio.run(wait())
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        await asyncio.sleep(0.05)
+        self.assertEqual({}, result)
+        controller.release(running)
+        await asyncio.to_thread(thread.join, 2)
+        self.assertEqual({"granted": True}, result)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import threading
+import unittest
+
+from core.answer_cache import AnswerCache, normalize_query
+
+
+class TestAnswerCache(unittest.IsolatedAsyncioTestCase):
+
+    def test_key(self):
+        self.assertEqual("每月几号发工资", normalize_query(" 每月几号发工资？ "))
+        self.assertEqual("hello world", normalize_query("Ｈｅｌｌｏ  World!"))
+
+        cache = AnswerCache()
+        key = cache.make_key("bot", "每月几号发工资？", {"sys_user_id": "u1"})
+        self.assertEqual(key, cache.make_key("bot", "每月几号发工资", {"sys_user_id": "u2"}))
+        self.assertNotEqual(key, cache.make_key("other", "每月几号发工资", {"sys_user_id": "u1"}))
+        self.assertNotEqual(key, cache.make_key("bot", "每月几号发工资", {"dept": "hr"}))
+        self.assertNotEqual(key, AnswerCache(ignore_inputs=[]).make_key("bot", "每月几号发工资", {"sys_user_id": "u2"}))
+
+    async def test_lookup_and_single_flight(self):
+        cache = AnswerCache(ttl=60)
+        answer, flight = await cache.lookup("k")
+        self.assertIsNone(answer)
+
+        # 同一问题进行中时，其他请求（包括其他线程的事件循环）等待结果
+        waiter = asyncio.create_task(cache.lookup("k"))
+        other_loop = []
+        thread = threading.Thread(target=lambda: other_loop.append(asyncio.run(cache.lookup("k"))))
+        thread.start()
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiter.done())
+        cache.complete("k", flight, "每月10号")
+        thread.join(1)
+        self.assertEqual(("每月10号", None), await waiter)
+        self.assertEqual([("每月10号", None)], other_loop)
+
+        self.assertEqual(("每月10号", None), await cache.lookup("k"))
+        self.assertEqual({"size": 1, "hits": 1, "coalesced": 2, "misses": 1, "inflight": 0, "hit_ratio": 0.75}, cache.stats())
+
+    async def test_failed_flight(self):
+        cache = AnswerCache(ttl=60)
+        _, flight = await cache.lookup("k")
+        waiter = asyncio.create_task(cache.lookup("k"))
+        await asyncio.sleep(0.01)
+        # 第一个请求失败后，等待者自己成为生成者
+        cache.complete("k", flight, None)
+        answer, new_flight = await waiter
+        self.assertIsNone(answer)
+        self.assertIsNotNone(new_flight)
+        self.assertIsNot(flight, new_flight)
+        cache.complete("k", new_flight, None)
+        self.assertEqual(0, cache.stats()["size"])
+
+    async def test_cancelled_waiter(self):
+        cache = AnswerCache(ttl=60)
+        _, flight = await cache.lookup("k")
+        waiter1 = asyncio.create_task(cache.lookup("k"))
+        waiter2 = asyncio.create_task(cache.lookup("k"))
+        await asyncio.sleep(0.01)
+        # 一个等待者被取消不影响其他等待者和生成者
+        waiter1.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter1
+        self.assertFalse(flight.cancelled())
+        cache.complete("k", flight, "每月10号")
+        self.assertEqual(("每月10号", None), await waiter2)
+        self.assertEqual(("每月10号", None), await cache.lookup("k"))
+
+    async def test_replay(self):
+        cache = AnswerCache(replay_chunk_size=4, replay_interval=0)
+        updates = []
+
+        async def update(content):
+            updates.append(content)
+
+        await cache.replay("0123456789", update)
+        self.assertEqual(["0123", "01234567"], updates)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import unittest
+import uuid
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from dingtalk_stream import ChatbotMessage, Credential
+
+from core.attachments import AttachmentError, AttachmentUploader, extract_attachments, get_message_text, sniff_image
+from core.conversation_store import MemoryConversationStore
+from core.dify_client import AsyncChatClient, ChatClient
+from core.dingtalk_api import close_http_session
+from core.handlers import ATTACHMENT_ONLY_QUERY, DifyAiCardBotHandler
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"p" * 300000
+JPEG = b"\xff\xd8\xff" + b"j" * 1000
+
+
+class FakeDingTalkClient(object):
+    credential = Credential("bot", "secret")
+
+
+class TestExtractAttachments(unittest.TestCase):
+
+    def test_message_types(self):
+        picture = ChatbotMessage.from_dict({"msgtype": "picture", "content": {"downloadCode": "p1"}})
+        self.assertEqual(["p1"], [a.download_code for a in extract_attachments(picture)])
+        self.assertEqual("", get_message_text(picture))
+
+        rich = ChatbotMessage.from_dict(
+            {
+                "msgtype": "richText",
+                "content": {
+                    "richText": [
+                        {"text": "这两张图"},
+                        {"downloadCode": "r1", "type": "picture"},
+                        {"text": "有什么区别"},
+                        {"downloadCode": "r1"},
+                    ]
+                },
+            }
+        )
+        self.assertEqual(["r1"], [a.download_code for a in extract_attachments(rich)])
+        self.assertEqual("这两张图有什么区别", get_message_text(rich))
+
+        file = ChatbotMessage.from_dict({"msgtype": "file", "content": {"downloadCode": "f1", "fileName": "报告.pdf"}})
+        attachments = extract_attachments(file)
+        self.assertEqual("报告.pdf", attachments[0].filename)
+
+        text = ChatbotMessage.from_dict({"msgtype": "text", "text": {"content": "你好"}})
+        self.assertEqual([], extract_attachments(text))
+        self.assertEqual("你好", get_message_text(text))
+
+    def test_build_dify_request(self):
+        handler = DifyAiCardBotHandler(
+            dify_api_client=None, conversation_store=MemoryConversationStore(), attachment_uploader=AttachmentUploader()
+        )
+        picture = ChatbotMessage.from_dict({"msgtype": "picture", "content": {"downloadCode": "p1"}, "senderStaffId": "u"})
+        files = [{"type": "image", "transfer_method": "local_file", "upload_file_id": "f1"}]
+        query, request_kwargs = handler._build_dify_request(picture, None, files=files)
+        self.assertEqual(ATTACHMENT_ONLY_QUERY, query)
+        self.assertEqual(files, request_kwargs["files"])
+
+    def test_sniff_image(self):
+        self.assertEqual(("png", "image/png"), sniff_image(PNG[:16]))
+        self.assertEqual(("jpg", "image/jpeg"), sniff_image(JPEG[:16]))
+        self.assertEqual(("webp", "image/webp"), sniff_image(b"RIFF\x00\x00\x00\x00WEBPVP8 "))
+
+
+class TestAttachmentUploader(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.files = {"a": PNG, "b": PNG, "c": JPEG, "d": b"%PDF-1.4 report"}
+        self.uploads = []
+        self.downloads = 0
+        # 设置后上传请求等待它，用于模拟上传中途取消
+        self.upload_gate = None
+        self.upload_started = asyncio.Event()
+        app = web.Application()
+        app.router.add_post("/v1.0/oauth2/accessToken", self.access_token)
+        app.router.add_post("/v1.0/robot/messageFiles/download", self.download_url)
+        app.router.add_get("/_files/{code}", self.download)
+        app.router.add_post("/v1/files/upload", self.upload)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.endpoint = str(self.server.make_url("")).rstrip("/")
+        patcher = mock.patch("core.dingtalk_api.DINGTALK_OPENAPI_ENDPOINT", self.endpoint)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await close_http_session()
+        await self.server.close()
+
+    async def access_token(self, request: web.Request):
+        return web.json_response({"accessToken": "token", "expireIn": 7200})
+
+    async def download_url(self, request: web.Request):
+        body = await request.json()
+        self.assertEqual("token", request.headers["x-acs-dingtalk-access-token"])
+        return web.json_response({"downloadUrl": f"{self.endpoint}/_files/{body['downloadCode']}"})
+
+    async def download(self, request: web.Request):
+        self.downloads += 1
+        return web.Response(body=self.files[request.match_info["code"]])
+
+    async def upload(self, request: web.Request):
+        self.upload_started.set()
+        if self.upload_gate is not None:
+            await self.upload_gate.wait()
+        form = await request.post()
+        upload = form["file"]
+        self.uploads.append((form["user"], upload.filename, upload.content_type, upload.file.read()))
+        return web.json_response({"id": uuid.uuid4().hex, "name": upload.filename}, status=201)
+
+    def async_client(self) -> AsyncChatClient:
+        client = AsyncChatClient(api_key="app-test", base_url=f"{self.endpoint}/v1")
+        self.addAsyncCleanup(client.close)
+        return client
+
+    def attachments(self, *codes):
+        message = ChatbotMessage.from_dict({"msgtype": "richText", "content": {"richText": [{"downloadCode": c} for c in codes]}})
+        return extract_attachments(message)
+
+    async def _check_upload(self, dify_client):
+        uploader = AttachmentUploader(spool_size=1024)
+        files = await uploader.upload(FakeDingTalkClient(), dify_client, self.attachments("a", "b", "c"), "user-1")
+        # a、b 内容相同，只上传一次
+        self.assertEqual(2, len(self.uploads))
+        self.assertEqual({PNG, JPEG}, {u[3] for u in self.uploads})
+        self.assertEqual({("image.png", "image/png"), ("image.jpg", "image/jpeg")}, {(u[1], u[2]) for u in self.uploads})
+        self.assertEqual(files[0]["upload_file_id"], files[1]["upload_file_id"])
+        self.assertEqual({"type": "image", "transfer_method": "local_file"}, {k: v for k, v in files[2].items() if k != "upload_file_id"})
+
+        # 转发同一张图片不再上传；其他用户需要各自上传
+        again = await uploader.upload(FakeDingTalkClient(), dify_client, self.attachments("b"), "user-1")
+        self.assertEqual(files[0]["upload_file_id"], again[0]["upload_file_id"])
+        self.assertEqual(2, len(self.uploads))
+        await uploader.upload(FakeDingTalkClient(), dify_client, self.attachments("b"), "user-2")
+        self.assertEqual(3, len(self.uploads))
+        stats = uploader.stats()
+        self.assertEqual(3, stats["uploaded"])
+        self.assertEqual(2, stats["reused"])
+
+    async def test_async_client(self):
+        await self._check_upload(self.async_client())
+
+    async def test_sync_client(self):
+        await self._check_upload(ChatClient(api_key="app-test", base_url=f"{self.endpoint}/v1"))
+
+    async def test_file_message(self):
+        uploader = AttachmentUploader()
+        message = ChatbotMessage.from_dict({"msgtype": "file", "content": {"downloadCode": "d", "fileName": "报告.pdf"}})
+        files = await uploader.upload(FakeDingTalkClient(), self.async_client(), extract_attachments(message), "u")
+        self.assertEqual("document", files[0]["type"])
+        self.assertEqual(("报告.pdf", "application/pdf"), self.uploads[0][1:3])
+
+    async def test_max_size(self):
+        uploader = AttachmentUploader(max_size=0.1)
+        client = self.async_client()
+        with self.assertRaises(AttachmentError):
+            await uploader.upload(FakeDingTalkClient(), client, self.attachments("a"), "u")
+        self.assertEqual(1, uploader.stats()["failures"])
+        self.assertEqual([], self.uploads)
+
+    async def _start_shared_upload(self, uploader, client):
+        """先后开始上传相同内容的两个任务，第二个等待第一个的结果"""
+        self.upload_gate = asyncio.Event()
+        leader = asyncio.create_task(uploader.upload(FakeDingTalkClient(), client, self.attachments("a"), "u"))
+        await asyncio.wait_for(self.upload_started.wait(), 5)
+        waiter = asyncio.create_task(uploader.upload(FakeDingTalkClient(), client, self.attachments("b"), "u"))
+        # 等第二个任务下载完，停在第一个任务的上传上
+        while self.downloads < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiter.done())
+        return leader, waiter
+
+    async def test_waiter_cancelled(self):
+        uploader = AttachmentUploader()
+        leader, waiter = await self._start_shared_upload(uploader, self.async_client())
+        # 等待者被取消（例如消息被拒绝、卡片投递失败）不影响正在上传的请求
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.upload_gate.set()
+        files = await leader
+        self.assertEqual(1, len(self.uploads))
+        self.assertIsNotNone(files[0]["upload_file_id"])
+        self.assertEqual(1, uploader.stats()["uploaded"])
+
+    async def test_leader_cancelled(self):
+        uploader = AttachmentUploader()
+        leader, waiter = await self._start_shared_upload(uploader, self.async_client())
+        # 正在上传的请求被取消后，等待者自己上传
+        leader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        self.upload_gate.set()
+        files = await asyncio.wait_for(waiter, 5)
+        self.assertIsNotNone(files[0]["upload_file_id"])
+        self.assertEqual(1, uploader.stats()["uploaded"])
+        self.assertEqual({}, uploader._uploading)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+Cache 的微基准测试：
+    python tests/benchmarks/cache_bench.py [--ops 200000] [--keys 20000] [--size 10000] [--threads 4]
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from core.cache import Cache  # noqa: E402
+
+
+def bench_single(cache: Cache, keys: list, ops: int):
+    begin = time.perf_counter()
+    for i in range(ops):
+        key = keys[i % len(keys)]
+        if cache.get(key) is None:
+            cache.set(key, i)
+    return time.perf_counter() - begin
+
+
+def bench_threads(cache: Cache, keys: list, ops: int, threads: int):
+    per_thread = ops // threads
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        for _ in range(per_thread):
+            key = keys[rnd.randrange(len(keys))]
+            if cache.get(key) is None:
+                cache.set(key, seed)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    begin = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=200000)
+    parser.add_argument("--keys", type=int, default=20000, help="不同用户数")
+    parser.add_argument("--size", type=int, default=10000, help="缓存容量")
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    keys = [f"staff-{i}" for i in range(args.keys)]
+    random.Random(0).shuffle(keys)
+
+    cache = Cache(expiry_time=900, max_size=args.size)
+    cost = bench_single(cache, keys, args.ops)
+    print(
+        f"single thread (cyclic access, LRU worst case): {args.ops / cost:,.0f} ops/s, {cost / args.ops * 1e6:.2f} us/op, stats={cache.stats()}"
+    )
+
+    cache = Cache(expiry_time=900, max_size=args.size)
+    cost = bench_threads(cache, keys, args.ops, args.threads)
+    print(f"{args.threads} threads: {args.ops / cost:,.0f} ops/s, {cost / args.ops * 1e6:.2f} us/op, stats={cache.stats()}")
+
+    cache = Cache(expiry_time=900, max_size=args.keys)
+    for key in keys:
+        cache.set(key, 1)
+    begin = time.perf_counter()
+    cache.cleanup()
+    print(f"cleanup {len(keys)} keys: {(time.perf_counter() - begin) * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+压测用的本地 Dify 与钉钉卡片接口替身，可以单独启动：
+    python tests/benchmarks/fake_servers.py --dify-port 15001 --dingtalk-port 15002 [--token-rate 50] [--answer-tokens 100]
+                                            [--event-mix message=3,agent_log=1] [--failure-rate 0.01] [--disconnect-rate 0.01]
+- Dify：/chat-messages、/completion-messages、/workflows/run，按 token_rate 逐个输出 SSE 事件；/files/upload 记录上传的文件；
+  POST /_script 按提问指定回答长度、首字节等待和输出时长（回放请求日志时使用，见 replay.py）；
+- 钉钉：/v1.0/oauth2/accessToken、/v1.0/card/instances、/v1.0/card/instances/deliver、/v1.0/card/streaming，
+  以及 stream 网关 /v1.0/gateway/connections/open 和它返回的 websocket 地址 /_ws，POST /_push 通过已建立的 websocket 轮流推送机器人消息，
+  机器人消息文件下载 /v1.0/robot/messageFiles/download（downloadCode 对应的下载地址 /_files/{downloadCode} 返回固定大小的内容），
+  超过 --card-qps 时返回 403 限流；按卡片记录创建、投放、首次出现内容、结束的时间（time.time()）以及更新次数和字节数，通过 GET /_stats 读取，POST /_reset 清空。
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import deque
+
+from aiohttp import web
+
+# 生成回答用的字表
+TOKENS = ["钉钉", "机器人", "正在", "回答", "你的", "问题", "，", "这是", "一段", "测试", "内容", "。", "Dify", " stream", " token"]
+
+EVENT_KINDS = ("message", "text_chunk", "agent_log", "node_finished")
+
+
+def parse_event_mix(value: str) -> dict:
+    """message=3,agent_log=1 -> {"message": 3, "agent_log": 1}"""
+    mix = {}
+    for item in filter(None, (value or "").split(",")):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in EVENT_KINDS:
+            raise ValueError(f"不支持的事件类型：{kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class FakeDifyServer(object):
+    """
+    :param token_rate: 每秒输出的 token 数
+    :param answer_tokens: 每个回答的 token 数
+    :param ttfb: 返回响应头之前的等待时间，单位秒
+    :param event_mix: 事件类型及权重，为空时 chat/completion 用 message，workflow 用 text_chunk
+    :param failure_rate: 直接返回 500 的比例
+    :param disconnect_rate: 输出一半后断开连接的比例
+    """
+
+    def __init__(
+        self,
+        token_rate: float = 50,
+        answer_tokens: int = 100,
+        ttfb: float = 0.2,
+        event_mix: dict = None,
+        failure_rate: float = 0,
+        disconnect_rate: float = 0,
+        seed: int = None,
+    ):
+        self.token_rate = token_rate
+        self.answer_tokens = answer_tokens
+        self.ttfb = ttfb
+        self.event_mix = event_mix or {}
+        self.failure_rate = failure_rate
+        self.disconnect_rate = disconnect_rate
+        self._random = random.Random(seed)
+        self.stats = {
+            "requests": 0,
+            "streams": 0,
+            "failures": 0,
+            "disconnects": 0,
+            "events": 0,
+            "stopped": 0,
+            "tokens": 0,
+            "uploads": 0,
+            "files": 0,
+        }
+        self._stopping = {}  # task_id -> asyncio.Event，收到停止请求时设置
+        self.scripts = {}  # 提问 -> {"answer_chars": 回答字数, "ttfb": 首字节等待秒数, "stream_seconds": 输出时长}
+
+    def routes(self) -> list:
+        return [
+            web.post("/chat-messages", self.chat_messages),
+            web.post("/completion-messages", self.completion_messages),
+            web.post("/workflows/run", self.workflows_run),
+            web.post("/chat-messages/{task_id}/stop", self.stop),
+            web.post("/completion-messages/{task_id}/stop", self.stop),
+            web.post("/workflows/tasks/{task_id}/stop", self.stop),
+            web.post("/files/upload", self.upload),
+            web.post("/_script", self.post_script),
+        ]
+
+    async def chat_messages(self, request: web.Request):
+        return await self._handle(request, "message")
+
+    async def completion_messages(self, request: web.Request):
+        return await self._handle(request, "message")
+
+    async def workflows_run(self, request: web.Request):
+        return await self._handle(request, "text_chunk")
+
+    async def upload(self, request: web.Request):
+        form = await request.post()
+        upload = form["file"]
+        self.stats["uploads"] += 1
+        return web.json_response({"id": str(uuid.uuid4()), "name": upload.filename, "size": len(upload.file.read())}, status=201)
+
+    async def post_script(self, request: web.Request):
+        self.scripts.update(await request.json())
+        return web.json_response({"scripts": len(self.scripts)})
+
+    async def stop(self, request: web.Request):
+        event = self._stopping.get(request.match_info["task_id"])
+        if event is not None:
+            event.set()
+        return web.json_response({"result": "success"})
+
+    def _pick_kind(self, default: str) -> str:
+        if not self.event_mix:
+            return default
+        kinds = list(self.event_mix.keys())
+        return self._random.choices(kinds, weights=[self.event_mix[k] for k in kinds])[0]
+
+    def _answer_tokens(self, chars: int = None) -> list:
+        if chars is None:
+            return [self._random.choice(TOKENS) for _ in range(self.answer_tokens)]
+        tokens, length = [], 0
+        while length < chars:
+            token = self._random.choice(TOKENS)[: chars - length]
+            tokens.append(token)
+            length += len(token)
+        return tokens
+
+    async def _handle(self, request: web.Request, default_kind: str):
+        self.stats["requests"] += 1
+        payload = await request.json()
+        self.stats["files"] += len(payload.get("files") or [])
+        script = self.scripts.get(payload.get("query")) or {}
+        ttfb = script.get("ttfb", self.ttfb)
+        if ttfb:
+            await asyncio.sleep(ttfb)
+        if self._random.random() < self.failure_rate:
+            self.stats["failures"] += 1
+            return web.json_response({"code": "internal_server_error", "message": "injected failure"}, status=500)
+
+        conversation_id = payload.get("conversation_id") or str(uuid.uuid4())
+        tokens = self._answer_tokens(script.get("answer_chars"))
+        if payload.get("response_mode") != "streaming":
+            await asyncio.sleep(len(tokens) / self.token_rate)
+            return web.json_response({"event": "message", "answer": "".join(tokens), "conversation_id": conversation_id})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        self.stats["streams"] += 1
+        disconnect_at = len(tokens) // 2 if self._random.random() < self.disconnect_rate else None
+        kind = self._pick_kind(default_kind)
+        interval = 1 / self.token_rate if self.token_rate else 0
+        if script.get("stream_seconds") is not None and tokens:
+            interval = script["stream_seconds"] / len(tokens)
+        ids = {"task_id": str(uuid.uuid4()), "message_id": str(uuid.uuid4()), "conversation_id": conversation_id}
+        stopping = self._stopping[ids["task_id"]] = asyncio.Event()
+
+        async def send(event: dict):
+            self.stats["events"] += 1
+            await response.write(b"data: " + json.dumps(dict(ids, **event), ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+        async def tick(i: int):
+            if disconnect_at is not None and i == disconnect_at:
+                self.stats["disconnects"] += 1
+                request.transport.abort()
+                raise ConnectionResetError("injected disconnect")
+            if interval:
+                await asyncio.sleep(interval)
+
+        try:
+            if kind in ("text_chunk", "node_finished"):
+                await send({"event": "workflow_started", "data": {"id": str(uuid.uuid4())}})
+                node_type = "llm" if kind == "text_chunk" else "agent"
+                await send({"event": "node_started", "data": {"node_type": node_type}})
+            for i, token in enumerate(tokens):
+                await tick(i)
+                if stopping.is_set():
+                    # 停止生成：和 Dify 一样直接结束，只输出已生成的部分
+                    self.stats["stopped"] += 1
+                    tokens = tokens[:i]
+                    break
+                self.stats["tokens"] += 1
+                if kind == "message":
+                    await send({"event": "message", "answer": token})
+                elif kind == "text_chunk":
+                    await send({"event": "text_chunk", "data": {"text": token}})
+                elif kind == "agent_log" and i % 10 == 0:
+                    # 思考过程中的日志，不会显示到卡片上
+                    await send({"event": "agent_log", "data": {"status": "start", "data": {"action": "search"}}})
+            answer = "".join(tokens)
+            if kind == "agent_log":
+                await send(
+                    {"event": "agent_log", "data": {"status": "success", "data": {"action": "Final Answer", "action_input": answer}}}
+                )
+            elif kind == "node_finished":
+                await send({"event": "node_finished", "data": {"node_type": "agent", "outputs": {"text": answer}}})
+            elif kind == "text_chunk":
+                await send({"event": "node_finished", "data": {"node_type": "llm", "outputs": {"text": answer}}})
+            if kind in ("text_chunk", "node_finished"):
+                await send({"event": "workflow_finished", "data": {"outputs": {"text": answer}}})
+            else:
+                await send({"event": "message_end", "metadata": {"usage": {"completion_tokens": len(tokens)}}})
+            await response.write_eof()
+        except ConnectionResetError:
+            pass
+        finally:
+            del self._stopping[ids["task_id"]]
+        return response
+
+
+class FakeDingTalkServer(object):
+    """
+    :param latency: 每个接口的处理延迟，单位秒
+    :param failure_rate: 卡片流式更新返回 500 的比例
+    :param qps: 应用的调用频率限额（卡片和文件接口合计），超过时和钉钉一样返回 403 QpsLimitForApi，0 表示不限制
+    """
+
+    def __init__(self, latency: float = 0.02, failure_rate: float = 0, seed: int = None, qps: float = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.qps = qps
+        self._calls = deque()  # 最近一秒内的调用时间
+        self._random = random.Random(seed)
+        self._websockets = []
+        self._next_websocket = 0
+        self.reset()
+
+    def reset(self):
+        self.cards = {}
+        self.stats = {
+            "tokens": 0,
+            "created": 0,
+            "delivered": 0,
+            "updates": 0,
+            "failed_updates": 0,
+            "finalized": 0,
+            "gateway_opened": 0,
+            "websockets": 0,
+            "throttled": 0,
+            "peak_qps": 0,
+            "pushed": 0,
+            "acked": 0,
+        }
+
+    def routes(self) -> list:
+        return [
+            web.post("/v1.0/oauth2/accessToken", self.access_token),
+            web.post("/v1.0/card/instances", self.create_card),
+            web.post("/v1.0/card/instances/deliver", self.deliver_card),
+            web.put("/v1.0/card/streaming", self.streaming),
+            web.post("/v1.0/gateway/connections/open", self.open_connection),
+            web.post("/v1.0/robot/messageFiles/download", self.file_download_url),
+            web.get("/_files/{code}", self.file_content),
+            web.get("/_ws", self.websocket),
+            web.post("/_push", self.push),
+            web.get("/_stats", self.get_stats),
+            web.post("/_reset", self.post_reset),
+        ]
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _throttled(self) -> bool:
+        now = time.monotonic()
+        while self._calls and now - self._calls[0] >= 1:
+            self._calls.popleft()
+        if self.qps and len(self._calls) >= self.qps:
+            self.stats["throttled"] += 1
+            return True
+        self._calls.append(now)
+        self.stats["peak_qps"] = max(self.stats["peak_qps"], len(self._calls))
+        return False
+
+    @staticmethod
+    def _throttled_response() -> web.Response:
+        return web.json_response({"code": "Forbidden.AccessDenied.QpsLimitForApi", "message": "qps limit"}, status=403)
+
+    async def access_token(self, request: web.Request):
+        await self._delay()
+        self.stats["tokens"] += 1
+        return web.json_response({"accessToken": uuid.uuid4().hex, "expireIn": 7200})
+
+    async def create_card(self, request: web.Request):
+        body = await request.json()
+        if self._throttled():
+            return self._throttled_response()
+        await self._delay()
+        self.stats["created"] += 1
+        self.cards[body["outTrackId"]] = {
+            "created_at": time.time(),
+            "space": None,
+            "delivered_at": None,
+            "first_content_at": None,
+            "finalized_at": None,
+            "updates": 0,
+            "bytes": 0,
+            "failed": False,
+        }
+        return web.json_response({"success": True})
+
+    async def deliver_card(self, request: web.Request):
+        body = await request.json()
+        if self._throttled():
+            return self._throttled_response()
+        await self._delay()
+        card = self.cards.get(body["outTrackId"])
+        if card is None:
+            return web.json_response({"code": "card.notFound"}, status=404)
+        self.stats["delivered"] += 1
+        card["delivered_at"] = time.time()
+        # dtv1.card//IM_GROUP.{conversationId} 或 dtv1.card//IM_ROBOT.{staffId}
+        card["space"] = body.get("openSpaceId", "").rpartition(".")[2]
+        return web.json_response({"success": True})
+
+    async def streaming(self, request: web.Request):
+        body = await request.json()
+        if self._throttled():
+            return self._throttled_response()
+        await self._delay()
+        card = self.cards.get(body["outTrackId"])
+        if card is None:
+            return web.json_response({"code": "card.notFound"}, status=404)
+        if self._random.random() < self.failure_rate:
+            self.stats["failed_updates"] += 1
+            return web.json_response({"code": "internal_error", "message": "injected failure"}, status=500)
+        self.stats["updates"] += 1
+        card["updates"] += 1
+        card["bytes"] += len(body.get("content", "").encode("utf-8"))
+        if body.get("content") and card["first_content_at"] is None:
+            card["first_content_at"] = time.time()
+        if body.get("isFinalize"):
+            self.stats["finalized"] += 1
+            card["finalized_at"] = time.time()
+            card["failed"] = bool(body.get("isError"))
+        return web.json_response({"success": True})
+
+    async def open_connection(self, request: web.Request):
+        await self._delay()
+        self.stats["gateway_opened"] += 1
+        endpoint = f"ws://{request.host}/_ws"
+        return web.json_response({"endpoint": endpoint, "ticket": uuid.uuid4().hex})
+
+    async def file_download_url(self, request: web.Request):
+        body = await request.json()
+        if self._throttled():
+            return self._throttled_response()
+        await self._delay()
+        return web.json_response({"downloadUrl": f"http://{request.host}/_files/{body['downloadCode']}"})
+
+    async def file_content(self, request: web.Request):
+        # 内容只由 downloadCode 决定，同一个 code 重复下载得到相同的内容
+        code = request.match_info["code"]
+        return web.Response(body=b"\x89PNG\r\n\x1a\n" + code.encode("utf-8") * (200 * 1024 // max(1, len(code))), content_type="image/png")
+
+    async def websocket(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.stats["websockets"] += 1
+        self._websockets.append(ws)
+        try:
+            # 客户端的 ping 由 aiohttp 自动回复，收到的只有消息的 ack
+            async for _ in ws:
+                self.stats["acked"] += 1
+        finally:
+            self._websockets.remove(ws)
+            self.stats["websockets"] -= 1
+        return ws
+
+    @staticmethod
+    def _callback_frame(message_id: str, sender: str, content: str) -> str:
+        data = {
+            # 群聊，用 conversationId 把卡片对应回消息
+            "conversationId": f"bench-{message_id}",
+            "conversationType": "2",
+            "chatbotCorpId": "bench-corp",
+            "chatbotUserId": "bench-bot",
+            "msgId": message_id,
+            "senderNick": sender,
+            "senderStaffId": sender,
+            "senderId": sender,
+            "senderCorpId": "bench-corp",
+            "isAdmin": False,
+            "robotCode": "bench",
+            "createAt": int(time.time() * 1000),
+            "sessionWebhook": "http://127.0.0.1/unused",
+            "sessionWebhookExpiredTime": int(time.time() * 1000) + 3600000,
+            "msgtype": "text",
+            "text": {"content": content},
+        }
+        headers = {
+            "topic": "/v1.0/im/bot/messages/get",
+            "messageId": message_id,
+            "contentType": "application/json",
+            "time": str(int(time.time() * 1000)),
+        }
+        return json.dumps({"specVersion": "1.0", "type": "CALLBACK", "headers": headers, "data": json.dumps(data, ensure_ascii=False)})
+
+    async def push(self, request: web.Request):
+        """{"count": 消息数, "senders": 发送人数, "query": 问题}，和钉钉一样把消息轮流推送给应用的各个连接"""
+        body = await request.json()
+        if not self._websockets:
+            return web.json_response({"code": "no_connection"}, status=400)
+        message_ids = []
+        for i in range(int(body.get("count", 1))):
+            message_id = uuid.uuid4().hex
+            sender = f"bench-user-{i % max(1, int(body.get('senders', 1)))}"
+            ws = self._websockets[self._next_websocket % len(self._websockets)]
+            self._next_websocket += 1
+            await ws.send_str(self._callback_frame(message_id, sender, f"{body.get('query', '你好')} #{i}"))
+            self.stats["pushed"] += 1
+            message_ids.append(message_id)
+        return web.json_response({"messageIds": message_ids})
+
+    async def get_stats(self, request: web.Request):
+        return web.json_response({"stats": self.stats, "cards": self.cards})
+
+    async def post_reset(self, request: web.Request):
+        websockets = self.stats["websockets"]
+        self.reset()
+        # 保持着的连接不受影响
+        self.stats["websockets"] = websockets
+        return web.json_response({"success": True})
+
+
+async def start_server(routes: list, host: str, port: int) -> web.AppRunner:
+    app = web.Application(client_max_size=10 * 1024 * 1024)
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--token-rate", type=float, default=50, help="Dify每秒输出的token数")
+    parser.add_argument("--answer-tokens", type=int, default=100, help="每个回答的token数")
+    parser.add_argument("--ttfb", type=float, default=0.2, help="Dify返回响应头前的等待时间，秒")
+    parser.add_argument("--event-mix", default="", help="事件类型及权重，如 message=3,agent_log=1")
+    parser.add_argument("--failure-rate", type=float, default=0, help="Dify直接返回500的比例")
+    parser.add_argument("--disconnect-rate", type=float, default=0, help="Dify输出一半后断开的比例")
+    parser.add_argument("--card-latency", type=float, default=0.02, help="钉钉接口的处理延迟，秒")
+    parser.add_argument("--card-failure-rate", type=float, default=0, help="钉钉卡片更新返回500的比例")
+    parser.add_argument("--card-qps", type=float, default=0, help="钉钉接口的调用频率限额，超过时返回403限流，0表示不限制")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def server_arguments(args: argparse.Namespace) -> list:
+    """把解析后的参数还原成命令行，用于在子进程中启动替身服务"""
+    return [
+        f"--token-rate={args.token_rate}",
+        f"--answer-tokens={args.answer_tokens}",
+        f"--ttfb={args.ttfb}",
+        f"--event-mix={args.event_mix}",
+        f"--failure-rate={args.failure_rate}",
+        f"--disconnect-rate={args.disconnect_rate}",
+        f"--card-latency={args.card_latency}",
+        f"--card-failure-rate={args.card_failure_rate}",
+        f"--card-qps={args.card_qps}",
+    ] + ([f"--seed={args.seed}"] if args.seed is not None else [])
+
+
+async def serve(args: argparse.Namespace):
+    dify = FakeDifyServer(
+        token_rate=args.token_rate,
+        answer_tokens=args.answer_tokens,
+        ttfb=args.ttfb,
+        event_mix=parse_event_mix(args.event_mix),
+        failure_rate=args.failure_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+    )
+    dingtalk = FakeDingTalkServer(latency=args.card_latency, failure_rate=args.card_failure_rate, seed=args.seed, qps=args.card_qps)
+    await start_server(dify.routes(), args.host, args.dify_port)
+    await start_server(dingtalk.routes(), args.host, args.dingtalk_port)
+    print(f"fake dify: http://{args.host}:{args.dify_port}, fake dingtalk: http://{args.host}:{args.dingtalk_port}", flush=True)
+    while True:
+        await asyncio.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--dify-port", type=int, default=15001)
+    parser.add_argument("--dingtalk-port", type=int, default=15002)
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
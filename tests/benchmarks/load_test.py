@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+离线压测：在子进程中启动本地 Dify 与钉钉替身（见 fake_servers.py），用合成的钉钉消息驱动 DifyAiCardBotHandler。
+    python tests/benchmarks/load_test.py [--messages 200] [--concurrency 20] [--app chatbot] [--client async]
+                                         [--card-mode coalesce] [--append] [--token-rate 50] [--json result.json]
+                                         [--card-qps 20 --rate-limit 18]
+每个并发用户发完一条消息、等卡片更新结束后再发下一条。输出吞吐、ack/卡片投放/首段内容/总耗时的 p50/p99、
+每个回答的卡片更新次数以及本进程的峰值常驻内存，--json 保存结果便于在不同提交之间对比。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import uuid
+import urllib.request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_servers  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"fake server on port {port} did not start")
+
+
+def fetch_json(url: str, method: str = "GET") -> dict:
+    request = urllib.request.Request(url, method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def post_json(url: str, body: dict) -> dict:
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def build_callback(worker: int, seq: int, query: str, distinct_queries: int = 0):
+    from dingtalk_stream import CallbackMessage
+
+    message_id = uuid.uuid4().hex
+    callback = CallbackMessage()
+    callback.headers.message_id = message_id
+    callback.data = {
+        # 群聊，用 conversationId 在钉钉替身里把卡片对应回消息
+        "conversationId": f"bench-{message_id}",
+        "conversationType": "2",
+        "chatbotCorpId": "bench-corp",
+        "chatbotUserId": "bench-bot",
+        "msgId": message_id,
+        "senderNick": f"bench-user-{worker}",
+        "senderStaffId": f"bench-user-{worker}",
+        "senderId": f"bench-user-{worker}",
+        "senderCorpId": "bench-corp",
+        "isAdmin": False,
+        "robotCode": "bench",
+        "createAt": int(time.time() * 1000),
+        "sessionWebhook": "http://127.0.0.1/unused",
+        "sessionWebhookExpiredTime": int(time.time() * 1000) + 3600000,
+        "msgtype": "text",
+        "text": {"content": f"{query} #{seq % distinct_queries if distinct_queries else seq}"},
+    }
+    return message_id, callback
+
+
+async def run_load(args: argparse.Namespace, dify_url: str) -> dict:
+    # 延迟导入：钉钉 SDK 在导入时读取 DINGTALK_OPENAPI_ENDPOINT
+    import dingtalk_stream
+
+    from app import DIFY_CLIENT_CLASSES
+    from core.admission import AdmissionController
+    from core.answer_cache import AnswerCache
+    from core.dedup import MessageDeduplicator
+    from core.dingtalk_api import close_http_session, get_dingtalk_app
+    from core.handlers import DifyAiCardBotHandler
+    from core.log import setup_logging
+
+    setup_logging(level=args.log_level, enqueue=args.log_enqueue, sample_rate=args.log_sample_rate, stream=sys.stderr)
+
+    loop = asyncio.get_running_loop()
+    done = {}  # message_id -> Future，卡片更新结束时完成
+
+    class _TrackingDeduplicator(MessageDeduplicator):
+        def complete(self, message_id: str):
+            super().complete(message_id)
+            future = done.get(message_id)
+            if future is not None:
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(time.time()))
+
+    client = DIFY_CLIENT_CLASSES[(args.app, args.client)](api_key="app-bench", base_url=dify_url, pool_size=args.concurrency)
+    admission_controller = None
+    if args.global_limit:
+        admission_controller = AdmissionController(global_limit=args.global_limit)
+    handler = DifyAiCardBotHandler(
+        client,
+        card_update_conf={"mode": args.card_mode, "append": args.append},
+        deduplicator=_TrackingDeduplicator(),
+        admission_controller=admission_controller,
+        bot_name="bench",
+        answer_cache=AnswerCache() if args.answer_cache else None,
+        card_conf={"pool_size": args.card_pool},
+    )
+    handler.dingtalk_client = dingtalk_stream.DingTalkStreamClient(dingtalk_stream.Credential("bench", "bench"))
+    dingtalk_app = get_dingtalk_app(handler.dingtalk_client.credential)
+    dingtalk_app.configure(qps=args.rate_limit)
+
+    results = {}  # message_id -> {sent, ack, completed}
+    counter = iter(range(args.messages))
+
+    async def worker(n: int):
+        for seq in counter:
+            message_id, callback = build_callback(n, seq, args.query, args.distinct_queries)
+            done[message_id] = loop.create_future()
+            sent = time.time()
+            await handler.process(callback)
+            ack = time.time()
+            try:
+                completed = await asyncio.wait_for(done[message_id], args.timeout)
+            except asyncio.TimeoutError:
+                completed = None
+            results[message_id] = {"sent": sent, "ack": ack, "completed": completed}
+
+    begin = time.monotonic()
+    await asyncio.gather(*(worker(n) for n in range(args.concurrency)))
+    elapsed = time.monotonic() - begin
+    if hasattr(client, "close"):
+        await client.close()
+    await close_http_session()
+    return {
+        "elapsed": elapsed,
+        "results": results,
+        "answer_cache": handler.answer_cache.stats() if handler.answer_cache else None,
+        "rate_limiter": dingtalk_app.stats(),
+    }
+
+
+def summarize(args: argparse.Namespace, load: dict, dingtalk_stats: dict) -> dict:
+    results = load["results"]
+    cards = {card["space"].replace("bench-", "", 1): card for card in dingtalk_stats["cards"].values() if card["space"]}
+    ack, to_card, first_token, total, updates, update_bytes = [], [], [], [], [], []
+    failed = timeouts = 0
+    for message_id, r in results.items():
+        ack.append(r["ack"] - r["sent"])
+        if r["completed"] is None:
+            timeouts += 1
+        else:
+            total.append(r["completed"] - r["sent"])
+        card = cards.get(message_id)
+        if card is None:
+            failed += 1
+            continue
+        if card["delivered_at"]:
+            to_card.append(card["delivered_at"] - r["sent"])
+        if card["first_content_at"]:
+            first_token.append(card["first_content_at"] - r["sent"])
+        if card["failed"] or not card["finalized_at"]:
+            failed += 1
+        updates.append(card["updates"])
+        update_bytes.append(card["bytes"])
+
+    def p(values):
+        return {"p50": percentile(values, 50), "p99": percentile(values, 99)}
+
+    return {
+        "revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "log_level", "log_enqueue", "log_sample_rate")},
+        "messages": len(results),
+        "elapsed": load["elapsed"],
+        "messages_per_sec": len(results) / load["elapsed"] if load["elapsed"] else 0,
+        "failed": failed,
+        "timeouts": timeouts,
+        "ack": p(ack),
+        "time_to_card": p(to_card),
+        "first_token": p(first_token),
+        "total": p(total),
+        "card_updates_per_answer": sum(updates) / len(updates) if updates else 0,
+        "card_bytes_per_answer": sum(update_bytes) / len(update_bytes) if update_bytes else 0,
+        "card_api": dingtalk_stats["stats"],
+        "answer_cache": load["answer_cache"],
+        "rate_limiter": load["rate_limiter"],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_summary(summary: dict):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    print(f"revision={summary['revision']} messages={summary['messages']} failed={summary['failed']} timeouts={summary['timeouts']}")
+    print(f"throughput: {summary['messages_per_sec']:.2f} msg/s in {summary['elapsed']:.1f}s")
+    for name in ("ack", "time_to_card", "first_token", "total"):
+        print(f"{name:>13}: p50={ms(summary[name]['p50'])} p99={ms(summary[name]['p99'])}")
+    print(f"card updates/answer: {summary['card_updates_per_answer']:.1f}, bytes/answer: {summary['card_bytes_per_answer']:.0f}")
+    card_api = summary["card_api"]
+    print(f"card api: peak {card_api['peak_qps']}/s, throttled {card_api['throttled']}, rate limiter: {summary['rate_limiter']}")
+    if summary["answer_cache"]:
+        print(f"answer cache: {summary['answer_cache']}")
+    print(f"peak rss: {summary['peak_rss_mb']:.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--app", choices=["chatbot", "completion", "workflow"], default="chatbot")
+    parser.add_argument("--client", choices=["sync", "async"], default="async")
+    parser.add_argument("--card-mode", choices=["coalesce", "immediate"], default="coalesce")
+    parser.add_argument("--append", action="store_true", help="卡片增量追加")
+    parser.add_argument("--card-pool", type=int, default=0, help="预创建的卡片数量")
+    parser.add_argument("--global-limit", type=int, default=0, help="开启准入控制时的全局并发数")
+    parser.add_argument("--query", default="你好，请介绍一下你自己")
+    parser.add_argument("--distinct-queries", type=int, default=0, help="不同问题的数量，0表示每条消息都不同")
+    parser.add_argument("--answer-cache", action="store_true", help="开启回答缓存（completion/workflow）")
+    parser.add_argument("--rate-limit", type=float, default=0, help="钉钉接口调用频率限制（dingtalk_rate_limit.qps），0表示不限制")
+    parser.add_argument("--timeout", type=float, default=120, help="单条消息最长等待时间，秒")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--log-enqueue", action="store_true", help="日志由后台线程写入，见 LOG_ENQUEUE")
+    parser.add_argument("--log-sample-rate", type=float, default=1, help="逐事件 debug 日志的采样比例")
+    parser.add_argument("--json", help="把结果保存到文件")
+    fake_servers.add_arguments(parser)
+    args = parser.parse_args()
+
+    dify_port, dingtalk_port = free_port(), free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_servers.py"),
+            f"--dify-port={dify_port}",
+            f"--dingtalk-port={dingtalk_port}",
+        ]
+        + fake_servers.server_arguments(args),
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(dify_port)
+        wait_for_port(dingtalk_port)
+        dingtalk_url = f"http://127.0.0.1:{dingtalk_port}"
+        os.environ["DINGTALK_OPENAPI_ENDPOINT"] = dingtalk_url
+        os.environ.setdefault("DINGTALK_AI_CARD_TEMPLATE_ID", "bench-template")
+        os.environ.setdefault("DIFY_CONVERSATION_REMAIN_TIME", "15")
+
+        load = asyncio.run(run_load(args, f"http://127.0.0.1:{dify_port}"))
+        summary = summarize(args, load, fetch_json(dingtalk_url + "/_stats"))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
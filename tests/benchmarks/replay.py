@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+回放请求日志（JOURNAL_ENABLED，见 core/journal.py）：在子进程中启动本地 Dify 与钉钉替身（见 fake_servers.py），
+按记录中的收到时间把每条记录还原成钉钉消息交给 DifyAiCardBotHandler，--speed 大于 1 时按比例压缩消息间隔；
+Dify 替身按记录的回答长度、首字节等待和输出时长回答（POST /_script），复现线上的到达分布、并发和回答长度。
+同一用户（用户 id 哈希相同）的消息仍然按准入控制排队；附件只回放文字部分，消息都按群聊发送以便在替身中对应卡片。
+    python tests/benchmarks/replay.py data/journal/requests.jsonl [requests.worker1.jsonl ...] [--speed 10] [--limit 1000]
+                                      [--bot name] [--app chatbot] [--client async] [--global-limit 0] [--json result.json]
+输出与 load_test.py 相同的吞吐和耗时统计、回放期间的峰值并发，以及原始记录的首段内容、总耗时供对比。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_servers  # noqa: E402
+from load_test import fetch_json, free_port, percentile, post_json, print_summary, summarize, wait_for_port  # noqa: E402
+
+from core.journal import read_journal  # noqa: E402
+
+# 回答缓存命中等没有调用 Dify 的记录，回放时仍然会调用替身，按这些默认值回答
+DEFAULT_TTFB = 0.2
+DEFAULT_STREAM_SECONDS = 2.0
+
+
+def load_records(paths: list, bot: str = None, limit: int = 0) -> list:
+    """读取各文件（含轮转文件）中的记录，按收到时间排序"""
+    records = [r for path in paths for r in read_journal(path) if r.get("ts") is not None and (not bot or r.get("bot") == bot)]
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+
+def replay_query(record: dict, seq: int) -> str:
+    """还原提问，加上序号使每条消息的提问不同，替身按提问找到对应的回答脚本"""
+    query = record.get("query")
+    if query is None:
+        query = "问" * max(1, record.get("query_chars") or 1)
+    if record.get("status") == "stop":
+        # 停止指令要原样发送
+        return query
+    return f"{query} #{seq}"
+
+
+def build_script(record: dict) -> dict:
+    """从记录的耗时中估算 Dify 的首字节等待和输出时长"""
+    timings = record.get("timings") or {}
+    script = {"answer_chars": max(1, record.get("answer_chars") or 1), "ttfb": DEFAULT_TTFB, "stream_seconds": DEFAULT_STREAM_SECONDS}
+    if "dify_response" in timings:
+        script["ttfb"] = max(0.0, timings["dify_response"] - timings.get("dify_request", timings["dify_response"]))
+        script["stream_seconds"] = max(0.0, timings.get("finished", timings["dify_response"]) - timings["dify_response"])
+    return script
+
+
+def build_callback(record: dict, query: str):
+    from dingtalk_stream import CallbackMessage
+
+    message_id = uuid.uuid4().hex
+    user = record.get("user") or "replay"
+    callback = CallbackMessage()
+    callback.headers.message_id = message_id
+    callback.data = {
+        "conversationId": f"bench-{message_id}",
+        "conversationType": "2",
+        "chatbotCorpId": "bench-corp",
+        "chatbotUserId": "bench-bot",
+        "msgId": message_id,
+        "senderNick": user,
+        "senderStaffId": user,
+        "senderId": user,
+        "senderCorpId": "bench-corp",
+        "isAdmin": False,
+        "robotCode": "bench",
+        "createAt": int(time.time() * 1000),
+        "sessionWebhook": "http://127.0.0.1/unused",
+        "sessionWebhookExpiredTime": int(time.time() * 1000) + 3600000,
+        "msgtype": "text",
+        "text": {"content": query},
+    }
+    return message_id, callback
+
+
+async def run_replay(args: argparse.Namespace, records: list, dify_url: str) -> dict:
+    # 延迟导入：钉钉 SDK 在导入时读取 DINGTALK_OPENAPI_ENDPOINT
+    import dingtalk_stream
+
+    from app import DIFY_CLIENT_CLASSES
+    from core.admission import AdmissionController
+    from core.dedup import MessageDeduplicator
+    from core.dingtalk_api import close_http_session, get_dingtalk_app
+    from core.handlers import DifyAiCardBotHandler
+    from core.log import setup_logging
+
+    setup_logging(level=args.log_level, stream=sys.stderr)
+
+    loop = asyncio.get_running_loop()
+    done = {}  # message_id -> Future，卡片更新结束时完成
+
+    class _TrackingDeduplicator(MessageDeduplicator):
+        def complete(self, message_id: str):
+            super().complete(message_id)
+            future = done.get(message_id)
+            if future is not None:
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(time.time()))
+
+    admission_controller = AdmissionController(global_limit=args.global_limit) if args.global_limit else AdmissionController()
+    handlers, clients = {}, []
+    for bot in sorted({r.get("bot") or "bench" for r in records}):
+        client = DIFY_CLIENT_CLASSES[(args.app, args.client)](api_key="app-bench", base_url=dify_url, pool_size=args.pool_size)
+        clients.append(client)
+        handler = DifyAiCardBotHandler(
+            client, deduplicator=_TrackingDeduplicator(), admission_controller=admission_controller, bot_name=bot
+        )
+        handler.dingtalk_client = dingtalk_stream.DingTalkStreamClient(dingtalk_stream.Credential("bench", "bench"))
+        handlers[bot] = handler
+    dingtalk_app = get_dingtalk_app(dingtalk_stream.Credential("bench", "bench"))
+    dingtalk_app.configure(qps=args.rate_limit)
+
+    results = {}  # message_id -> {sent, ack, completed}
+    peak = {"inflight": 0}
+
+    async def send(handler, callback, message_id: str):
+        done[message_id] = loop.create_future()
+        sent = time.time()
+        await handler.process(callback)
+        ack = time.time()
+        try:
+            completed = await asyncio.wait_for(done[message_id], args.timeout)
+        except asyncio.TimeoutError:
+            completed = None
+        results[message_id] = {"sent": sent, "ack": ack, "completed": completed}
+
+    async def sample_inflight():
+        while True:
+            peak["inflight"] = max(peak["inflight"], sum(h.inflight() for h in handlers.values()))
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_inflight())
+    tasks = []
+    first_ts = records[0]["ts"] if records else 0
+    begin = time.monotonic()
+    for seq, record in enumerate(records):
+        # 按原始间隔（除以 speed）发送，处理不过来时不追赶，直接依次发送
+        delay = (record["ts"] - first_ts) / args.speed - (time.monotonic() - begin)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message_id, callback = build_callback(record, replay_query(record, seq))
+        tasks.append(asyncio.create_task(send(handlers[record.get("bot") or "bench"], callback, message_id)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - begin
+    sampler.cancel()
+    for client in clients:
+        if hasattr(client, "close"):
+            await client.close()
+    await close_http_session()
+    return {
+        "elapsed": elapsed,
+        "results": results,
+        "answer_cache": None,
+        "rate_limiter": dingtalk_app.stats(),
+        "peak_inflight": peak["inflight"],
+    }
+
+
+def original_summary(records: list) -> dict:
+    """原始记录的耗时与状态分布，与回放结果对比"""
+    first_token = [r["timings"]["first_token"] for r in records if "first_token" in (r.get("timings") or {})]
+    total = [r["timings"]["finished"] for r in records if "finished" in (r.get("timings") or {})]
+    statuses = {}
+    for r in records:
+        statuses[r.get("status")] = statuses.get(r.get("status"), 0) + 1
+    span = records[-1]["ts"] - records[0]["ts"] if len(records) > 1 else 0
+    return {
+        "messages": len(records),
+        "span_seconds": round(span, 1),
+        "statuses": statuses,
+        "first_token": {"p50": percentile(first_token, 50), "p99": percentile(first_token, 99)},
+        "total": {"p50": percentile(total, 50), "p99": percentile(total, 99)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="请求日志文件，轮转后的文件会一起读取")
+    parser.add_argument("--speed", type=float, default=1, help="回放倍速，10表示消息间隔缩短为原来的1/10")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放多少条，0表示全部")
+    parser.add_argument("--bot", default="", help="只回放该机器人的记录")
+    parser.add_argument("--app", choices=["chatbot", "completion", "workflow"], default="chatbot")
+    parser.add_argument("--client", choices=["sync", "async"], default="async")
+    parser.add_argument("--pool-size", type=int, default=100, help="调用Dify替身的连接池大小")
+    parser.add_argument("--global-limit", type=int, default=0, help="开启准入控制时的全局并发数")
+    parser.add_argument("--rate-limit", type=float, default=0, help="钉钉接口调用频率限制（dingtalk_rate_limit.qps），0表示不限制")
+    parser.add_argument("--timeout", type=float, default=300, help="单条消息最长等待时间，秒")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="把结果保存到文件")
+    fake_servers.add_arguments(parser)
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed 必须大于0")
+
+    records = load_records(args.paths, args.bot, args.limit)
+    if not records:
+        parser.error("没有可以回放的记录")
+
+    dify_port, dingtalk_port = free_port(), free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_servers.py"),
+            f"--dify-port={dify_port}",
+            f"--dingtalk-port={dingtalk_port}",
+        ]
+        + fake_servers.server_arguments(args),
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(dify_port)
+        wait_for_port(dingtalk_port)
+        dify_url, dingtalk_url = f"http://127.0.0.1:{dify_port}", f"http://127.0.0.1:{dingtalk_port}"
+        scripts = {replay_query(r, seq): build_script(r) for seq, r in enumerate(records)}
+        post_json(dify_url + "/_script", scripts)
+        os.environ["DINGTALK_OPENAPI_ENDPOINT"] = dingtalk_url
+        os.environ.setdefault("DINGTALK_AI_CARD_TEMPLATE_ID", "bench-template")
+        os.environ.setdefault("DIFY_CONVERSATION_REMAIN_TIME", "15")
+
+        replay = asyncio.run(run_replay(args, records, dify_url))
+        summary = summarize(args, replay, fetch_json(dingtalk_url + "/_stats"))
+    finally:
+        server.terminate()
+        server.wait()
+
+    summary["config"].pop("paths", None)
+    summary["journal"] = args.paths
+    summary["peak_inflight"] = replay["peak_inflight"]
+    summary["original"] = original_summary(records)
+    print_summary(summary)
+    original = summary["original"]
+    print(f"peak inflight: {summary['peak_inflight']}")
+    print(f"original: {original['messages']} messages over {original['span_seconds']}s, statuses={original['statuses']}")
+    for name in ("first_token", "total"):
+        values = original[name]
+        print(f"{'original ' + name:>22}: p50={values['p50']} p99={values['p99']} (s)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+SSE 解析的 CPU 基准：对比原来的 sseclient + 每个事件完整 json.loads + if 链，与 core.sse 的预过滤分发。
+    python tests/benchmarks/sse_bench.py [--streams 200] [--nodes 40] [--tokens 300] [--payload 4096] [--chunk 1024]
+模拟长 agent 工作流：大量 node_started/node_finished/agent_thought（带较大的工具输入输出）夹杂逐 token 的 message 事件。
+对比用的 sseclient 不再是运行依赖，先 pip install -r tests/benchmarks/requirements.txt
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+os.environ.setdefault("DIFY_CONVERSATION_REMAIN_TIME", "15")
+
+from loguru import logger  # noqa: E402
+from sseclient import SSEClient  # noqa: E402
+
+from core.handlers import DifyAiCardBotHandler, _StreamState  # noqa: E402
+from core.log import setup_logging  # noqa: E402
+from core.sse import SSEDecoder  # noqa: E402
+
+
+def build_stream(nodes: int, tokens: int, payload: int) -> bytes:
+    blob = "x" * payload
+
+    def event(d: dict) -> str:
+        return "data: " + json.dumps(dict(d, task_id="t", conversation_id="c"), ensure_ascii=False) + "\n\n"
+
+    parts = [event({"event": "workflow_started", "data": {"inputs": {"blob": blob}}})]
+    for i in range(nodes):
+        parts.append(event({"event": "node_started", "data": {"node_type": "tool", "inputs": {"blob": blob}}}))
+        parts.append(event({"event": "agent_thought", "thought": blob, "tool_input": blob, "observation": blob}))
+        parts.append(event({"event": "node_finished", "data": {"node_type": "tool", "outputs": {"blob": blob}}}))
+    for i in range(tokens):
+        parts.append(event({"event": "message", "answer": "回答"}))
+    parts.append(event({"event": "message_end", "metadata": {}}))
+    parts.append(event({"event": "workflow_finished", "data": {"outputs": {"blob": blob}}}))
+    return "".join(parts).encode("utf-8")
+
+
+def legacy_loop(chunks: list) -> str:
+    # 原来 _call_dify_with_stream 的处理方式（只保留影响开销的部分）
+    full_content, length = "", 0
+    final_hash = None
+    for event in SSEClient(iter(chunks)).events():
+        try:
+            r = json.loads(event.data)
+        except Exception:
+            continue
+        logger.debug(f"接收到模型服务返回：{r}")
+        evt = r.get("event")
+        if evt in ["message", "agent_message"]:
+            delta = r.get("answer", "")
+            if delta:
+                full_content += delta
+                if len(full_content) - length > 10:
+                    logger.debug(f"调用流式接口更新内容：message/agent_message, current_length={length}, next_length={len(full_content)}")
+                    length = len(full_content)
+            continue
+        if evt in ["text_chunk"]:
+            continue
+        if evt == "agent_log":
+            continue
+        if evt == "node_finished":
+            data = r.get("data") or {}
+            if data.get("node_type") == "agent":
+                text = (data.get("outputs") or {}).get("text")
+                if text and hashlib.md5(text.encode("utf-8")).hexdigest() != final_hash:
+                    full_content += text
+            continue
+        if evt in [
+            "agent_thought",
+            "message_file",
+            "workflow_started",
+            "workflow_finished",
+            "node_started",
+            "parallel_branch_started",
+            "parallel_branch_message",
+            "parallel_branch_finished",
+        ]:
+            logger.debug(f"Ignoring event: {evt}")
+            continue
+    return full_content
+
+
+def fast_loop(handler: DifyAiCardBotHandler, chunks: list, incoming_message) -> str:
+    state = _StreamState()
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        for event in decoder.feed(chunk):
+            handler._handle_stream_event(event.raw, state, incoming_message)
+    for event in decoder.flush():
+        handler._handle_stream_event(event.raw, state, incoming_message)
+    return state.full_content
+
+
+class _Message:
+    sender_staff_id = "bench-user"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--nodes", type=int, default=40)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--payload", type=int, default=4096, help="每个工作流事件中大字段的字节数")
+    parser.add_argument("--chunk", type=int, default=1024, help="网络分块大小")
+    args = parser.parse_args()
+
+    setup_logging(level="INFO", stream=sys.stderr)
+
+    stream = build_stream(args.nodes, args.tokens, args.payload)
+    chunks = [stream[i : i + args.chunk] for i in range(0, len(stream), args.chunk)]
+    handler = DifyAiCardBotHandler(dify_api_client=None)
+    incoming_message = _Message()
+    print(f"stream size: {len(stream) / 1024:.0f}KB, events: {stream.count(b'data: ')}, chunks: {len(chunks)}")
+
+    assert legacy_loop(chunks) == fast_loop(handler, chunks, incoming_message)
+    results = {}
+    for name, func in (("sseclient", lambda: legacy_loop(chunks)), ("core.sse", lambda: fast_loop(handler, chunks, incoming_message))):
+        begin = time.process_time()
+        for _ in range(args.streams):
+            func()
+        cost = time.process_time() - begin
+        results[name] = cost
+        print(f"{name:>10}: {cost:.3f}s cpu, {cost / args.streams * 1000:.2f}ms/stream")
+    print(f"speedup: {results['sseclient'] / results['core.sse']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
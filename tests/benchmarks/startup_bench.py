@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+冷启动基准：启动钉钉替身（含 stream 网关，见 fake_servers.py），在临时目录生成有 N 个机器人的 .bots.yaml，
+多次以子进程运行 app.py，解析它输出的 startup_summary，统计进程启动到第一个、全部 stream 连接就绪的时间。
+    python tests/benchmarks/startup_bench.py [--bots 4] [--runs 5] [--mode threads] [--gateway-latency 0.05] [--json result.json]
+"""
+
+import argparse
+import ast
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import free_port, git_revision, percentile, wait_for_port  # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+SUMMARY_RE = re.compile(r"(\{'startup_summary': .*\})\s*$")
+
+
+def write_bots_config(workdir: str, bots: int):
+    lines = ["bots:"]
+    for i in range(bots):
+        lines += [
+            f"  - name: bench-{i}",
+            f"    dingtalk_app_client_id: bench-{i}",
+            f"    dingtalk_app_client_secret: bench-{i}",
+            "    dify_app_type: chatbot",
+            f"    dify_app_api_key: app-bench-{i}",
+            "    handler: DifyAiCardBotHandler",
+        ]
+    with open(os.path.join(workdir, ".bots.yaml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def run_once(args: argparse.Namespace, workdir: str, endpoint: str) -> dict:
+    env = {"DIFY_CONVERSATION_REMAIN_TIME": "15", "DINGTALK_AI_CARD_TEMPLATE_ID": "bench.schema"}
+    env.update(os.environ)
+    env.update(
+        DINGTALK_OPENAPI_ENDPOINT=endpoint,
+        RUNTIME_MODE=args.mode,
+        BOTS_CONFIG_RELOAD_INTERVAL="0",
+        METRICS_ENABLED="false",
+        LOG_LEVEL="INFO",
+    )
+    begin = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "app.py")], cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    summary = None
+    try:
+        for line in proc.stdout:
+            match = SUMMARY_RE.search(line)
+            if match:
+                # loguru 直接输出 dict 的 repr
+                summary = ast.literal_eval(match.group(1))["startup_summary"]
+                break
+            if time.time() - begin > args.timeout:
+                break
+    finally:
+        proc.kill()
+        proc.wait()
+    if summary is None:
+        raise RuntimeError("app.py did not report startup_summary")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bots", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mode", default="threads", choices=("threads", "asyncio"))
+    parser.add_argument("--gateway-latency", type=float, default=0.05, help="钉钉接口（含网关）的处理延迟，秒")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--json", default="", help="结果保存路径")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_servers.py"),
+            f"--dify-port={free_port()}",
+            f"--dingtalk-port={port}",
+            f"--card-latency={args.gateway_latency}",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    summaries = []
+    try:
+        wait_for_port(port)
+        with tempfile.TemporaryDirectory() as workdir:
+            write_bots_config(workdir, args.bots)
+            for i in range(args.runs):
+                summary = run_once(args, workdir, f"http://127.0.0.1:{port}")
+                summaries.append(summary)
+                print(
+                    f"run {i + 1}: first_ready={summary['first_ready']}s all_ready={summary['all_ready']}s connections={summary['connections']}"
+                )
+    finally:
+        server.kill()
+        server.wait()
+
+    def column(key):
+        return [s[key] for s in summaries if s[key] is not None]
+
+    result = {
+        "revision": git_revision(),
+        "bots": args.bots,
+        "mode": args.mode,
+        "runs": len(summaries),
+        "first_ready_p50": percentile(column("first_ready"), 50),
+        "all_ready_p50": percentile(column("all_ready"), 50),
+        "all_ready_max": max(column("all_ready"), default=None),
+        "phases": summaries[-1]["phases"],
+        "packages": summaries[-1]["packages"],
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
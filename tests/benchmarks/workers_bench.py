@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+"""
+多进程扩展基准：启动 Dify 与钉钉替身，按 --workers 中的每个进程数以子进程运行 app.py（WORKER_PROCESSES=N，asyncio 模式），
+机器人的 stream 连接数为 N * --connections-per-worker；连接全部建立后通过替身的 /_push 把消息轮流推送给各个连接，
+统计全部卡片结束所用的时间和每秒完成的消息数。Dify 替身输出很快时瓶颈在 app 的 CPU 上，进程数不超过 CPU 核数时吞吐应接近线性增长。
+    python tests/benchmarks/workers_bench.py [--workers 1,2,4] [--messages 400] [--answer-tokens 200] [--json result.json]
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import fetch_json, free_port, git_revision, post_json, wait_for_port  # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def write_bots_config(workdir: str, connections: int):
+    lines = [
+        "bots:",
+        "  - name: bench",
+        "    dingtalk_app_client_id: bench",
+        "    dingtalk_app_client_secret: bench",
+        "    dify_app_type: chatbot",
+        "    dify_app_api_key: app-bench",
+        "    handler: DifyAiCardBotHandler",
+        f"    stream_connections: {connections}",
+        # 只测处理能力，不限制钉钉接口的调用频率
+        "    dingtalk_rate_limit:",
+        "      qps: 0",
+    ]
+    with open(os.path.join(workdir, ".bots.yaml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def wait_for(predicate, timeout: float, interval: float = 0.1) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def run_once(args: argparse.Namespace, workers: int, dify_url: str, dingtalk_url: str) -> dict:
+    connections = workers * args.connections_per_worker
+    env = {"DIFY_CONVERSATION_REMAIN_TIME": "15", "DINGTALK_AI_CARD_TEMPLATE_ID": "bench.schema"}
+    env.update(os.environ)
+    env.update(
+        DINGTALK_OPENAPI_ENDPOINT=dingtalk_url,
+        DIFY_OPEN_API_URL=dify_url,
+        RUNTIME_MODE="asyncio",
+        WORKER_PROCESSES=str(workers),
+        BOTS_CONFIG_RELOAD_INTERVAL="0",
+        METRICS_ENABLED="false",
+        LOG_LEVEL="WARNING",
+        PER_USER_MAX_CONCURRENCY="0",
+        ADMISSION_QUEUE_SIZE=str(args.messages),
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        write_bots_config(workdir, connections)
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+        try:
+            if not wait_for(lambda: fetch_json(f"{dingtalk_url}/_stats")["stats"]["websockets"] >= connections, args.timeout):
+                raise RuntimeError(f"app.py did not open {connections} stream connections")
+            post_json(f"{dingtalk_url}/_reset", {})
+            begin = time.monotonic()
+            post_json(f"{dingtalk_url}/_push", {"count": args.messages, "senders": args.senders or args.messages, "query": args.query})
+            wait_for(lambda: fetch_json(f"{dingtalk_url}/_stats")["stats"]["finalized"] >= args.messages, args.timeout, interval=0.05)
+            elapsed = time.monotonic() - begin
+            stats = fetch_json(f"{dingtalk_url}/_stats")["stats"]
+        finally:
+            # supervisor 收到 SIGTERM 后停止各 worker
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        # 等连接全部断开，免得影响下一轮
+        wait_for(lambda: fetch_json(f"{dingtalk_url}/_stats")["stats"]["websockets"] == 0, 15)
+    return {
+        "workers": workers,
+        "connections": connections,
+        "finalized": stats["finalized"],
+        "elapsed": round(elapsed, 3),
+        "throughput": round(stats["finalized"] / elapsed, 1) if elapsed else None,
+        "updates": stats["updates"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4", help="依次测试的进程数，逗号分隔")
+    parser.add_argument("--connections-per-worker", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--senders", type=int, default=0, help="发送人数，0表示每条消息一个发送人")
+    parser.add_argument("--query", default="你好")
+    parser.add_argument("--token-rate", type=float, default=1000, help="Dify每秒输出的token数")
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--card-latency", type=float, default=0.005)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", default="", help="结果保存路径")
+    args = parser.parse_args()
+
+    dify_port, dingtalk_port = free_port(), free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_servers.py"),
+            f"--dify-port={dify_port}",
+            f"--dingtalk-port={dingtalk_port}",
+            f"--token-rate={args.token_rate}",
+            f"--answer-tokens={args.answer_tokens}",
+            "--ttfb=0.01",
+            f"--card-latency={args.card_latency}",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    runs = []
+    try:
+        wait_for_port(dify_port)
+        wait_for_port(dingtalk_port)
+        for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+            result = run_once(args, workers, f"http://127.0.0.1:{dify_port}", f"http://127.0.0.1:{dingtalk_port}")
+            runs.append(result)
+            print(
+                f"workers={result['workers']} connections={result['connections']} finalized={result['finalized']}/{args.messages} "
+                f"elapsed={result['elapsed']}s throughput={result['throughput']}/s"
+            )
+    finally:
+        server.kill()
+        server.wait()
+
+    base = runs[0]["throughput"] if runs and runs[0]["throughput"] else None
+    result = {
+        "revision": git_revision(),
+        "cpu_count": os.cpu_count(),
+        "messages": args.messages,
+        "answer_tokens": args.answer_tokens,
+        "runs": [dict(run, speedup=round(run["throughput"] / base, 2) if base and run["throughput"] else None) for run in runs],
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import threading
+import time
+import unittest
+
+from core.cache import Cache
+
+
+class TestCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = Cache(expiry_time=60, max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))  # a 变为最近使用
+        cache.set("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual({"size": 2, "hits": 3, "misses": 1, "evictions": 1, "expirations": 0}, cache.stats())
+
+    def test_expiry_and_sweeper(self):
+        cache = Cache(expiry_time=0.05, sweep_interval=0.02)
+        cache.set("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        time.sleep(0.15)
+
+        self.assertEqual(0, len(cache))
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(1, cache.stats()["expirations"])
+        cache.stop_sweeper()
+
+    def test_concurrent_access(self):
+        cache = Cache(expiry_time=60, max_size=100)
+
+        def worker(n):
+            for i in range(2000):
+                cache.set(f"{n}-{i % 150}", i)
+                cache.get(f"{n}-{(i * 7) % 150}")
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = cache.stats()
+        self.assertEqual(100, stats["size"])
+        self.assertEqual(8 * 2000, stats["hits"] + stats["misses"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import itertools
+import unittest
+from unittest.mock import patch
+
+from core.card_replier import CardPool, DifyAICardReplier
+
+
+class TestCardPool(unittest.IsolatedAsyncioTestCase):
+
+    async def test_acquire_and_refill(self):
+        ids = itertools.count()
+
+        async def create_card(replier, card_template_id, card_data, card_instance_id=None, retry=True):
+            return f"card-{next(ids)}"
+
+        with patch.object(DifyAICardReplier, "async_create_card", create_card):
+            pool = CardPool("template", {"content": ""}, size=2)
+            # 第一次取不到，同时在后台补满
+            self.assertIsNone(pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(2, pool.stats()["available"])
+            self.assertEqual("card-0", pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(2, pool.stats()["available"])
+
+            # 过期的卡片直接丢弃
+            pool.max_age = -1
+            self.assertIsNone(pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(
+                {"available": 2, "creating": 0, "hits": 1, "misses": 2, "expired": 2, "failures": 0, "consecutive_failures": 0},
+                pool.stats(),
+            )
+
+    async def test_create_failure(self):
+        calls = []
+
+        async def create_card(replier, card_template_id, card_data, card_instance_id=None, retry=True):
+            calls.append(card_template_id)
+            if len(calls) <= 4:
+                raise RuntimeError("boom")
+            return f"card-{len(calls)}"
+
+        with patch.object(DifyAICardReplier, "async_create_card", create_card):
+            pool = CardPool("template", {"content": ""}, size=3, retry_delay=0.05)
+            self.assertIsNone(pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(
+                {"available": 0, "creating": 0, "hits": 0, "misses": 1, "expired": 0, "failures": 3, "consecutive_failures": 3},
+                pool.stats(),
+            )
+            # 退避期间不再创建
+            self.assertIsNone(pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(3, len(calls))
+            # 退避结束后只试创建一张
+            await asyncio.sleep(0.3)
+            self.assertIsNone(pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(4, len(calls))
+            await asyncio.sleep(0.6)
+            self.assertIsNone(pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(5, len(calls))
+            self.assertEqual(0, pool.stats()["consecutive_failures"])
+            # 恢复后补满
+            self.assertEqual("card-5", pool.acquire(None))
+            await asyncio.sleep(0)
+            self.assertEqual(8, len(calls))
+
+
+if __name__ == "__main__":
+    unittest.main()
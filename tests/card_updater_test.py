@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import unittest
+
+from core.card_updater import CardUpdater, CoalescingCardUpdater, create_card_updater
+
+
+class _Recorder:
+    def __init__(self, delay=0.0, fail_at=()):
+        self.delay = delay
+        self.fail_at = fail_at
+        self.calls = []
+        self.append_flags = []
+
+    async def send(self, content, append, finished, failed):
+        await asyncio.sleep(self.delay)
+        if len(self.append_flags) in self.fail_at:
+            self.append_flags.append(None)
+            raise Exception("mock failure")
+        self.calls.append((content, finished, failed))
+        self.append_flags.append(append)
+
+
+class TestCardUpdater(unittest.IsolatedAsyncioTestCase):
+
+    async def test_immediate(self):
+        recorder = _Recorder()
+        updater = create_card_updater(recorder.send, mode="immediate").start()
+        self.assertIsInstance(updater, CardUpdater)
+        await updater.update("a")
+        await updater.update("ab")
+        await updater.finish("abc")
+        await updater.finish("abc")
+
+        self.assertEqual([("a", False, False), ("ab", False, False), ("abc", True, False)], recorder.calls)
+
+    async def test_coalesce_slow_send(self):
+        # 钉钉接口很慢时，update 不应被阻塞，中间内容会被合并
+        recorder = _Recorder(delay=0.05)
+        updater = CoalescingCardUpdater(recorder.send, min_interval=0.01, max_pending=1000).start()
+        content = ""
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        for i in range(100):
+            content += f"{i},"
+            await updater.update(content)
+            await asyncio.sleep(0.001)
+        update_cost = loop.time() - begin
+        await updater.finish(content)
+
+        self.assertLess(update_cost, 1)
+        self.assertLess(len(recorder.calls), 50)
+        self.assertEqual((content, True, False), recorder.calls[-1])
+        self.assertEqual(1, sum(1 for c in recorder.calls if c[1]))
+
+    async def test_coalesce_max_pending(self):
+        recorder = _Recorder()
+        updater = CoalescingCardUpdater(recorder.send, min_interval=60, max_pending=10).start()
+        # 首次更新立即刷新，之后在间隔内只有积压超过 max_pending 才刷新
+        await updater.update("x")
+        await asyncio.sleep(0.01)
+        await updater.update("x" * 5)
+        await asyncio.sleep(0.01)
+        self.assertEqual([("x", False, False)], recorder.calls)
+        await updater.update("x" * 20)
+        await asyncio.sleep(0.01)
+        self.assertEqual([("x", False, False), ("x" * 20, False, False)], recorder.calls)
+        await updater.finish("error", failed=True)
+        self.assertEqual(("error", False, True), recorder.calls[-1])
+
+    async def test_append_delta(self):
+        recorder = _Recorder()
+        updater = create_card_updater(recorder.send, mode="immediate", append=True)
+        await updater.update("ab")
+        await updater.update("abcd")
+        await updater.finish("abcdef")
+
+        self.assertEqual([("ab", False, False), ("cd", False, False), ("ef", True, False)], recorder.calls)
+        self.assertEqual([True, True, True], recorder.append_flags)
+        stats = updater.stats()
+        self.assertEqual(6, stats["bytes_sent"])
+        self.assertEqual(12, stats["full_bytes"])
+
+    async def test_append_fallback_to_full(self):
+        # 第二次更新失败后，下一次更新自动全量覆盖；内容不是已确认内容的延续时也全量覆盖
+        recorder = _Recorder(fail_at=(1,))
+        updater = create_card_updater(recorder.send, mode="immediate", append=True)
+        await updater.update("ab")
+        await updater.update("abcd")
+        await updater.update("abcdef")
+        await updater.update("xyz")
+        await updater.finish("xyz!")
+
+        self.assertEqual([True, None, False, False, True], recorder.append_flags)
+        self.assertEqual([("ab", False, False), ("abcdef", False, False), ("xyz", False, False), ("!", True, False)], recorder.calls)
+        self.assertEqual(1, updater.stats()["failed_updates"])
+
+    async def test_append_final_retry(self):
+        recorder = _Recorder(fail_at=(1,))
+        updater = create_card_updater(recorder.send, mode="immediate", append=True)
+        await updater.update("ab")
+        await updater.finish("abc")
+
+        self.assertEqual([True, None, False], recorder.append_flags)
+        self.assertEqual(("abc", True, False), recorder.calls[-1])
+
+    async def test_close(self):
+        # 卡片投放失败时放弃后续更新，后台任务也随之结束
+        recorder = _Recorder(delay=0.01)
+        updater = create_card_updater(recorder.send, min_interval=10).start()
+        await updater.update("a")
+        updater.close()
+        await updater.update("ab")
+        await updater.finish("abc")
+        await asyncio.sleep(0.05)
+
+        self.assertTrue(updater._task.done())
+        self.assertNotIn(("abc", True, False), recorder.calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
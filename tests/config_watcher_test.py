@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import os
+import tempfile
+import unittest
+
+import yaml
+
+from core.admission import AdmissionController
+from core.config_watcher import ConfigWatcher, changed_keys, diff_bots, validate_bots_config
+
+
+def make_bot(name: str, **kwargs) -> dict:
+    bot = {
+        "name": name,
+        "dingtalk_app_client_id": f"{name}-id",
+        "dingtalk_app_client_secret": f"{name}-secret",
+        "dify_app_type": "chatbot",
+        "dify_app_api_key": f"{name}-key",
+        "handler": "DifyAiCardBotHandler",
+    }
+    bot.update(kwargs)
+    return bot
+
+
+class TestConfigWatcher(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".yaml")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, bots: list, mtime: int):
+        with open(self.path, "w") as f:
+            yaml.safe_dump({"bots": bots}, f, allow_unicode=True)
+        # 避免文件系统时间精度导致两次写入的修改时间相同
+        os.utime(self.path, ns=(mtime, mtime))
+
+    def load(self, path: str) -> dict:
+        with open(path) as f:
+            return yaml.safe_load(f)
+
+    def test_diff(self):
+        a, b, c = make_bot("a"), make_bot("b"), make_bot("c")
+        b2 = make_bot("b", dify_app_api_key="rotated", max_concurrency=2)
+        diff = diff_bots([a, b], [b2, c])
+        self.assertEqual([c], diff["added"])
+        self.assertEqual([a], diff["removed"])
+        self.assertEqual([(b, b2)], diff["changed"])
+        self.assertEqual({"dify_app_api_key", "max_concurrency"}, changed_keys(b, b2))
+        self.assertEqual({"added": [], "removed": [], "changed": []}, diff_bots([a], [make_bot("a")]))
+
+    def test_validate(self):
+        validate_bots_config({"bots": [make_bot("a"), make_bot("b")]})
+        with self.assertRaises(ValueError):
+            validate_bots_config({"bots": [make_bot("a"), make_bot("a")]})
+        with self.assertRaises(ValueError):
+            validate_bots_config({"bots": [make_bot("a", dify_app_api_key="")]})
+        with self.assertRaises(ValueError):
+            validate_bots_config({})
+
+    def test_check(self):
+        changes = []
+
+        def on_change(old_conf, new_conf):
+            changes.append(([b["name"] for b in old_conf["bots"]], [b["name"] for b in new_conf["bots"]]))
+
+        self.write([make_bot("a")], 1_000_000_000)
+        watcher = ConfigWatcher(self.path, self.load, on_change, interval=3600)
+        watcher.start(self.load(self.path))
+        self.assertFalse(watcher.check())
+
+        # 修改时间变了但内容没变
+        self.write([make_bot("a")], 2_000_000_000)
+        self.assertFalse(watcher.check())
+
+        self.write([make_bot("a"), make_bot("b")], 3_000_000_000)
+        self.assertTrue(watcher.check())
+        self.assertEqual([(["a"], ["a", "b"])], changes)
+
+        # 配置有误时不回调，保留原配置
+        self.write([make_bot("a"), make_bot("a")], 4_000_000_000)
+        self.assertFalse(watcher.check())
+        self.write([make_bot("b")], 5_000_000_000)
+        self.assertTrue(watcher.check())
+        self.assertEqual((["a", "b"], ["b"]), changes[-1])
+        self.assertEqual({"reloads": 2, "failures": 1}, watcher.stats())
+        watcher.stop()
+
+    def test_partially_applied(self):
+        # on_change 返回实际生效的配置，下次变化时与它对比
+        self.write([make_bot("a")], 1_000_000_000)
+        seen = []
+
+        def on_change(old_conf, new_conf):
+            seen.append([b["name"] for b in old_conf["bots"]])
+            return {"bots": [b for b in new_conf["bots"] if b["name"] != "bad"]}
+
+        watcher = ConfigWatcher(self.path, self.load, on_change, interval=3600)
+        watcher.start(self.load(self.path))
+        self.write([make_bot("a"), make_bot("bad")], 2_000_000_000)
+        self.assertTrue(watcher.check())
+        self.write([make_bot("a"), make_bot("bad"), make_bot("c")], 3_000_000_000)
+        self.assertTrue(watcher.check())
+        self.assertEqual([["a"], ["a"]], seen)
+        watcher.stop()
+
+    def test_app_loader(self):
+        # app.py 中实际使用的加载函数，ConfigWatcher 调用时会传入配置文件路径
+        from app import load_worker_bots_config
+
+        changes = []
+        self.write([make_bot("a")], 1_000_000_000)
+        watcher = ConfigWatcher(self.path, load_worker_bots_config, lambda old_conf, new_conf: changes.append(new_conf), interval=3600)
+        watcher.start(load_worker_bots_config(self.path))
+        self.write([make_bot("a"), make_bot("b")], 2_000_000_000)
+        self.assertTrue(watcher.check())
+        self.assertEqual(["a", "b"], [b["name"] for b in changes[0]["bots"]])
+        self.assertEqual({"reloads": 1, "failures": 0}, watcher.stats())
+        watcher.stop()
+
+    def test_update_api_key(self):
+        # 启用附件时换 api key 要重建 handler，不能沿用原来 Dify 应用里上传的文件
+        from app import create_bot_handler, update_bot
+
+        class FakeRuntime(object):
+            def __init__(self, handler):
+                self.handlers = {"a": handler}
+
+            def replace_handler(self, name, callback_handler, drain_timeout=300):
+                self.handlers[name] = callback_handler
+
+        controller = AdmissionController()
+        store_conf = {"backend": "memory"}
+        for attachments, replaced in (({"enabled": False}, False), ({}, True)):
+            old_bot = make_bot("a", conversation_store=store_conf, attachments=attachments)
+            bot = make_bot("a", conversation_store=store_conf, attachments=attachments, dify_app_api_key="rotated")
+            handler = create_bot_handler(old_bot, controller)
+            runtime = FakeRuntime(handler)
+            update_bot(runtime, controller, old_bot, bot)
+            new_handler = runtime.handlers["a"]
+            self.assertEqual(replaced, new_handler is not handler)
+            self.assertEqual("rotated", new_handler.dify_api_client.api_key)
+            if replaced:
+                self.assertIsNot(handler.attachment_uploader, new_handler.attachment_uploader)
+                # 会话上下文与进行中的生成仍然沿用
+                self.assertIs(handler.cache, new_handler.cache)
+                self.assertIs(handler.generations, new_handler.generations)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import os
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from core.conversation_store import (
+    MemoryConversationStore,
+    RedisConversationStore,
+    SQLiteConversationStore,
+    create_conversation_store,
+)
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+    """本地 Redis 替身，只支持 GET/SET/DEL/PING"""
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            args = self._read_command()
+            if args is None:
+                break
+            cmd = args[0].upper()
+            if cmd == "PING":
+                self.wfile.write(b"+PONG\r\n")
+            elif cmd == "SET":
+                data[args[1]] = args[2]
+                self.wfile.write(b"+OK\r\n")
+            elif cmd == "GET":
+                value = data.get(args[1])
+                if value is None:
+                    self.wfile.write(b"$-1\r\n")
+                else:
+                    value = value.encode("utf-8")
+                    self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+            elif cmd == "DEL":
+                self.wfile.write(b":%d\r\n" % (1 if data.pop(args[1], None) is not None else 0))
+            else:
+                self.wfile.write(b"-ERR unknown command\r\n")
+            self.wfile.flush()
+
+
+class _FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FakeRedisHandler)
+        self.data = {}
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class TestConversationStore(unittest.TestCase):
+
+    def test_memory(self):
+        store = create_conversation_store(None, namespace="bot1", expiry_time=60)
+        self.assertIsInstance(store, MemoryConversationStore)
+        store.set("u1", "c1")
+        self.assertEqual("c1", store.get("u1"))
+        self.assertIsNone(store.get("u2"))
+        store.close()
+
+    def test_sqlite_shared_between_instances(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "conversations.db")
+            store_a = SQLiteConversationStore(namespace="bot1", path=path, flush_interval=10)
+            store_b = SQLiteConversationStore(namespace="bot1", path=path, flush_interval=10)
+            store_a.set("u1", "c1")
+            # 未落盘前本实例可以读到，其它实例读不到
+            self.assertEqual("c1", store_a.get("u1"))
+            self.assertIsNone(store_b.get("u1"))
+            store_a.flush()
+            self.assertEqual("c1", store_b.get("u1"))
+            self.assertIsNone(SQLiteConversationStore(namespace="bot2", path=path).get("u1"))
+
+            # 热路径读取应在 1ms 以内
+            begin = time.perf_counter()
+            for _ in range(1000):
+                store_b.get("u1")
+            self.assertLess((time.perf_counter() - begin) / 1000, 0.001)
+            store_a.close()
+            store_b.close()
+
+    def test_sqlite_close(self):
+        # 各线程各自的连接在 close 时一并关闭
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteConversationStore(namespace="bot1", path=os.path.join(tmp, "conversations.db"), local_ttl=0)
+            store.set("u1", "c1")
+            store.flush()
+            thread = threading.Thread(target=store.get, args=("u1",))
+            thread.start()
+            thread.join()
+            connections = list(store._connections)
+            self.assertEqual(2, len(connections))  # 当前线程（建表、flush 写入）和上面的线程
+            store.close()
+            for conn in connections:
+                with self.assertRaises(sqlite3.ProgrammingError):
+                    conn.execute("SELECT 1")
+
+    def test_async_get(self):
+        # 事件循环中读取 sqlite/redis 时放到线程池里执行，内存存储直接读取
+        with tempfile.TemporaryDirectory() as tmp:
+            stores = [MemoryConversationStore(), SQLiteConversationStore(path=os.path.join(tmp, "conversations.db"), local_ttl=0)]
+            for store, blocking in zip(stores, (False, True)):
+                store.set("u1", "c1")
+                store.flush()
+                get = store.get
+                threads = []
+
+                def traced_get(key):
+                    threads.append(threading.current_thread())
+                    return get(key)
+
+                store.get = traced_get
+                self.assertEqual("c1", asyncio.run(store.async_get("u1")))
+                self.assertEqual(blocking, threads != [threading.current_thread()])
+                store.close()
+
+    def test_redis(self):
+        server = _FakeRedisServer()
+        url = "redis://127.0.0.1:%d/0" % server.server_address[1]
+        try:
+            store = create_conversation_store({"backend": "redis", "url": url, "flush_interval": 10}, namespace="bot1")
+            self.assertIsInstance(store, RedisConversationStore)
+            store.set("u1", "c1")
+            store.flush()
+            self.assertEqual({"dod:conversation:bot1:u1": "c1"}, server.data)
+
+            other = RedisConversationStore(namespace="bot1", url=url, local_ttl=0)
+            self.assertEqual("c1", other.get("u1"))
+            self.assertIsNone(other.get("u2"))
+            store.delete("u1")
+            store.flush()
+            self.assertIsNone(other.get("u1"))
+            store.close()
+            other.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import threading
+import time
+import unittest
+
+from core.dedup import MessageDeduplicator
+
+
+class TestMessageDeduplicator(unittest.TestCase):
+
+    def test_duplicates(self):
+        dedup = MessageDeduplicator(window=60)
+        self.assertTrue(dedup.acquire("msg1"))
+        self.assertFalse(dedup.acquire("msg1"))
+        dedup.complete("msg1")
+        self.assertFalse(dedup.acquire("msg1"))
+        self.assertTrue(dedup.acquire("msg2"))
+        # 没有 msgId 的消息不去重
+        self.assertTrue(dedup.acquire(None))
+        self.assertTrue(dedup.acquire(None))
+
+        self.assertEqual({"accepted": 2, "duplicates": 2, "duplicates_processing": 1, "duplicates_done": 1}, dedup.stats())
+
+    def test_release_and_window(self):
+        dedup = MessageDeduplicator(window=0.05)
+        self.assertTrue(dedup.acquire("msg1"))
+        dedup.release("msg1")
+        self.assertTrue(dedup.acquire("msg1"))
+        time.sleep(0.1)
+        self.assertTrue(dedup.acquire("msg1"))
+
+    def test_concurrent_duplicates(self):
+        # 多个连接同时收到同一条消息，只放行一次
+        dedup = MessageDeduplicator(window=60)
+        results = []
+        barrier = threading.Barrier(16)
+
+        def worker():
+            barrier.wait()
+            results.append(dedup.acquire("msg1"))
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, results.count(True))
+        self.assertEqual(15, dedup.stats()["duplicates"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,15 +3,17 @@
 # __author__ = 'zfanswer'
 import unittest
 from unittest.mock import patch
+
 from core.dify_client import ChatClient
+from core.sse import aiter_sse_events
 
 
 class TestChatClient(unittest.TestCase):
 
     def setUp(self):
-        self.chat_client = ChatClient(api_key="app-r7P5q2Dl3opvJFewFD1OD7D9", base_url="http://192.168.250.64/v1")
+        self.chat_client = ChatClient(api_key="app-r7P5q2Dl3opvJFewFD1OD7D9", base_url="http://127.0.0.1/v1")
 
-    @patch("dify_client.ChatClient._send_request")
+    @patch("core.dify_client.ChatClient._send_request")
     def test_create_chat_message_blocking(self, mock_send_request):
         # 测试 blocking 模式
         inputs = {}
@@ -21,7 +23,7 @@ class TestChatClient(unittest.TestCase):
         conversation_id = "conv_id"
         files = None
 
-        self.chat_client.create_chat_message(inputs, query, user, response_mode, conversation_id, files)
+        self.chat_client.create_chat_messages(inputs, query, user, response_mode, conversation_id, files)
 
         mock_send_request.assert_called_once_with(
             "POST",
@@ -31,13 +33,14 @@ class TestChatClient(unittest.TestCase):
                 "query": query,
                 "user": user,
                 "response_mode": response_mode,
-                "conversation_id": conversation_id,
                 "files": files,
+                "auto_generate_name": False,
+                "conversation_id": conversation_id,
             },
             stream=False,
         )
 
-    @patch("dify_client.ChatClient._send_request")
+    @patch("core.dify_client.ChatClient._send_request")
     def test_create_chat_message_streaming(self, mock_send_request):
         # 测试 streaming 模式
         inputs = {}
@@ -47,17 +50,70 @@ class TestChatClient(unittest.TestCase):
         conversation_id = None
         files = None
 
-        self.chat_client.create_chat_message(inputs, query, user, response_mode, conversation_id, files)
+        self.chat_client.create_chat_messages(inputs, query, user, response_mode, conversation_id, files)
 
         mock_send_request.assert_called_once_with(
             "POST",
             "/chat-messages",
-            {"inputs": inputs, "query": query, "user": user, "response_mode": response_mode, "files": files},
+            {
+                "inputs": inputs,
+                "query": query,
+                "user": user,
+                "response_mode": response_mode,
+                "files": files,
+                "auto_generate_name": False,
+            },
             stream=True,
         )
 
+    def test_session_pool(self):
+        client = ChatClient(api_key="app-xxx", base_url="http://127.0.0.1/v1", pool_size=4, max_retries=2)
+        session = client._get_session()
+
+        self.assertIs(session, client._get_session())
+        adapter = session.get_adapter("http://127.0.0.1/v1/parameters")
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertEqual(2, adapter.max_retries.total)
+        self.assertEqual(frozenset(["GET"]), adapter.max_retries.allowed_methods)
+        self.assertEqual({"requests": 0, "new_connections": 0, "reused_connections": 0}, client.pool_stats())
+
     # 可以添加更多的测试用例来覆盖不同的场景和参数组合
 
 
+class _FakeStreamContent:
+    def __init__(self, lines, chunk_size=7):
+        self._data = b"".join(lines)
+        self._chunk_size = chunk_size
+
+    async def iter_any(self):
+        # 网络分块与行边界不对齐
+        for i in range(0, len(self._data), self._chunk_size):
+            yield self._data[i : i + self._chunk_size]
+
+
+class _FakeStreamResponse:
+    def __init__(self, lines):
+        self.content = _FakeStreamContent(lines)
+
+
+class TestAsyncSSEEvents(unittest.IsolatedAsyncioTestCase):
+
+    async def test_events(self):
+        lines = [
+            b": ping\n",
+            b'data: {"event": "message", "answer": "\xe4\xbd\xa0"}\n',
+            b"\n",
+            b"event: custom\r\n",
+            b"data: line1\n",
+            b"data: line2\n",
+            b"\n",
+            b"data: tail\n",
+        ]
+        events = [e async for e in aiter_sse_events(_FakeStreamResponse(lines))]
+
+        self.assertEqual(['{"event": "message", "answer": "你"}', "line1\nline2", "tail"], [e.data for e in events])
+        self.assertEqual("custom", events[1].event)
+
+
 if __name__ == "__main__":
     unittest.main()
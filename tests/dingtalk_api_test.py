@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from dingtalk_stream import Credential
+
+from core.card_replier import CardStreamingError
+from core.dingtalk_api import AccessTokenCache, DingTalkApp, RateLimiter, close_http_session, get_dingtalk_app
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_pacing(self):
+        limiter = RateLimiter(qps=50, burst=5)
+        begin = time.monotonic()
+        for _ in range(20):
+            await limiter.acquire()
+        # 前 5 个用桶里的令牌，其余 15 个按 50 次/秒发放
+        self.assertGreater(time.monotonic() - begin, 0.25)
+        self.assertEqual(20, limiter.stats()["acquired"])
+
+    async def test_urgent_first(self):
+        limiter = RateLimiter(qps=20, burst=1)
+        await limiter.acquire()
+        order = []
+
+        async def acquire(name, urgent):
+            await limiter.acquire(urgent)
+            order.append(name)
+
+        normal = [asyncio.create_task(acquire(f"n{i}", False)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        urgent = asyncio.create_task(acquire("final", True))
+        await asyncio.gather(urgent, *normal)
+        self.assertEqual("final", order[0])
+
+    async def test_throttled(self):
+        limiter = RateLimiter(qps=100, recovery_time=5)
+        limiter.throttled(retry_after=0.1)
+        limiter.throttled()  # 同一次暂停期间不再降速
+        self.assertLess(limiter.stats()["current_qps"], 51)
+        self.assertEqual(2, limiter.stats()["throttled"])
+        begin = time.monotonic()
+        await limiter.acquire(urgent=True)
+        self.assertGreater(time.monotonic() - begin, 0.09)
+        limiter.configure(qps=100, recovery_time=0.2)
+        await asyncio.sleep(0.2)
+        self.assertEqual(100, limiter.stats()["current_qps"])
+
+    async def test_unlimited(self):
+        limiter = RateLimiter(qps=0)
+        for _ in range(1000):
+            await limiter.acquire()
+        self.assertEqual(0, limiter.stats()["waited"])
+
+
+class _CountingTokens(AccessTokenCache):
+    def _fetch(self):
+        time.sleep(0.05)
+        return f"token-{self.fetches}", 7200
+
+
+class TestAccessTokenCache(unittest.TestCase):
+
+    def test_single_flight(self):
+        tokens = _CountingTokens(Credential("app", "secret"))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(tokens.get())) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(["token-0"] * 10, results)
+        self.assertEqual(1, tokens.fetches)
+        # 作废旧 token 不影响已经刷新的新 token
+        tokens.reset("token-0")
+        self.assertEqual("token-1", tokens.get())
+        tokens.reset("token-0")
+        self.assertEqual("token-1", tokens.get())
+
+    def test_shared_by_app(self):
+        self.assertIs(get_dingtalk_app(Credential("shared", "s")), get_dingtalk_app(Credential("shared", "s")))
+        self.assertIsNot(get_dingtalk_app(Credential("shared", "s")), get_dingtalk_app(Credential("other", "s")))
+
+
+class TestDingTalkApp(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.throttle = 0
+        self.updates = []
+        app = web.Application()
+        app.router.add_post("/v1.0/oauth2/accessToken", self.access_token)
+        app.router.add_put("/v1.0/card/streaming", self.streaming)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        patcher = mock.patch("core.dingtalk_api.DINGTALK_OPENAPI_ENDPOINT", str(self.server.make_url("")).rstrip("/"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = DingTalkApp(Credential("app", "secret"))
+        self.app.configure(qps=100, recovery_time=1)
+
+    async def asyncTearDown(self):
+        await close_http_session()
+        await self.server.close()
+
+    async def access_token(self, request: web.Request):
+        return web.json_response({"accessToken": "token", "expireIn": 7200})
+
+    async def streaming(self, request: web.Request):
+        if self.throttle:
+            self.throttle -= 1
+            return web.json_response({"code": "Forbidden.AccessDenied.QpsLimitForApi"}, status=403)
+        self.updates.append((await request.json())["content"])
+        return web.json_response({"success": True})
+
+    async def test_retry_when_throttled(self):
+        self.throttle = 2
+        await self.app.request("PUT", "/v1.0/card/streaming", {"content": "final"}, urgent=True, retry=True)
+        self.assertEqual(["final"], self.updates)
+        stats = self.app.stats()
+        self.assertEqual(2, stats["throttled"])
+        self.assertLess(stats["current_qps"], 100)
+        self.assertEqual(1, stats["token_fetches"])
+
+    async def test_normal_not_retried(self):
+        self.throttle = 1
+        with self.assertRaises(CardStreamingError):
+            await self.app.request("PUT", "/v1.0/card/streaming", {"content": "partial"}, error_class=CardStreamingError)
+        self.assertEqual([], self.updates)
+
+
+if __name__ == "__main__":
+    unittest.main()
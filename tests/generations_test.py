@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import threading
+import unittest
+
+from core.generations import GenerationTracker, estimate_tokens
+from core.handlers import _StreamState
+
+
+class TestGenerationTracker(unittest.IsolatedAsyncioTestCase):
+
+    def test_estimate_tokens(self):
+        self.assertEqual(0, estimate_tokens(""))
+        self.assertEqual(4, estimate_tokens("每月几号"))
+        self.assertEqual(3, estimate_tokens("hello world"))
+
+    async def test_cancel(self):
+        tracker = GenerationTracker()
+        state = _StreamState()
+        task = asyncio.create_task(asyncio.sleep(10))
+        generation = tracker.register(("c", "u"), task, state)
+        self.assertEqual(1, tracker.stats()["running"])
+
+        self.assertFalse(tracker.cancel(("c", "other"), "superseded"))
+        self.assertTrue(tracker.cancel(("c", "u"), "superseded"))
+        self.assertEqual("superseded", generation.reason)
+        self.assertTrue(state.cancelled)
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        # 已经取消过的不会重复取消
+        self.assertFalse(tracker.cancel(("c", "u"), "stopped"))
+        tracker.unregister(generation)
+        self.assertEqual(0, tracker.stats()["running"])
+
+    async def test_complete(self):
+        tracker = GenerationTracker()
+        generation = tracker.register(("c", "u"), asyncio.create_task(asyncio.sleep(10)), _StreamState())
+        # 生成完之后不再能被取消
+        self.assertTrue(tracker.complete(generation))
+        self.assertFalse(tracker.cancel(("c", "u"), "stopped"))
+        # 取消已经发出时 complete 返回 False，取代它的请求等它释放
+        other = tracker.register(("c", "u"), asyncio.create_task(asyncio.sleep(10)), _StreamState())
+        self.assertIs(other, tracker.cancel_generation(("c", "u"), "superseded"))
+        self.assertFalse(tracker.complete(other))
+        self.assertFalse(other.released.done())
+        tracker.unregister(other)
+        self.assertTrue(other.released.done())
+        generation.task.cancel()
+
+    async def test_cancel_from_other_thread(self):
+        tracker = GenerationTracker()
+        task = asyncio.create_task(asyncio.sleep(10))
+        tracker.register(("c", "u"), task, _StreamState())
+        result = []
+        thread = threading.Thread(target=lambda: result.append(tracker.cancel(("c", "u"), "stopped")))
+        thread.start()
+        thread.join(1)
+        self.assertEqual([True], result)
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+    async def test_unregister_keeps_newer_generation(self):
+        tracker = GenerationTracker()
+        old = tracker.register(("c", "u"), asyncio.create_task(asyncio.sleep(10)), _StreamState())
+        new = tracker.register(("c", "u"), asyncio.create_task(asyncio.sleep(10)), _StreamState())
+        tracker.unregister(old)
+        self.assertEqual(1, tracker.stats()["running"])
+        self.assertTrue(tracker.cancel(("c", "u"), "stopped"))
+        self.assertEqual("stopped", new.reason)
+        old.task.cancel()
+
+    def test_savings(self):
+        tracker = GenerationTracker()
+        tracker.record_completed(100, 10)
+        tracker.record_completed(300, 30)
+        saved = tracker.record_cancelled("superseded", 50, 5)
+        self.assertEqual({"tokens_saved": 150, "updates_saved": 15}, saved)
+        self.assertEqual({"tokens_saved": 0, "updates_saved": 0}, tracker.record_cancelled("stopped", 500, 50))
+        stats = tracker.stats()
+        self.assertEqual(2, stats["completed"])
+        self.assertEqual(1, stats["superseded"])
+        self.assertEqual(1, stats["stopped"])
+        self.assertEqual(150, stats["estimated_tokens_saved"])
+        self.assertEqual(15, stats["estimated_updates_saved"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import itertools
+import json
+import os
+import unittest
+from collections import defaultdict, deque
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from dingtalk_stream import CallbackMessage, Credential
+
+from configs import DIFY_CONVERSATION_REMAIN_TIME
+from core.admission import AdmissionController
+from core.card_replier import CardCreationError, DifyAICardReplier
+from core.conversation_store import MemoryConversationStore
+from core.dify_client import AsyncChatClient
+from core.handlers import (
+    BUSY_CARD_TEXT,
+    MERGED_CARD_TEXT,
+    NOTHING_TO_STOP_TEXT,
+    QUEUED_CARD_TEXT,
+    STOP_REPLY_TEXT,
+    STOPPED_CARD_TEXT,
+    SUPERSEDED_CARD_TEXT,
+    UPSTREAM_BUSY_CARD_TEXT,
+    DifyAiCardBotHandler,
+)
+from core.upstream import CircuitBreaker
+
+ANSWER = ["第一段回答的内容比较长一些，", "第二段回答的内容也比较长一些。"]
+
+
+class FakeDingTalkClient(object):
+    credential = Credential("bot", "secret")
+
+
+def message_event(answer: str, task_id: str = "t1") -> dict:
+    return {"event": "message", "task_id": task_id, "answer": answer}
+
+
+def answer_script(task_id: str = "t1", gate: asyncio.Event = None) -> list:
+    """默认的回答：第一段之后可以停在 gate 上，等测试放行后再输出剩下的部分"""
+    script = [message_event(ANSWER[0], task_id)]
+    if gate is not None:
+        script.append(gate)
+    script += [message_event(ANSWER[1], task_id), {"event": "message_end", "task_id": task_id, "conversation_id": "c1"}]
+    return script
+
+
+class HandlerTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    本地 Dify 替身 + 记录卡片内容的钉钉替身，驱动 DifyAiCardBotHandler.process：
+    - self.scripts 中每一项对应一次 Dify 请求：事件（dict）依次输出，遇到 asyncio.Event 时等它放行，
+      int 表示直接返回该状态码，"disconnect" 表示输出到一半断开连接；
+    - self.cards[消息id] 是该消息卡片的每次更新 (内容, finished, failed)；self.final_gate 不为空时最终更新等它放行，
+      self.card_gate 不为空时创建卡片等它放行，self.card_error 不为空时创建卡片抛出该异常。
+    """
+
+    card_update_mode = "immediate"
+
+    async def asyncSetUp(self):
+        self.scripts = deque()
+        self.dify_requests = []
+        self.dify_stops = []
+        self.dify_disconnects = 0
+        app = web.Application()
+        app.router.add_post("/v1/chat-messages", self.chat_messages)
+        app.router.add_post("/v1/chat-messages/{task_id}/stop", self.stop)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.addAsyncCleanup(self.server.close)
+
+        self.cards = defaultdict(list)
+        self.card_ids = itertools.count()
+        self.final_gate = None
+        self.final_started = asyncio.Event()
+        self.card_error = None
+        self.card_gate = None
+        self.created_cards = []
+        test = self
+
+        async def create_card(replier, card_template_id, card_data, card_instance_id=None, retry=True):
+            if test.card_gate is not None:
+                await test.card_gate.wait()
+            if test.card_error is not None:
+                raise test.card_error
+            card_instance_id = f"{replier.incoming_message.message_id}/{next(test.card_ids)}"
+            test.created_cards.append(card_instance_id)
+            return card_instance_id
+
+        async def deliver_card(replier, card_instance_id, at_sender=False):
+            pass
+
+        async def streaming(replier, card_instance_id, content_key, content_value, append, finished, failed):
+            if (finished or failed) and test.final_gate is not None:
+                test.final_started.set()
+                await test.final_gate.wait()
+            test.cards[card_instance_id.split("/")[0]].append((content_value, finished, failed))
+
+        for name, fake in (("async_create_card", create_card), ("async_deliver_card", deliver_card), ("async_streaming", streaming)):
+            patcher = mock.patch.object(DifyAICardReplier, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.replies = []
+        self.message_ids = itertools.count()
+
+    async def chat_messages(self, request: web.Request):
+        body = await request.json()
+        self.dify_requests.append(body)
+        script = self.scripts.popleft() if self.scripts else answer_script()
+        if isinstance(script, int):
+            return web.json_response({"message": "error"}, status=script)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        try:
+            for step in script:
+                if isinstance(step, asyncio.Event):
+                    await step.wait()
+                elif step == "disconnect":
+                    request.transport.close()
+                    return response
+                else:
+                    await response.write(f"data: {json.dumps(step, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await response.write_eof()
+        except ConnectionResetError:
+            # 机器人那边提前关闭了连接
+            self.dify_disconnects += 1
+        return response
+
+    async def stop(self, request: web.Request):
+        self.dify_stops.append(request.match_info["task_id"])
+        return web.json_response({"result": "success"})
+
+    def create_handler(self, **kwargs) -> DifyAiCardBotHandler:
+        client = AsyncChatClient(
+            api_key="app-test", base_url=str(self.server.make_url("/v1")), backoff_factor=0, **kwargs.pop("client", {})
+        )
+        self.addAsyncCleanup(client.close)
+        kwargs.setdefault("conversation_store", MemoryConversationStore())
+        kwargs.setdefault("card_update_conf", {"mode": self.card_update_mode, "min_interval": 0})
+        handler = DifyAiCardBotHandler(client, bot_name="bot", card_conf={"template_id": "template"}, **kwargs)
+        handler.dingtalk_client = FakeDingTalkClient()
+        handler.reply_text = lambda text, incoming_message: self.replies.append(text)
+        return handler
+
+    async def send(self, handler: DifyAiCardBotHandler, text: str, user: str = "u1") -> str:
+        message_id = f"m{next(self.message_ids)}"
+        callback_msg = CallbackMessage()
+        callback_msg.headers.message_id = message_id
+        callback_msg.data = {
+            "msgId": message_id,
+            "msgtype": "text",
+            "text": {"content": text},
+            "conversationId": "conv",
+            "conversationType": "1",
+            "senderStaffId": user,
+            "senderNick": user,
+        }
+        await handler.process(callback_msg)
+        return message_id
+
+    async def wait_idle(self, handler: DifyAiCardBotHandler, timeout: float = 5):
+        # 卡片投放失败时处理任务以取消结束
+        tasks = list(handler._inflight)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            self.assertFalse(pending, "等待超时")
+
+    async def wait_for(self, predicate, timeout: float = 5):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not predicate():
+            self.assertLess(asyncio.get_running_loop().time(), deadline, "等待超时")
+            await asyncio.sleep(0.01)
+
+    def final(self, message_id: str):
+        """卡片的最终更新 (内容, finished, failed)，没有时为 None"""
+        finals = [u for u in self.cards[message_id] if u[1] or u[2]]
+        self.assertLessEqual(len(finals), 1)
+        return finals[0] if finals else None
+
+
+class TestGenerationCancel(HandlerTestCase):
+
+    async def test_supersede(self):
+        controller = AdmissionController(per_user_limit=1)
+        handler = self.create_handler(admission_controller=controller)
+        gate = asyncio.Event()
+        self.scripts.extend([answer_script("t1", gate), answer_script("t2")])
+        first = await self.send(handler, "第一个问题")
+        await self.wait_for(lambda: self.cards[first])
+        # 同一用户发来新消息：停止之前的生成，新消息不排在被取消的请求后面
+        second = await self.send(handler, "第二个问题")
+        await self.wait_idle(handler)
+        self.assertEqual((ANSWER[0] + SUPERSEDED_CARD_TEXT, True, False), self.final(first))
+        self.assertEqual(["t1"], self.dify_stops)
+        self.assertEqual(("".join(ANSWER), True, False), self.final(second))
+        self.assertEqual(0, controller.stats()["queued"])
+        self.assertEqual({"running": 0, "waiting": 0}, {k: controller.stats()[k] for k in ("running", "waiting")})
+        self.assertEqual(1, handler.generations.stats()["superseded"])
+        gate.set()
+
+    async def test_stop(self):
+        handler = self.create_handler()
+        gate = asyncio.Event()
+        self.scripts.append(answer_script("t1", gate))
+        first = await self.send(handler, "问题")
+        await self.wait_for(lambda: self.cards[first])
+        await self.send(handler, "停止")
+        await self.wait_idle(handler)
+        self.assertEqual([STOP_REPLY_TEXT], self.replies)
+        self.assertEqual((ANSWER[0] + STOPPED_CARD_TEXT, True, False), self.final(first))
+        self.assertEqual(["t1"], self.dify_stops)
+        self.assertEqual(1, len(self.dify_requests))
+        gate.set()
+
+    async def test_stop_after_finished(self):
+        handler = self.create_handler()
+        first = await self.send(handler, "问题")
+        await self.wait_idle(handler)
+        await self.send(handler, "stop")
+        self.assertEqual([NOTHING_TO_STOP_TEXT], self.replies)
+        self.assertEqual(("".join(ANSWER), True, False), self.final(first))
+        self.assertEqual([], self.dify_stops)
+
+    async def test_stop_during_final_update(self):
+        # 回答已经生成完、正在发送最终卡片时收到停止指令或新消息，不能打断最终更新
+        handler = self.create_handler()
+        self.final_gate = asyncio.Event()
+        first = await self.send(handler, "问题")
+        await asyncio.wait_for(self.final_started.wait(), 5)
+        await self.send(handler, "停止")
+        second = await self.send(handler, "新问题")
+        self.final_gate.set()
+        await self.wait_idle(handler)
+        self.assertEqual([NOTHING_TO_STOP_TEXT], self.replies)
+        self.assertEqual(("".join(ANSWER), True, False), self.final(first))
+        self.assertEqual(("".join(ANSWER), True, False), self.final(second))
+        self.assertEqual([], self.dify_stops)
+        self.assertEqual(
+            {"completed": 2, "superseded": 0, "stopped": 0},
+            {k: handler.generations.stats()[k] for k in ("completed", "superseded", "stopped")},
+        )
+
+
+class TestGenerationCancelCoalesce(TestGenerationCancel):
+    card_update_mode = "coalesce"
+
+
+class TestStreamRetry(HandlerTestCase):
+
+    async def test_retry_before_first_token(self):
+        # 还没有向卡片输出内容时失败：重试，用户只看到一张卡片、一份完整的回答
+        for failure in (503, ["disconnect"]):
+            self.scripts.extend([failure, answer_script()])
+            handler = self.create_handler()
+            message_id = await self.send(handler, "问题")
+            await self.wait_idle(handler)
+            self.assertEqual(("".join(ANSWER), True, False), self.final(message_id))
+            # 中间的每次更新都是最终回答的前缀，没有重复输出
+            self.assertTrue(all("".join(ANSWER).startswith(content) for content, _, _ in self.cards[message_id]))
+        self.assertEqual(4, len(self.dify_requests))
+        self.assertEqual(2, len(self.created_cards))
+
+    async def test_no_retry_after_first_token(self):
+        # 已经输出过内容再中断：不重试，避免重复或错乱的回答
+        gate = asyncio.Event()
+        self.scripts.append([message_event(ANSWER[0]), gate, "disconnect"])
+        handler = self.create_handler()
+        message_id = await self.send(handler, "问题")
+        await self.wait_for(lambda: self.cards[message_id])
+        gate.set()
+        await self.wait_idle(handler)
+        content, finished, failed = self.final(message_id)
+        self.assertTrue(failed)
+        self.assertIn("读取模型服务输出中断", content)
+        self.assertEqual(1, len(self.dify_requests))
+        self.assertEqual(1, len(self.created_cards))
+
+    async def test_circuit_open(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=1)
+        handler = self.create_handler(client={"circuit_breaker": circuit_breaker})
+        circuit_breaker.record_failure()
+        message_id = await self.send(handler, "问题")
+        await self.wait_idle(handler)
+        self.assertEqual((UPSTREAM_BUSY_CARD_TEXT, True, False), self.final(message_id))
+        self.assertEqual([], self.dify_requests)
+
+
+class TestAdmission(HandlerTestCase):
+
+    def assertReleased(self, controller: AdmissionController):
+        self.assertEqual({"running": 0, "waiting": 0}, {k: controller.stats()[k] for k in ("running", "waiting")})
+
+    async def test_queued_and_merged(self):
+        controller = AdmissionController(global_limit=1, per_user_policy="merge")
+        handler = self.create_handler(admission_controller=controller)
+        gate = asyncio.Event()
+        self.scripts.extend([answer_script("t1", gate), answer_script("t2")])
+        running = await self.send(handler, "其他用户的问题", user="u2")
+        await self.wait_for(lambda: self.cards[running])
+        # 排队时卡片上显示排队位置，排队期间同一用户的新消息合并到排队的请求中
+        queued = await self.send(handler, "问题一")
+        await self.wait_for(lambda: self.cards[queued])
+        self.assertEqual((QUEUED_CARD_TEXT.format(position=1), False, False), self.cards[queued][0])
+        merged = await self.send(handler, "问题二")
+        await self.wait_for(lambda: self.final(merged))
+        self.assertEqual((MERGED_CARD_TEXT, True, False), self.final(merged))
+        gate.set()
+        await self.wait_idle(handler)
+        self.assertEqual(("".join(ANSWER), True, False), self.final(queued))
+        self.assertEqual("问题一\n问题二", self.dify_requests[1]["query"])
+        self.assertEqual(2, len(self.dify_requests))
+        self.assertEqual({"queued": 1, "merged": 1}, {k: controller.stats()[k] for k in ("queued", "merged")})
+        self.assertReleased(controller)
+
+    async def test_rejected(self):
+        controller = AdmissionController(global_limit=1, max_queue=0)
+        handler = self.create_handler(admission_controller=controller)
+        gate = asyncio.Event()
+        self.scripts.append(answer_script("t1", gate))
+        running = await self.send(handler, "其他用户的问题", user="u2")
+        await self.wait_for(lambda: self.cards[running])
+        rejected = await self.send(handler, "问题")
+        await self.wait_for(lambda: self.final(rejected))
+        self.assertEqual((BUSY_CARD_TEXT, True, False), self.final(rejected))
+        gate.set()
+        await self.wait_idle(handler)
+        self.assertEqual(1, len(self.dify_requests))
+        self.assertEqual(1, controller.stats()["rejected"])
+        self.assertReleased(controller)
+
+    async def test_release_on_error(self):
+        controller = AdmissionController(global_limit=1)
+        handler = self.create_handler(admission_controller=controller)
+        self.scripts.append(400)
+        message_id = await self.send(handler, "问题")
+        await self.wait_idle(handler)
+        self.assertTrue(self.final(message_id)[2])
+        self.assertReleased(controller)
+        # 名额已经释放，后续消息正常回答
+        message_id = await self.send(handler, "问题")
+        await self.wait_idle(handler)
+        self.assertEqual(("".join(ANSWER), True, False), self.final(message_id))
+        self.assertReleased(controller)
+
+
+class TestCardFailure(HandlerTestCase):
+
+    async def test_create_card_failed(self):
+        # 卡片创建失败时用户看不到回答，停止读取 Dify 的输出，不再继续生成
+        handler = self.create_handler()
+        dify_gate = asyncio.Event()
+        self.card_gate = asyncio.Event()
+        self.card_error = CardCreationError("创建卡片失败")
+        self.scripts.append(answer_script("t1", dify_gate))
+        message_id = await self.send(handler, "问题")
+        await self.wait_for(lambda: self.dify_requests)
+        self.card_gate.set()
+        await self.wait_idle(handler)
+        dify_gate.set()
+        await self.wait_for(lambda: self.dify_disconnects)
+        self.assertEqual([], self.cards[message_id])
+        self.assertEqual(1, len(self.dify_requests))
+        self.assertEqual(0, handler.generations.stats()["completed"])
+        # 没有残留进行中的生成，同一用户的下一条消息正常回答
+        self.card_gate = self.card_error = None
+        message_id = await self.send(handler, "问题")
+        await self.wait_idle(handler)
+        self.assertEqual(("".join(ANSWER), True, False), self.final(message_id))
+        self.assertEqual([], self.dify_stops)
+
+    async def test_release_on_card_failure(self):
+        controller = AdmissionController(global_limit=1)
+        handler = self.create_handler(admission_controller=controller)
+        self.card_error = CardCreationError("创建卡片失败")
+        await self.send(handler, "问题")
+        await self.wait_idle(handler)
+        self.assertEqual({"running": 0, "waiting": 0}, {k: controller.stats()[k] for k in ("running", "waiting")})
+
+
+class TestHandlerDefaults(unittest.TestCase):
+
+    def test_conversation_remain_time(self):
+        # 没有设置 DIFY_CONVERSATION_REMAIN_TIME 时使用 configs 中的默认值
+        with mock.patch.dict(os.environ):
+            os.environ.pop("DIFY_CONVERSATION_REMAIN_TIME", None)
+            handler = DifyAiCardBotHandler(dify_api_client=None)
+        self.addCleanup(handler.cache.close)
+        self.assertEqual(60 * DIFY_CONVERSATION_REMAIN_TIME, handler.cache.expiry_time)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import os
+import tempfile
+import time
+import unittest
+
+from dingtalk_stream import ChatbotMessage
+
+from core.conversation_store import MemoryConversationStore
+from core.handlers import DifyAiCardBotHandler, _StreamState
+from core.journal import (
+    JournalWriter,
+    hash_user,
+    journal_files,
+    read_journal,
+    setup_journal,
+    shutdown_journal,
+    worker_journal_path,
+)
+from core.metrics import create_request_timings
+
+
+class TestJournalWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "journal", "requests.jsonl")
+
+    def test_batched_write(self):
+        writer = JournalWriter(self.path, batch_size=2, flush_interval=0.05)
+        for i in range(5):
+            writer.record({"seq": i, "query": f"问题{i}"})
+        time.sleep(0.3)
+        # 不需要等 stop，间隔到了就写入
+        self.assertEqual(5, writer.stats()["written"])
+        self.assertGreaterEqual(writer.stats()["batches"], 3)
+        writer.stop()
+        self.assertEqual([0, 1, 2, 3, 4], [r["seq"] for r in read_journal(self.path)])
+
+    def test_rotate_and_compress(self):
+        writer = JournalWriter(self.path, batch_size=1, flush_interval=0.01, max_bytes=200, backup_count=2, compress=True)
+        for i in range(30):
+            writer.record({"seq": i, "query": "x" * 80})
+        writer.stop()
+        files = journal_files(self.path)
+        self.assertEqual(self.path, files[-1])
+        self.assertEqual(2, len(files) - 1)
+        self.assertTrue(all(f.endswith(".gz") for f in files[:-1]))
+        self.assertGreater(writer.stats()["rotations"], 2)
+        # 进程异常退出时最后一行可能不完整
+        with open(self.path, "a") as f:
+            f.write('{"seq": 99, "que')
+        seqs = [r["seq"] for r in read_journal(self.path)]
+        self.assertEqual(list(range(30 - len(seqs), 30)), seqs)
+
+    def test_exclude_query(self):
+        writer = JournalWriter(self.path, flush_interval=0.01, include_query=False)
+        writer.record({"query": "秘密", "query_chars": 2})
+        writer.stop()
+        self.assertEqual([{"query": None, "query_chars": 2}], list(read_journal(self.path)))
+
+    def test_worker_path(self):
+        self.assertEqual("data/requests.worker1.jsonl", worker_journal_path("data/requests.jsonl", 1))
+
+
+class TestHandlerJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "requests.jsonl")
+
+    def tearDown(self):
+        shutdown_journal()
+
+    def test_record(self):
+        handler = DifyAiCardBotHandler(dify_api_client=None, conversation_store=MemoryConversationStore(), bot_name="bot")
+        message = ChatbotMessage.from_dict(
+            {"msgtype": "text", "text": {"content": "你好"}, "senderStaffId": "staff-1", "conversationType": "1", "msgId": "m1"}
+        )
+        # 没有开启请求日志时不统计事件
+        self.assertIsNone(_StreamState().events)
+        setup_journal(self.path, flush_interval=0.01)
+        # 关闭指标时也要记录耗时
+        timings = create_request_timings("bot", "m1", record=True)
+        state = _StreamState()
+        for answer in ("你", "好"):
+            handler._handle_stream_event(f'{{"event": "message", "answer": "{answer}"}}'.encode("utf-8"), state, message)
+        handler._handle_stream_event(b'{"event": "message_end", "conversation_id": "c1"}', state, message)
+        handler._handle_stream_event('{"task_id": "t1", "event": "ping"}', state, message)
+        timings.mark("dify_request")
+        timings.mark("dify_response")
+        timings.card_update(6)
+        timings.answer_chars = len(state.full_content)
+        handler._journal_request(timings.finish("ok"), message, "你好", state)
+        shutdown_journal()
+
+        record = list(read_journal(self.path))[0]
+        self.assertEqual("bot", record["bot"])
+        self.assertEqual("m1", record["message_id"])
+        self.assertEqual(hash_user("staff-1"), record["user"])
+        self.assertNotIn("staff-1", str(record))
+        self.assertEqual("你好", record["query"])
+        self.assertEqual({"message": 2, "message_end": 1, "ping": 1}, record["events"])
+        self.assertEqual(2, record["answer_chars"])
+        self.assertEqual(1, record["card_updates"])
+        self.assertIn("dify_response", record["timings"])
+        self.assertAlmostEqual(time.time(), record["ts"], delta=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import io
+import threading
+import unittest
+
+from dingtalk_stream import ChatbotMessage
+
+from core import log
+from core.handlers import _loggable_message
+from core.log import BackgroundWriter, redact, sample_debug, setup_logging, shutdown_logging
+from core.sse import SSEDispatcher
+
+
+class _SlowStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def write(self, s):
+        self.release.wait(5)
+        return super().write(s)
+
+
+class TestLogging(unittest.TestCase):
+
+    def tearDown(self):
+        shutdown_logging()
+        setup_logging(level="DEBUG")
+        log._settings.update(debug=True, sample_rate=1.0, max_length=0, redact=False)
+
+    def test_background_writer(self):
+        stream = _SlowStream()
+        writer = BackgroundWriter(stream, max_queue=2)
+        for i in range(10):
+            writer.write(f"{i}\n")
+        # 写入线程被卡住时 write 不阻塞，超出队列的直接丢弃
+        self.assertGreater(writer.dropped, 0)
+        stream.release.set()
+        writer.stop()
+        self.assertEqual(10, writer.written + writer.dropped)
+        self.assertEqual(writer.written, len(stream.getvalue().splitlines()))
+
+    def test_enqueue_and_truncate(self):
+        stream = io.StringIO()
+        setup_logging(level="INFO", enqueue=True, max_length=20, stream=stream)
+        from loguru import logger
+
+        logger.info("x" * 100)
+        logger.debug("不输出")
+        shutdown_logging()
+        output = stream.getvalue()
+        self.assertIn("x" * 20 + "...(截断，共100字符)", output)
+        self.assertNotIn("x" * 21, output)
+        self.assertNotIn("不输出", output)
+
+    def test_debug_disabled(self):
+        setup_logging(level="INFO", stream=io.StringIO())
+        self.assertFalse(sample_debug())
+        dispatcher = SSEDispatcher({"message": lambda payload: payload["answer"]})
+        self.assertEqual("hi", dispatcher.dispatch(b'{"event": "message", "answer": "hi"}'))
+
+    def test_sample_rate(self):
+        setup_logging(level="DEBUG", sample_rate=0, stream=io.StringIO())
+        self.assertFalse(any(sample_debug() for _ in range(100)))
+        setup_logging(level="DEBUG", sample_rate=0.5, stream=io.StringIO())
+        self.assertTrue(0 < sum(sample_debug() for _ in range(1000)) < 1000)
+
+    def test_redact(self):
+        message = ChatbotMessage.from_dict(
+            {"msgId": "m1", "conversationId": "c1", "senderStaffId": "u1", "msgtype": "text", "text": {"content": "我的工资是多少"}}
+        )
+        self.assertIs(message, _loggable_message(message))
+        self.assertEqual("secret", redact("secret"))
+        setup_logging(level="INFO", redact=True, stream=io.StringIO())
+        self.assertEqual("<6字符>", redact("secret"))
+        loggable = _loggable_message(message)
+        self.assertEqual("<7字符>", loggable["text"])
+        self.assertEqual("m1", loggable["message_id"])
+
+
+if __name__ == "__main__":
+    unittest.main()
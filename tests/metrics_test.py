@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import time
+import unittest
+import urllib.request
+
+from core import metrics
+from core.metrics import MetricsRegistry, NULL_TIMINGS, RequestTimings, create_request_timings, start_metrics_server
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_total", "计数", ("bot",))
+        counter.inc(1, "a")
+        counter.inc(2, "a")
+        histogram = registry.histogram("test_seconds", "耗时", ("bot",), buckets=(0.1, 1))
+        histogram.observe(0.05, "a")
+        histogram.observe(0.5, "a")
+        histogram.observe(5, "a")
+        registry.register_stats("test_pool", lambda: {"requests": 3, "mode": "append"}, bot="a")
+
+        text = registry.render()
+        self.assertIn('test_total{bot="a"} 3', text)
+        self.assertIn('test_seconds_bucket{bot="a",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{bot="a",le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{bot="a",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{bot="a"} 3', text)
+        self.assertIn('test_pool_requests{bot="a"} 3', text)
+        # 非数值的统计项不导出
+        self.assertNotIn("test_pool_mode", text)
+
+        registry.unregister_stats("test_pool", bot="a")
+        self.assertNotIn("test_pool_requests", registry.render())
+
+    def test_server(self):
+        registry = MetricsRegistry()
+        registry.counter("test_total", "计数").inc(1)
+        server = start_metrics_server(port=0, host="127.0.0.1", registry=registry)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            with urllib.request.urlopen(url) as response:
+                self.assertIn("test_total 1", response.read().decode("utf-8"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestRequestTimings(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.enable_metrics(False)
+
+    def test_disabled(self):
+        timings = create_request_timings("bot")
+        self.assertIs(NULL_TIMINGS, timings)
+        timings.mark("ack")
+        timings.card_update(10)
+        timings.answer_chars = 10
+        self.assertEqual({}, timings.marks)
+        self.assertEqual(0, timings.answer_chars)
+        self.assertIsNone(timings.finish())
+
+    def test_record(self):
+        metrics.enable_metrics()
+        timings = create_request_timings("timings_test_bot", "msg1")
+        self.assertIsInstance(timings, RequestTimings)
+        count = metrics.REQUEST_SECONDS.get("timings_test_bot")["count"]
+
+        timings.mark("ack")
+        timings.mark("dify_response")
+        # 排队位置等提示文字的卡片更新不算首段内容
+        timings.card_update(6)
+        self.assertNotIn("first_token", timings.marks)
+        time.sleep(0.01)
+        timings.first_token()
+        timings.card_update(6)
+        first_token = timings.marks["first_token"]
+        timings.first_token()
+        timings.card_update(0)
+        # 同一时间点只记录第一次
+        self.assertEqual(first_token, timings.marks["first_token"])
+        timings.answer_chars = 4
+        record = timings.finish()
+
+        self.assertEqual("msg1", record["message_id"])
+        self.assertEqual(3, record["card_updates"])
+        self.assertEqual(12, record["card_bytes"])
+        self.assertGreater(record["timings"]["finished"], 0)
+        self.assertEqual(count + 1, metrics.REQUEST_SECONDS.get("timings_test_bot")["count"])
+        self.assertEqual(2, metrics.CARD_UPDATE_GAP_SECONDS.get("timings_test_bot")["count"])
+        self.assertEqual(1, metrics.REQUESTS_TOTAL.get("timings_test_bot", "ok"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from core.dingtalk_api import get_http_session
+from core.runtime import BotRuntime, LoopThread, get_rss_bytes
+
+
+class FakeStreamClient(object):
+    """和 dingtalk_stream.DingTalkStreamClient.start 一样，被取消后会等待一段时间再重连"""
+
+    instances = []
+
+    def __init__(self, credential, logger=None):
+        self.credential = credential
+        self.callback_handler_map = {}
+        self.connects = 0
+        self.stopped = False
+        FakeStreamClient.instances.append(self)
+
+    def register_callback_handler(self, topic, handler):
+        handler.dingtalk_client = self
+        self.callback_handler_map[topic] = handler
+
+    async def start(self):
+        try:
+            while True:
+                self.connects += 1
+                try:
+                    await asyncio.sleep(3600)
+                except asyncio.CancelledError:
+                    await asyncio.sleep(10)
+        finally:
+            self.stopped = True
+
+
+class FakeHandler(object):
+
+    def __init__(self):
+        self.busy = threading.Event()
+        self.dify_api_client = None
+
+    def inflight(self, loop=None) -> int:
+        return 1 if self.busy.is_set() else 0
+
+
+class FakeAsyncDifyClient(object):
+    """记录在哪些事件循环上关闭了 session"""
+
+    def __init__(self):
+        self.closed_loops = []
+
+    async def close(self):
+        self.closed_loops.append(asyncio.get_running_loop())
+
+
+class TestRuntime(unittest.TestCase):
+
+    def test_loop_thread(self):
+        loop_thread = LoopThread("test-loop")
+
+        async def current_thread():
+            await asyncio.sleep(0)
+            return threading.current_thread().name
+
+        self.assertEqual("test-loop", loop_thread.submit(current_thread()).result(1))
+        loop_thread.stop()
+        loop_thread.join(1)
+
+    def test_shared_loops(self):
+        runtime = BotRuntime(mode="asyncio", loops=2)
+        picked = {runtime._pick_loop("bot").name for _ in range(4)}
+        self.assertEqual({"dingtalk-loop-0", "dingtalk-loop-1"}, picked)
+        runtime.stop()
+
+    @mock.patch("dingtalk_stream.DingTalkStreamClient", FakeStreamClient)
+    def test_reload(self):
+        FakeStreamClient.instances = []
+        runtime = BotRuntime(mode="threads")
+        handler = FakeHandler()
+        runtime.add_bot("bot", "id", "secret", handler, connections=2)
+        self.assertEqual(2, len(runtime.bots["bot"]))
+
+        # 减少连接：多出的连接真正退出，而不是被 SDK 吞掉取消后重连
+        runtime.resize_bot("bot", 1, drain_timeout=1)
+        self.assertEqual(1, len(runtime.bots["bot"]))
+        self.assertTrue(FakeStreamClient.instances[1].stopped)
+        self.assertFalse(FakeStreamClient.instances[0].stopped)
+
+        # 替换 handler 不断开连接
+        new_handler = FakeHandler()
+        self.assertIs(handler, runtime.replace_handler("bot", new_handler, drain_timeout=1))
+        client = FakeStreamClient.instances[0]
+        self.assertIs(new_handler, list(client.callback_handler_map.values())[0])
+        self.assertFalse(client.stopped)
+
+        # 停止机器人时等进行中的消息处理完再停止事件循环
+        new_handler.busy.set()
+        loop_thread = runtime.bots["bot"][0].loop_thread
+        runtime.remove_bot("bot", drain_timeout=5)
+        self.assertNotIn("bot", runtime.bots)
+        self.assertTrue(client.stopped)
+        time.sleep(0.2)
+        self.assertIn(loop_thread, runtime._loop_threads)
+        new_handler.busy.clear()
+        deadline = time.monotonic() + 3
+        while loop_thread in runtime._loop_threads and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.assertNotIn(loop_thread, runtime._loop_threads)
+        runtime.stop()
+
+    @mock.patch("dingtalk_stream.DingTalkStreamClient", FakeStreamClient)
+    def test_release_sessions(self):
+        runtime = BotRuntime(mode="threads")
+        handler = FakeHandler()
+        handler.dify_api_client = FakeAsyncDifyClient()
+        runtime.add_bot("bot", "id", "secret", handler, connections=2)
+        loop_thread = runtime.bots["bot"][1].loop_thread
+
+        async def open_session():
+            return get_http_session()
+
+        session = loop_thread.submit(open_session()).result(1)
+        # 减少连接时停止事件循环之前关闭绑定在它上面的 session
+        runtime.resize_bot("bot", 1, drain_timeout=1)
+        deadline = time.monotonic() + 3
+        while loop_thread in runtime._loop_threads and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(session.closed)
+        self.assertEqual([loop_thread.loop], handler.dify_api_client.closed_loops)
+        runtime.remove_bot("bot", drain_timeout=1)
+        runtime.stop()
+
+    def test_rss(self):
+        self.assertGreater(get_rss_bytes(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
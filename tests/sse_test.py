@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import json
+import unittest
+
+from core.sse import SSEDecoder, SSEDispatcher, find_event_type, iter_sse_events, peek_event_type, peek_task_id
+
+
+class _FakeResponse:
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def iter_content(self, chunk_size=None):
+        return iter(self._chunks)
+
+
+class TestSSEDecoder(unittest.TestCase):
+
+    def test_split_chunks(self):
+        stream = (
+            'data: {"event": "message", "answer": "你好"}\r\n\r\n: ping\n\nevent: custom\nid: 1\ndata: a\ndata: b\n\ndata: tail'.encode()
+        )
+        for size in (1, 3, len(stream)):
+            decoder = SSEDecoder()
+            events = []
+            for i in range(0, len(stream), size):
+                events.extend(decoder.feed(stream[i : i + size]))
+            events.extend(decoder.flush())
+            self.assertEqual(['{"event": "message", "answer": "你好"}', "a\nb", "tail"], [e.data for e in events])
+            self.assertEqual(["message", "custom", "message"], [e.event for e in events])
+            self.assertEqual("1", events[1].id)
+
+    def test_iter_sse_events(self):
+        events = list(iter_sse_events(_FakeResponse([b"data: 1\n", b"\ndata: 2\n\n"])))
+        self.assertEqual([b"1", b"2"], [e.raw for e in events])
+
+
+class TestSSEDispatcher(unittest.TestCase):
+
+    def test_peek_event_type(self):
+        self.assertEqual("node_started", peek_event_type(b'{"event": "node_started", "data": {}}'))
+        self.assertEqual("message", peek_event_type(b' {"event":"message"}'))
+        # event 不是第一个字段时需要完整解析
+        self.assertIsNone(peek_event_type(b'{"task_id": "1", "event": "message"}'))
+        self.assertIsNone(peek_event_type(b"[DONE]"))
+
+    def test_find_event_type(self):
+        self.assertEqual("message", find_event_type('{"task_id": "1", "event": "message"}'))
+        self.assertEqual("ping", find_event_type(b'{"event": "ping"}'))
+        self.assertIsNone(find_event_type(b"[DONE]"))
+
+    def test_peek_task_id(self):
+        self.assertEqual("t-1", peek_task_id(b'{"event": "message", "task_id": "t-1", "answer": "hi"}'))
+        self.assertIsNone(peek_task_id('{"event": "ping"}'))
+
+    def test_dispatch(self):
+        calls = []
+        dispatcher = SSEDispatcher({"message": lambda r, state: calls.append((r["answer"], state)) or ["ok"]}, frozenset(["node_started"]))
+
+        self.assertEqual(["ok"], dispatcher.dispatch(b'{"event": "message", "answer": "a"}', 1))
+        self.assertEqual(["ok"], dispatcher.dispatch('{"task_id": "1", "event": "message", "answer": "b"}', 2))
+        # 忽略的、未知的事件不解析；格式错误的也不会抛异常
+        self.assertIsNone(dispatcher.dispatch(b'{"event": "node_started", "data": {' + json.dumps({"x": "y" * 1000}).encode(), 3))
+        self.assertIsNone(dispatcher.dispatch(b'{"event": "unknown"}', 4))
+        self.assertIsNone(dispatcher.dispatch(b"[DONE", 5))
+        self.assertIsNone(dispatcher.dispatch(b'{"task_id": "1", "event": "tts_message"}', 6))
+
+        self.assertEqual([("a", 1), ("b", 2)], calls)
+        self.assertEqual(2, dispatcher.skipped)
+        self.assertEqual(3, dispatcher.parsed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import builtins
+import sys
+import unittest
+from unittest import mock
+
+from core.startup import StartupProfile, process_age
+
+
+class TestStartupProfile(unittest.TestCase):
+
+    def test_process_age(self):
+        self.assertGreaterEqual(process_age(), 0)
+        self.assertEqual("interpreter", StartupProfile().phases[0][0])
+
+    def test_trace_imports(self):
+        profile = StartupProfile()
+        original_import = builtins.__import__
+        sys.modules.pop("colorsys", None)
+        with profile.phase("imports"), profile.trace_imports():
+            import colorsys  # noqa: F401
+            import json  # noqa: F401
+        self.assertIs(original_import, builtins.__import__)
+        self.assertIn("colorsys", profile.imports)
+        self.assertIn("json", profile.imports)
+        # 已经导入过的包不计入 packages
+        self.assertIn("colorsys", profile.packages)
+        self.assertNotIn("json", profile.packages)
+        self.assertIn("imports", profile.summary()["phases"])
+
+    def test_connection_ready(self):
+        profile = StartupProfile(summary_timeout=60)
+        with mock.patch.object(profile, "report") as report:
+            profile.expect_connections(2)
+            profile.connection_ready("a")
+            summary = profile.summary()
+            self.assertEqual("1/2", summary["connections"])
+            self.assertIsNotNone(summary["first_ready"])
+            self.assertIsNone(summary["all_ready"])
+            report.assert_not_called()
+            profile.connection_ready("b")
+            report.assert_called_once()
+        profile._timer.cancel()
+        self.assertGreaterEqual(profile.stats()["all_ready_seconds"], profile.stats()["first_ready_seconds"])
+
+    def test_report_once(self):
+        profile = StartupProfile()
+        profile.expect_connections(1)
+        profile.connection_ready("a")
+        self.assertTrue(profile._timer.finished.is_set())
+        # 输出统计之后的重连不再计数
+        profile.connection_ready("a")
+        self.assertEqual("1/1", profile.summary()["connections"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import time
+import unittest
+from unittest import mock
+
+from core.upstream import CircuitBreaker, CircuitOpenError, backoff_delay
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_and_recover(self):
+        breaker = CircuitBreaker(failure_threshold=3, recovery_time=0.1)
+        for _ in range(2):
+            breaker.before_request()
+            breaker.record_failure()
+        # 中间的成功会清零连续失败次数
+        breaker.record_success()
+        for _ in range(3):
+            breaker.before_request()
+            breaker.record_failure()
+        self.assertEqual("open", breaker.state)
+        self.assertTrue(breaker.is_open())
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+
+        time.sleep(0.12)
+        self.assertEqual("half_open", breaker.state)
+        self.assertFalse(breaker.is_open())
+        # 半开状态只放行一个探测请求
+        breaker.before_request()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        breaker.record_success()
+        self.assertEqual("closed", breaker.state)
+        breaker.before_request()
+        self.assertEqual(
+            {"open": 0, "half_open": 0, "consecutive_failures": 0, "failures": 5, "opened": 1, "rejected": 2}, breaker.stats()
+        )
+
+    def test_probe_failure_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        breaker.before_request()
+        breaker.record_failure()
+        self.assertEqual("open", breaker.state)
+        self.assertEqual(2, breaker.stats()["opened"])
+
+    def test_probe_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0, probe_timeout=0.05)
+        breaker.record_failure()
+        breaker.before_request()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        # 探测请求一直没有结果时允许新的探测
+        time.sleep(0.06)
+        breaker.before_request()
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(failure_threshold=0)
+        for _ in range(100):
+            breaker.record_failure()
+            breaker.before_request()
+        self.assertEqual("closed", breaker.state)
+
+    def test_backoff_delay(self):
+        with mock.patch("core.upstream.random.uniform", side_effect=lambda a, b: b):
+            self.assertEqual([0.5, 1, 2, 4, 5], [backoff_delay(n, 0.5, cap=5) for n in range(1, 6)])
+        self.assertTrue(all(0 <= backoff_delay(3, 0.5) <= 2 for _ in range(100)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# __author__ = 'zfanswer'
+import queue
+import sys
+import time
+import unittest
+from unittest import mock
+
+from dingtalk_stream import CallbackMessage
+
+from core.runtime import BotRuntime
+from core.workers import Supervisor, WorkerContext, assign_connections, merge_metrics
+from runtime_test import FakeStreamClient
+
+
+def _crashing_worker(index, workers, inboxes):
+    sys.exit(3)
+
+
+def _callback(sender: str, message_id: str = "m") -> CallbackMessage:
+    callback_msg = CallbackMessage()
+    callback_msg.headers.message_id = message_id
+    callback_msg.data = {"msgId": message_id, "senderStaffId": sender, "msgtype": "text", "text": {"content": "hi"}}
+    return callback_msg
+
+
+class _ProcessingHandler(object):
+    def __init__(self):
+        self.processed = []
+
+    async def process(self, callback_msg):
+        self.processed.append(callback_msg)
+
+
+class TestAssignment(unittest.TestCase):
+
+    def test_assign_connections(self):
+        self.assertEqual([1, 1, 1, 1], assign_connections("bot", 4, 4))
+        self.assertEqual(6, sum(assign_connections("bot", 6, 4)))
+        self.assertEqual(1, sum(assign_connections("bot", 1, 4)))
+        # 不同机器人从不同的 worker 开始分配，单连接的机器人不会都落在 worker0
+        starts = {assign_connections(f"bot-{i}", 1, 4).index(1) for i in range(20)}
+        self.assertGreater(len(starts), 1)
+
+    def test_filter_bots_config(self):
+        conf = {"bots": [{"name": "a", "connections": 2}, {"name": "b", "connections": 1}]}
+        names = [
+            [bot["name"] for bot in WorkerContext(i, 2, []).filter_bots_config(conf, lambda bot: bot["connections"])["bots"]]
+            for i in range(2)
+        ]
+        self.assertEqual(["a", "a"], [n for ns in names for n in ns if n == "a"])
+        self.assertEqual(1, sum(ns.count("b") for ns in names))
+
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.inboxes = [queue.Queue(), queue.Queue()]
+        self.workers = [WorkerContext(i, 2, self.inboxes) for i in range(2)]
+        for worker in self.workers:
+            worker.set_bot("bot", 2)
+
+    def test_route_by_sender(self):
+        handled = {0: set(), 1: set()}
+        for i in range(50):
+            sender = f"user-{i}"
+            # 无论消息先到哪个 worker，最终都由同一个 worker 处理
+            owners = set()
+            for worker in self.workers:
+                if worker.route("bot", _callback(sender)):
+                    owners.add(1 - worker.index)
+                    self.inboxes[1 - worker.index].get_nowait()
+                else:
+                    owners.add(worker.index)
+            self.assertEqual(1, len(owners))
+            handled[owners.pop()].add(sender)
+        self.assertTrue(handled[0] and handled[1])
+
+    def test_forwarded_not_routed_again(self):
+        callback_msg = _callback("someone")
+        callback_msg.extensions["forwarded_from"] = 1
+        self.assertFalse(self.workers[0].route("bot", callback_msg))
+        # 只在一个 worker 中运行的机器人不转交
+        self.workers[0].set_bot("single", 1)
+        self.assertFalse(self.workers[0].route("single", _callback("someone")))
+
+    def test_serve(self):
+        worker = WorkerContext(0, 2, self.inboxes, pending_timeout=5)
+        dispatched = []
+        ready = []
+
+        def dispatch(bot_name, callback_msg):
+            # 第一次调用时机器人还没有启动
+            if not ready:
+                ready.append(True)
+                return False
+            dispatched.append((bot_name, callback_msg))
+            return True
+
+        worker.serve(dispatch)
+        self.workers[1].inboxes[0].put(("bot", 1, {"messageId": "m1"}, {"senderStaffId": "u"}))
+        deadline = time.monotonic() + 3
+        while not dispatched and time.monotonic() < deadline:
+            time.sleep(0.05)
+        bot_name, callback_msg = dispatched[0]
+        self.assertEqual("bot", bot_name)
+        self.assertEqual("m1", callback_msg.headers.message_id)
+        self.assertEqual(1, callback_msg.extensions["forwarded_from"])
+        self.assertEqual({"forwarded": 0, "received": 1, "pending": 0, "dropped": 0}, worker.stats())
+
+    @mock.patch("dingtalk_stream.DingTalkStreamClient", FakeStreamClient)
+    def test_runtime_dispatch(self):
+        runtime = BotRuntime(mode="asyncio")
+        handler = _ProcessingHandler()
+        self.assertFalse(runtime.dispatch("bot", _callback("u")))
+        runtime.add_bot("bot", "id", "secret", handler)
+        self.assertTrue(runtime.dispatch("bot", _callback("u")))
+        deadline = time.monotonic() + 2
+        while not handler.processed and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(1, len(handler.processed))
+        runtime.remove_bot("bot", drain_timeout=1)
+        runtime.stop()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_merge_metrics(self):
+        text = "\n".join(
+            [
+                "# HELP dod_requests_total 处理的消息数",
+                "# TYPE dod_requests_total counter",
+                'dod_requests_total{bot="a",status="ok"} {n}',
+                "# TYPE dod_runtime_bots gauge",
+                "dod_runtime_bots 1",
+            ]
+        )
+        merged = merge_metrics({0: text.replace("{n}", "3"), 1: text.replace("{n}", "5")}).splitlines()
+        self.assertEqual(1, merged.count("# TYPE dod_requests_total counter"))
+        index = merged.index("# TYPE dod_requests_total counter")
+        self.assertEqual(
+            ['dod_requests_total{worker="0",bot="a",status="ok"} 3', 'dod_requests_total{worker="1",bot="a",status="ok"} 5'],
+            merged[index + 1 : index + 3],
+        )
+        self.assertIn('dod_runtime_bots{worker="1"} 1', merged)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def test_restart(self):
+        supervisor = Supervisor(_crashing_worker, 1, restart_delay=0.05, max_restart_delay=0.2).start()
+        try:
+            deadline = time.monotonic() + 30
+            while supervisor.stats()["restarts"] < 2 and time.monotonic() < deadline:
+                supervisor.check()
+                time.sleep(0.05)
+        finally:
+            supervisor.stop()
+        self.assertGreaterEqual(supervisor.stats()["restarts"], 2)
+        self.assertEqual(0, supervisor.stats()["alive"])
+
+
+if __name__ == "__main__":
+    unittest.main()